@@ -19,16 +19,24 @@ A simple filesystem-backed store
 """
 
 import errno
+import fcntl
 import hashlib
 import logging
+import mmap
 import os
+import select
 import stat
+import sys
+import threading
+import time
+import uuid
 
 import jsonschema
 from oslo_config import cfg
 from oslo_serialization import jsonutils
 from oslo_utils import excutils
 from oslo_utils import units
+from six.moves import queue
 from six.moves import urllib
 
 import glance_store
@@ -45,6 +53,11 @@ _ = i18n._
 _LE = i18n._LE
 _LW = i18n._LW
 
+DURABILITY_NONE = 'none'
+DURABILITY_FDATASYNC = 'fdatasync'
+DURABILITY_GROUP = 'group'
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_FDATASYNC, DURABILITY_GROUP)
+
 _FILESYSTEM_CONFIGS = [
     cfg.StrOpt('filesystem_store_datadir',
                help=_('Directory to which the Filesystem backend '
@@ -67,7 +80,153 @@ _FILESYSTEM_CONFIGS = [
                       "of the group that owns the files created. Assigning "
                       "it less then or equal to zero means don't change the "
                       "default permission of the file. This value will be "
-                      "decoded as an octal digit."))]
+                      "decoded as an octal digit.")),
+    cfg.StrOpt('filesystem_store_durability',
+               default=DURABILITY_NONE,
+               choices=DURABILITY_MODES,
+               help=_("How image files are made durable before add() "
+                      "returns. 'none' leaves them to be written back by "
+                      "the kernel, so a crash may truncate images already "
+                      "reported as stored. 'fdatasync' flushes the data "
+                      "of every image file before it is renamed into "
+                      "place, and its directory after. 'group' does the "
+                      "same in batches on a background thread, syncing "
+                      "each directory once for all the uploads completed "
+                      "meanwhile, which costs less than a sync per image "
+                      "under concurrent uploads.")),
+    cfg.IntOpt('filesystem_store_temp_file_max_age',
+               default=3600,
+               help=_("Age in seconds since their last modification after "
+                      "which the temporary files of image files being "
+                      "written are considered left over by an interrupted "
+                      "write, and removed when the store is configured.")),
+    cfg.BoolOpt('filesystem_store_mmap_reads',
+                default=False,
+                help=_("Memory map image files when they are read, and "
+                       "return views of the mapping rather than copies of "
+                       "their data read into memory.")),
+    cfg.IntOpt('filesystem_store_read_threads',
+               default=0,
+               min=0,
+               help=_("Number of threads reading the images of at least "
+                      "filesystem_store_parallel_read_size with pread() "
+                      "at different offsets, ahead of the chunks being "
+                      "returned, which uses more of the bandwidth of NVMe "
+                      "arrays and parallel network filesystems than a "
+                      "single sequential reader. Assigning it 0 or 1 "
+                      "disables parallel reads.")),
+    cfg.IntOpt('filesystem_store_parallel_read_size',
+               default=64,
+               min=0,
+               help=_("Size in megabytes from which images are read by "
+                      "filesystem_store_read_threads threads.")),
+    cfg.BoolOpt('filesystem_store_fadvise',
+                default=False,
+                help=_("Give the kernel hints about the way image files "
+                       "are accessed with posix_fadvise(): they are read "
+                       "sequentially with readahead, and the image files "
+                       "larger than filesystem_store_drop_cache_size are "
+                       "dropped from the page cache as they are written or "
+                       "read, so that they don't evict the working set of "
+                       "the host.")),
+    cfg.IntOpt('filesystem_store_drop_cache_size',
+               default=1024,
+               min=0,
+               help=_("Size in megabytes above which image files are "
+                      "dropped from the page cache as they are written or "
+                      "read, when filesystem_store_fadvise is enabled.")),
+    cfg.IntOpt('filesystem_store_direct_io_size',
+               default=0,
+               min=0,
+               help=_("Size in megabytes from which images of a known "
+                      "size are written with O_DIRECT, bypassing the page "
+                      "cache. Assigning it 0 disables O_DIRECT writes.")),
+    cfg.BoolOpt('filesystem_store_preallocate',
+                default=False,
+                help=_("Preallocate the space of images of a known size "
+                       "with posix_fallocate() before writing them, which "
+                       "fails early when there isn't enough space left "
+                       "and gives them contiguous extents. Preallocated "
+                       "image files are not sparse, and filesystems "
+                       "without fallocate() support have it emulated by "
+                       "writing to every block.")),
+    cfg.BoolOpt('filesystem_store_fast_clone',
+                default=True,
+                help=_("Copy images within the store, such as snapshots, "
+                       "with a FICLONE reflink where the filesystem "
+                       "supports it (XFS, btrfs), which shares the data "
+                       "of the image file, or else with "
+                       "copy_file_range(), which copies it in the kernel, "
+                       "instead of streaming it. Only applies to copies "
+                       "within the same filesystem.")),
+    cfg.IntOpt('filesystem_store_fanout',
+               default=0,
+               min=0,
+               max=4,
+               help=_("Number of levels of subdirectories image files are "
+                      "spread in, each named after two hexadecimal digits "
+                      "of the SHA-256 of the image ID, e.g. "
+                      "<datadir>/ab/cd/<ID> with 2 levels. Assigning it 0 "
+                      "keeps image files directly in the datadir. Image "
+                      "files are found at any level whatever the value, "
+                      "and the glance-store-filesystem-layout command "
+                      "moves existing ones.")),
+    cfg.IntOpt('filesystem_store_capacity_cache_ttl',
+               default=5,
+               min=0,
+               help=_("Time in seconds the free space of the datadirs is "
+                      "cached for when picking the datadir of an image. "
+                      "Once stale, it is refreshed in the background while "
+                      "the cached value keeps being used. Assigning it 0 "
+                      "checks the free space on every upload.")),
+    cfg.IntOpt('filesystem_store_stripe_width',
+               default=0,
+               min=0,
+               help=_("Number of datadirs of filesystem_store_datadirs the "
+                      "images larger than filesystem_store_stripe_size are "
+                      "striped over, in extents of that size written and "
+                      "read in parallel. A manifest listing the extents "
+                      "takes the place of the image file. Assigning it 0 "
+                      "or 1 disables striping.")),
+    cfg.IntOpt('filesystem_store_stripe_size',
+               default=64,
+               min=1,
+               help=_("Size in megabytes of the extents of striped "
+                      "images."))]
+
+# Image files are written to a temporary file with this prefix, in the same
+# directory, and only renamed into place once complete.
+_TEMP_PREFIX = '.glance-tmp-'
+
+# The deepest fan-out of image files in subdirectories
+MAX_FANOUT = 4
+# Attempts at linking an image file into fan-out directories which may be
+# removed concurrently
+_LINK_ATTEMPTS = 3
+
+# Striped images are stored as the extents listed in a manifest named
+# after the image ID with this suffix
+_MANIFEST_SUFFIX = '.stripes'
+# Chunks of an extent queued between its reader or writer thread and the
+# thread streaming the image
+_STRIPE_QUEUE_DEPTH = 8
+# Threads flushing the files and directories of a batch of group commits
+_GROUP_COMMIT_THREADS = 16
+
+# Data read ahead of the position of sequential reads
+_READAHEAD = 8 * units.Mi
+# Data written or read between the hints dropping it from the page cache
+_DROP_BEHIND_INTERVAL = 32 * units.Mi
+# Buffer and alignment of O_DIRECT writes
+_DIRECT_IO_BUFFER_SIZE = 8 * units.Mi
+_DIRECT_IO_ALIGNMENT = 4096
+
+# The ioctl sharing the data of a file with another one, from linux/fs.h
+_FICLONE = 0x40049409
+# Errors of FICLONE and copy_file_range() meaning they can't be used
+# between two files
+_CLONE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                      errno.EOPNOTSUPP, errno.EXDEV)
 
 MULTI_FILESYSTEM_METADATA_SCHEMA = {
     "type": "array",
@@ -82,6 +241,355 @@ MULTI_FILESYSTEM_METADATA_SCHEMA = {
 }
 
 
+def image_path(datadir, image_id, fanout=0):
+    """
+    Return the path of an image file in a datadir, spread in `fanout`
+    levels of subdirectories named after the SHA-256 of the image ID.
+    """
+    image_id = str(image_id)
+    digest = hashlib.sha256(image_id.encode('utf-8')).hexdigest()
+    shards = [digest[level * 2:level * 2 + 2] for level in range(fanout)]
+    return os.path.join(datadir, *(shards + [image_id]))
+
+
+def _fdatasync(fd):
+    fdatasync = getattr(os, 'fdatasync', os.fsync)
+    fdatasync(fd)
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fdatasync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _fdatasync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fadvise(fd, offset, length, advice):
+    """Give the kernel a posix_fadvise() hint, where it is available."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError as e:
+        LOG.debug("posix_fadvise(%(advice)s) failed: %(e)s" %
+                  {'advice': advice, 'e': utils.exception_to_str(e)})
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            select.select([], [fd], [])
+    return len(data)
+
+
+def _clone_file(src_fd, dst_fd, size):
+    """
+    Copy size bytes of a file to an empty one without moving the data
+    through user space: reflink it with FICLONE or else have the kernel
+    copy it with copy_file_range().
+
+    :returns: True if the data was copied, False if neither is supported
+              between these files, in which case nothing was copied
+    :raises IOError: if fewer than size bytes could be copied, e.g. as the
+                     file was truncated
+    """
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno not in _CLONE_UNSUPPORTED:
+            raise
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        return False
+    copied = 0
+    while copied < size:
+        try:
+            count = copy_file_range(src_fd, dst_fd, size - copied,
+                                    copied, copied)
+        except OSError as e:
+            if copied == 0 and e.errno in _CLONE_UNSUPPORTED:
+                return False
+            raise
+        if not count:
+            break
+        copied += count
+    if copied != size:
+        raise IOError(errno.EIO, _("Copied %(copied)d bytes of %(size)d") %
+                      {'copied': copied, 'size': size})
+    return True
+
+
+class MountpointIndex(object):
+    """
+    Longest prefix lookup of the entry of the filesystem store metadata
+    whose mountpoint a path starts with.
+
+    The entries are indexed by mountpoint, and a lookup tries the prefixes
+    of the path of every distinct mountpoint length, longest first, so it
+    doesn't depend on the number of mountpoints. The entry of every image
+    path of a datadir is cached in `datadirs` once it is known.
+    """
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self._entries = {}
+        for image_meta in metadata:
+            self._entries.setdefault(image_meta['mountpoint'], image_meta)
+        self._lengths = sorted(set(len(mountpoint)
+                                   for mountpoint in self._entries),
+                               reverse=True)
+        self.datadirs = {}
+
+    def lookup(self, path):
+        """Return the entry of the mountpoint of path, or None."""
+        for length in self._lengths:
+            image_meta = self._entries.get(path[:length])
+            if image_meta is not None:
+                return image_meta
+        return None
+
+    def resolves(self, datadir):
+        """
+        Return True if all the paths in datadir have the same entry, which
+        they don't when a mountpoint is below the datadir.
+        """
+        return not any(len(mountpoint) > len(datadir) and
+                       mountpoint.startswith(datadir)
+                       for mountpoint in self._entries)
+
+
+class GroupCommitter(object):
+    """
+    Makes image files durable for concurrent uploads in batches.
+
+    A background thread takes all the commits requested since its last
+    batch, flushes the data of their files concurrently, renames them into
+    place, then flushes every directory whose entries changed once for the
+    batch. The uploads requesting commits while a batch is synced make the
+    next one.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = None
+
+    def commit(self, path, publish):
+        """
+        Flush the data of the file at path, call publish(), which renames
+        it into place and returns the directories to flush, and flush
+        them, along with the other commits of the batch.
+
+        :raises: the exception raised by publish() or by the flushes
+        """
+        request = {'path': path, 'publish': publish, 'error': None,
+                   'done': threading.Event()}
+        with self._cond:
+            self._pending.append(request)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, []
+            self._commit(batch)
+
+    @staticmethod
+    def _commit(batch):
+        # The files, then the directories, are flushed concurrently, so that
+        # the filesystem writes them back together rather than one by one
+        errors = _call_concurrently(_fdatasync_path,
+                                    [request['path'] for request in batch])
+        directories = {}
+        for request, error in zip(batch, errors):
+            if error is None:
+                try:
+                    for directory in request['publish']():
+                        directories.setdefault(directory, []).append(request)
+                except Exception as e:
+                    error = e
+            request['error'] = error
+        errors = _call_concurrently(_fsync_directory, list(directories))
+        for directory, error in zip(list(directories), errors):
+            if error is not None:
+                for request in directories[directory]:
+                    request['error'] = request['error'] or error
+        for request in batch:
+            request['done'].set()
+
+
+def _call_concurrently(func, args):
+    """
+    Call func with each of args, on up to _GROUP_COMMIT_THREADS threads,
+    and return the exception raised by each call, or None.
+
+    The calls go through utils.run_blocking(), as under eventlet the
+    threads are greenthreads which would otherwise flush one by one on
+    the hub.
+    """
+    errors = [None] * len(args)
+    indexes = iter(range(len(args)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            try:
+                utils.run_blocking(func, args[index])
+            except Exception as e:
+                errors[index] = e
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(len(args), _GROUP_COMMIT_THREADS) - 1)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    worker()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+_GROUP_COMMITTER = GroupCommitter()
+
+
+class CapacityTracker(object):
+    """
+    Keeps track of the space of the datadirs of a store.
+
+    The (free, total) space returned by `probe` for a datadir is cached
+    for `ttl` seconds. Once stale, it keeps being used while it is
+    refreshed in a background thread, so that uploads don't wait for
+    statvfs() on slow filesystems such as NFS. The space reserved for
+    the images being added is deducted from the free space. Releasing it
+    drops the cached space of the datadir, which is probed again when
+    next needed, since the space the image took isn't free anymore.
+    """
+
+    def __init__(self, probe, ttl=0):
+        self.probe = probe
+        self.ttl = ttl
+        # Held while picking a datadir and reserving space in it
+        self.lock = threading.RLock()
+        self._stats = {}
+        self._reserved = {}
+        # Datadir -> number of times its cached space was dropped, so that
+        # probes started before are discarded
+        self._generations = {}
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    def refresh(self, datadir):
+        """Probe the space of a datadir and return its (free, total)."""
+        generation = self._generations.get(datadir, 0)
+        free, total = self.probe(datadir)
+        with self._refreshing_lock:
+            if self._generations.get(datadir, 0) == generation:
+                self._stats[datadir] = (free, total, time.time())
+        return free, total
+
+    def invalidate(self, datadir):
+        """Drop the cached space of a datadir."""
+        with self._refreshing_lock:
+            self._generations[datadir] = self._generations.get(datadir,
+                                                               0) + 1
+            self._stats.pop(datadir, None)
+
+    def _get(self, datadir):
+        stats = self._stats.get(datadir)
+        if stats is None or self.ttl <= 0:
+            return self.refresh(datadir)
+        if time.time() - stats[2] > self.ttl:
+            self._refresh_in_background(datadir)
+        return stats[:2]
+
+    def _refresh_in_background(self, datadir):
+        with self._refreshing_lock:
+            if datadir in self._refreshing:
+                return
+            self._refreshing.add(datadir)
+
+        def refresh():
+            try:
+                self.refresh(datadir)
+            except Exception as e:
+                LOG.warn(_LW("Unable to refresh the free space of %(dir)s: "
+                             "%(e)s") % {'dir': datadir,
+                                         'e': utils.exception_to_str(e)})
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(datadir)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def free_space(self, datadir):
+        """Return the free space of a datadir, minus the space reserved."""
+        return self._get(datadir)[0] - self.reserved(datadir)
+
+    def reserved(self, datadir):
+        return self._reserved.get(datadir, 0)
+
+    def reserve(self, datadir, size):
+        with self.lock:
+            self._reserved[datadir] = self.reserved(datadir) + size
+
+    def release(self, datadir, size):
+        with self.lock:
+            reserved = self.reserved(datadir) - size
+            if reserved > 0:
+                self._reserved[datadir] = reserved
+            else:
+                self._reserved.pop(datadir, None)
+            self.invalidate(datadir)
+
+    def utilization(self, datadirs):
+        """
+        Return a dict of the total, free and reserved space of datadirs,
+        and of the fraction of their space used or reserved.
+        """
+        result = {}
+        for datadir in datadirs:
+            free, total = self._get(datadir)
+            reserved = self.reserved(datadir)
+            used = total - free + reserved
+            result[datadir] = {
+                'total': total,
+                'free': max(0, free - reserved),
+                'reserved': reserved,
+                'utilization': (min(1.0, float(used) / total) if total
+                                else 1.0)}
+        return result
+
+
 class StoreLocation(glance_store.location.StoreLocation):
     """Class describing a Filesystem URI."""
 
@@ -114,10 +622,22 @@ class ChunkedFile(object):
     """
     We send this back to the Glance API server as
     something that can iterate over a large file
+
+    It also advertises the file descriptor, offset and length of the data
+    with fileno(), `offset` and `length`, so that it can be sent without
+    copying it through Python, as sendfile() does.
+
+    With use_mmap, the file is memory mapped and the iterator returns
+    memoryviews of the mapping rather than copies of the data.
+
+    With sequential, the kernel is told the file is read sequentially and
+    the data ahead is read in advance. With drop_cache_size, the data read
+    is dropped from the page cache once more than that was read.
     """
 
     def __init__(self, filepath, offset=0, chunk_size=4096,
-                 partial_length=None):
+                 partial_length=None, use_mmap=False, sequential=False,
+                 drop_cache_size=None):
         self.filepath = filepath
         self.chunk_size = chunk_size
         self.partial_length = partial_length
@@ -125,6 +645,28 @@ class ChunkedFile(object):
         self.fp = open(self.filepath, 'rb')
         if offset:
             self.fp.seek(offset)
+        self.offset = offset
+        filesize = os.fstat(self.fp.fileno()).st_size
+        self.length = max(0, filesize - offset)
+        if self.partial:
+            self.length = min(self.length, partial_length)
+        self.use_mmap = use_mmap and filesize > 0
+        self._map = None
+        self._pos = offset
+        # Holes are looked for with a file descriptor of its own, so that
+        # the position of fp doesn't move under its buffer.
+        self._probe_fd = None
+        # The file holds a hole up to _data_start, then data up to _data_end
+        self._data_start = 0
+        self._data_end = 0 if hasattr(os, 'SEEK_DATA') else sys.maxsize
+        self._zeros = b''
+        self.sequential = sequential
+        self.drop_cache_size = drop_cache_size
+        self._readahead = offset
+        self._dropped = offset
+        if sequential:
+            _fadvise(self.fp.fileno(), offset, self.length,
+                     'POSIX_FADV_SEQUENTIAL')
 
     def __iter__(self):
         """Return an iterator over the image file."""
@@ -136,7 +678,7 @@ class ChunkedFile(object):
                     else:
                         size = self.chunk_size
 
-                    chunk = self.fp.read(size)
+                    chunk = self._read(size)
                     if chunk:
                         yield chunk
 
@@ -149,11 +691,425 @@ class ChunkedFile(object):
         finally:
             self.close()
 
+    def fileno(self):
+        """Return the file descriptor of the image file."""
+        return self.fp.fileno()
+
+    def sendfile(self, out):
+        """
+        Send the data to a socket or file descriptor with os.sendfile(),
+        without copying it through Python, then close the file. Where
+        sendfile() isn't available, the data is read and written instead.
+
+        :param out: a socket or any object with a fileno(), or a file
+                    descriptor
+        :returns: the number of bytes sent
+        """
+        out_fd = out if isinstance(out, int) else out.fileno()
+        sendfile = getattr(os, 'sendfile', None)
+        if sendfile is None:
+            sent = 0
+            for chunk in self:
+                sent += _write_all(out_fd, chunk)
+            return sent
+
+        try:
+            sent = 0
+            while sent < self.length:
+                try:
+                    count = sendfile(out_fd, self.fileno(),
+                                     self.offset + sent, self.length - sent)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    # Non blocking sockets, e.g. green ones
+                    select.select([], [out_fd], [])
+                    continue
+                if count == 0:
+                    # The file was truncated
+                    break
+                sent += count
+            return sent
+        finally:
+            self.close()
+
+    def _read(self, size):
+        self._advise(size)
+        if self.use_mmap:
+            return self._read_mmap(size)
+        hole = self._hole_length()
+        if hole:
+            # Holes read as zeros, there is no need to read them
+            if len(self._zeros) != min(size, hole):
+                self._zeros = b'\0' * min(size, hole)
+            chunk = self._zeros
+            self.fp.seek(len(chunk), os.SEEK_CUR)
+        else:
+            chunk = self.fp.read(size)
+        self._pos += len(chunk)
+        return chunk
+
+    def _advise(self, size):
+        if self.sequential and self._pos + size > self._readahead:
+            end = self.offset + self.length
+            length = min(_READAHEAD, end - self._readahead)
+            if length > 0:
+                _fadvise(self.fp.fileno(), self._readahead, length,
+                         'POSIX_FADV_WILLNEED')
+            self._readahead += _READAHEAD
+        if (self.drop_cache_size is not None and
+                self._pos - self.offset > self.drop_cache_size and
+                self._pos - self._dropped >= _DROP_BEHIND_INTERVAL):
+            self._drop_cache()
+
+    def _drop_cache(self):
+        _fadvise(self.fp.fileno(), self._dropped, self._pos - self._dropped,
+                 'POSIX_FADV_DONTNEED')
+        self._dropped = self._pos
+
+    def _read_mmap(self, size):
+        if self._map is None:
+            self._map = memoryview(mmap.mmap(self.fp.fileno(), 0,
+                                             access=mmap.ACCESS_READ))
+        chunk = self._map[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+
+    def _hole_length(self):
+        """
+        Return the length of the hole at the current position in the file,
+        or 0 if there is data, using SEEK_DATA and SEEK_HOLE.
+        """
+        if self._pos < self._data_start:
+            return self._data_start - self._pos
+        if self._pos < self._data_end:
+            return 0
+        try:
+            if self._probe_fd is None:
+                self._probe_fd = os.open(self.filepath, os.O_RDONLY)
+            data = os.lseek(self._probe_fd, self._pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                # Holes aren't supported, read everything
+                self._data_end = sys.maxsize
+                return 0
+            # There is no data past this position
+            data = max(os.fstat(self._probe_fd).st_size, self._pos)
+            self._data_start = self._data_end = data
+            return data - self._pos
+        self._data_start = data
+        self._data_end = os.lseek(self._probe_fd, data, os.SEEK_HOLE)
+        return data - self._pos
+
     def close(self):
         """Close the internal file pointer"""
         if self.fp:
+            if (self.drop_cache_size is not None and
+                    self._pos - self.offset > self.drop_cache_size):
+                self._drop_cache()
             self.fp.close()
             self.fp = None
+        if self._probe_fd is not None:
+            os.close(self._probe_fd)
+            self._probe_fd = None
+        if self._map is not None:
+            mapping = self._map.obj
+            self._map.release()
+            try:
+                mapping.close()
+            except BufferError:
+                # Views of it are still in use, it is unmapped once they
+                # are all released
+                pass
+            self._map = None
+
+
+def _pread_into(fd, buf, length, offset):
+    """
+    Read up to length bytes of a file at offset into a buffer.
+
+    :returns: the number of bytes read, less than length at end of file
+    """
+    view = memoryview(buf)
+    done = 0
+    while done < length:
+        if hasattr(os, 'preadv'):
+            count = os.preadv(fd, [view[done:length]], offset + done)
+        else:
+            data = os.pread(fd, length - done, offset + done)
+            count = len(data)
+            view[done:done + count] = data
+        if not count:
+            break
+        done += count
+    return done
+
+
+class ParallelChunkedFile(ChunkedFile):
+    """
+    ChunkedFile reading the file with several threads. Each thread reads
+    chunks at their offset with pread(), into a ring of buffers allocated
+    up front, while the iterator returns the chunks already read in order.
+    The reads are made in eventlet's pool of native threads when threading
+    is monkey patched, since the threads are green threads then.
+
+    The chunks are returned as copies of the buffers, which are reused for
+    the chunks after, so that they stay valid once the next ones are taken.
+    """
+
+    def __init__(self, filepath, offset=0, chunk_size=4096,
+                 partial_length=None, threads=4, **kwargs):
+        super(ParallelChunkedFile, self).__init__(
+            filepath, offset=offset, chunk_size=chunk_size,
+            partial_length=partial_length, **kwargs)
+        self.threads = max(1, threads)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._consumed = 0
+        self._ring = []
+        self._results = []
+
+    def __iter__(self):
+        count = -(-self.length // self.chunk_size)
+        self._ring = [bytearray(self.chunk_size)
+                      for _i in range(min(count, 2 * self.threads))]
+        self._results = [None] * len(self._ring)
+        readers = []
+        try:
+            for first in range(min(count, self.threads)):
+                reader = threading.Thread(target=self._read_chunks,
+                                          args=(first, count))
+                reader.daemon = True
+                reader.start()
+                readers.append(reader)
+
+            for index in range(count):
+                slot = index % len(self._ring)
+                with self._cond:
+                    while (self._results[slot] is None or
+                           self._results[slot][0] != index):
+                        self._cond.wait()
+                    result = self._results[slot][1]
+                if isinstance(result, Exception):
+                    raise result
+                chunk = bytes(memoryview(self._ring[slot])[:result])
+                self._pos += result
+                # The buffer can be read into again now that it is copied
+                with self._cond:
+                    self._consumed = index + 1
+                    self._cond.notify_all()
+                if chunk:
+                    yield chunk
+                if result < self.chunk_size:
+                    break
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            for reader in readers:
+                reader.join()
+            self.close()
+
+    def _read_chunks(self, first, count):
+        """Read every `threads` chunk of the file from the first one."""
+        fd = self.fp.fileno()
+        end = self.offset + self.length
+        for index in range(first, count, self.threads):
+            slot = index % len(self._ring)
+            with self._cond:
+                # Wait for the chunk using the buffer before to be taken
+                while (not self._stopped and
+                       index >= self._consumed + len(self._ring)):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            start = self.offset + index * self.chunk_size
+            try:
+                result = utils.run_blocking(
+                    _pread_into, fd, self._ring[slot],
+                    min(self.chunk_size, end - start), start)
+            except Exception as e:
+                result = e
+            with self._cond:
+                self._results[slot] = (index, result)
+                self._cond.notify_all()
+            if isinstance(result, Exception):
+                return
+
+
+class _ExtentReader(object):
+    """
+    Reads a range of an extent into a queue, in a thread of its own.
+
+    The chunks are read through utils.run_blocking(), as under eventlet
+    the thread is a greenthread which would otherwise read on the hub.
+    """
+
+    _END = object()
+
+    def __init__(self, path, offset, length, chunk_size):
+        self.queue = queue.Queue(maxsize=_STRIPE_QUEUE_DEPTH)
+        self.stopped = False
+        thread = threading.Thread(target=self._read,
+                                  args=(path, offset, length, chunk_size))
+        thread.daemon = True
+        thread.start()
+
+    def _read(self, path, offset, length, chunk_size):
+        try:
+            chunks = iter(ChunkedFile(path, offset=offset,
+                                      chunk_size=chunk_size,
+                                      partial_length=length))
+            while True:
+                chunk = utils.run_blocking(next, chunks, None)
+                if chunk is None:
+                    break
+                if not self._put(chunk):
+                    chunks.close()
+                    return
+            self._put(self._END)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def stop(self):
+        self.stopped = True
+
+
+class StripedFile(object):
+    """
+    Iterates over an image striped in extents of stripe_size bytes, read
+    ahead `readahead` extents at a time in parallel.
+    """
+
+    def __init__(self, extents, stripe_size, size, offset=0,
+                 chunk_size=4096, partial_length=None, readahead=2,
+                 resolve=None):
+        self.extents = extents
+        self.stripe_size = stripe_size
+        self.size = size
+        self.offset = offset
+        self.chunk_size = chunk_size
+        end = size if partial_length is None else offset + partial_length
+        self.end = min(end, size)
+        self.readahead = max(1, readahead)
+        self.resolve = resolve
+
+    def _ranges(self):
+        """Yield the path, offset and length of the extents to read."""
+        position = self.offset
+        while position < self.end:
+            index = position // self.stripe_size
+            start = position - index * self.stripe_size
+            length = min(self.stripe_size - start, self.end - position)
+            path = self.extents[index]
+            if self.resolve is not None:
+                path = self.resolve(path) or path
+            yield path, start, length
+            position += length
+
+    def __iter__(self):
+        ranges = self._ranges()
+        readers = []
+        try:
+            while True:
+                while len(readers) < self.readahead:
+                    extent = next(ranges, None)
+                    if extent is None:
+                        break
+                    readers.append(_ExtentReader(*(extent +
+                                                   (self.chunk_size,))))
+                if not readers:
+                    return
+                for chunk in readers[0]:
+                    yield chunk
+                readers.pop(0)
+        finally:
+            for reader in readers:
+                reader.stop()
+
+
+class _ExtentWriter(object):
+    """
+    Writes the extents of a striped image to a datadir, in a thread of its
+    own. Each extent is queued as its path, its chunks of data, then an
+    empty chunk. Store._write() makes the writes and flushes through
+    utils.run_blocking(), so that they don't block the hub under eventlet.
+    """
+
+    _STOP = object()
+
+    def __init__(self, store, datadir, durability):
+        self.store = store
+        self.datadir = datadir
+        self.durability = durability
+        self.queue = queue.Queue(maxsize=_STRIPE_QUEUE_DEPTH)
+        self.error = None
+        self.stopped = False
+        self._in_extent = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _next(self):
+        item = self.queue.get()
+        if item is self._STOP:
+            self.stopped = True
+            item = b''
+        if not item:
+            self._in_extent = False
+        return item
+
+    def read(self, size=None):
+        chunk = self._next()
+        if self.stopped:
+            raise exceptions.BackendException(
+                _("The write of extent %s was stopped") % self.datadir)
+        return chunk
+
+    def _run(self):
+        while not self.stopped:
+            path = self._next()
+            if self.stopped:
+                return
+            self._in_extent = True
+            if self.error is None:
+                temppath = os.path.join(self.datadir, '%s%s.%s' % (
+                    _TEMP_PREFIX, os.path.basename(path),
+                    uuid.uuid4().hex[:8]))
+                try:
+                    self.store._write(temppath, self, 0, None,
+                                      self.durability == DURABILITY_FDATASYNC)
+                    self.store._set_file_permission(temppath, path)
+                    self.store._commit(temppath, path, self.durability)
+                except Exception as e:
+                    if not self.stopped:
+                        self.error = e
+                    self.store._delete_partial(temppath, path)
+            # Skip the data of an extent which failed to be written
+            while self._in_extent:
+                self._next()
+
+    def stop(self):
+        self.queue.put(self._STOP)
+        self.thread.join()
 
 
 class Store(glance_store.driver.Store):
@@ -165,6 +1121,14 @@ class Store(glance_store.driver.Store):
     READ_CHUNKSIZE = 64 * units.Ki
     WRITE_CHUNKSIZE = READ_CHUNKSIZE
     FILESYSTEM_STORE_METADATA = None
+    _mountpoint_index = None
+
+    def __init__(self, *args, **kwargs):
+        self._capacity = CapacityTracker(
+            lambda datadir: self._probe_capacity(datadir))
+        # The space of the datadirs, as of the last update_capabilities()
+        self.capacity = {}
+        super(Store, self).__init__(*args, **kwargs)
 
     def get_schemes(self):
         return ('file', 'filesystem')
@@ -269,6 +1233,7 @@ class Store(glance_store.driver.Store):
             jsonschema.validate(metadata, MULTI_FILESYSTEM_METADATA_SCHEMA)
             glance_store.check_location_metadata(metadata)
             self.FILESYSTEM_STORE_METADATA = metadata
+            self._mountpoint_index = MountpointIndex(metadata)
         except (jsonschema.exceptions.ValidationError,
                 exceptions.BackendException, ValueError) as vee:
             reason = _('The JSON in the metadata file %(file)s is '
@@ -346,11 +1311,44 @@ class Store(glance_store.driver.Store):
                                         reverse=True)
 
         self._create_image_directories(directory_paths)
+        self._remove_stale_temp_files(directory_paths)
+        self._capacity.ttl = (
+            self.conf.glance_store.filesystem_store_capacity_cache_ttl)
 
         metadata_file = self.conf.glance_store.filesystem_store_metadata_file
         if metadata_file:
             self._validate_metadata(metadata_file)
 
+    def _remove_stale_temp_files(self, directory_paths):
+        """
+        Remove the temporary files left over by writes interrupted by a
+        crash. Files still being written by other processes sharing the
+        directories are recent, and left alone.
+
+        :directory_paths is a list of directories belonging to glance store.
+        """
+        max_age = self.conf.glance_store.filesystem_store_temp_file_max_age
+        cutoff = time.time() - max_age
+        for datadir in directory_paths:
+            try:
+                names = os.listdir(datadir)
+            except OSError:
+                continue
+            for name in names:
+                if not name.startswith(_TEMP_PREFIX):
+                    continue
+                path = os.path.join(datadir, name)
+                try:
+                    if os.lstat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        LOG.info(_("Removed stale temporary file %s") % path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        LOG.warn(_LW("Unable to remove stale temporary "
+                                     "file %(path)s: %(e)s") %
+                                 dict(path=path,
+                                      e=utils.exception_to_str(e)))
+
     def _check_directory_paths(self, datadir_path, directory_paths,
                                priority_paths):
         """
@@ -407,17 +1405,46 @@ class Store(glance_store.driver.Store):
 
         return datadir_path, priority
 
-    @staticmethod
-    def _resolve_location(location):
-        filepath = location.store_location.path
-
-        if not os.path.exists(filepath):
-            raise exceptions.NotFound(image=filepath)
+    def _datadirs(self):
+        if getattr(self, 'multiple_datadirs', False):
+            return [datadir for datadirs in self.priority_data_map.values()
+                    for datadir in datadirs]
+        datadir = getattr(self, 'datadir', None)
+        return [datadir] if datadir else []
 
+    def _find_image_file(self, filepath):
+        """
+        Return the path the image file of the given path is at, which is
+        another level of fan-out of the same datadir when the layout was
+        changed since it was added, or None if there is no such file.
+        """
+        if os.path.exists(filepath):
+            return filepath
+        filepath = os.path.normpath(filepath)
+        image_id = os.path.basename(filepath)
+        for datadir in self._datadirs():
+            datadir = os.path.normpath(datadir)
+            paths = [image_path(datadir, image_id, fanout)
+                     for fanout in range(MAX_FANOUT + 1)]
+            if filepath not in paths:
+                continue
+            for path in paths:
+                if path != filepath and os.path.exists(path):
+                    return path
+        return None
+
+    def _resolve_location(self, location):
+        filepath = self._find_image_file(location.store_location.path)
+
+        if filepath is None:
+            raise exceptions.NotFound(image=location.store_location.path)
+
+        if filepath.endswith(_MANIFEST_SUFFIX):
+            return filepath, self._read_manifest(filepath)[2]
         filesize = os.path.getsize(filepath)
         return filepath, filesize
 
-    def _get_metadata(self, filepath):
+    def _get_metadata(self, filepath, datadir=None):
         """Return metadata dictionary.
 
         If metadata is provided as list of dictionaries then return
@@ -431,26 +1458,37 @@ class Store(glance_store.driver.Store):
         in glance image metadata. So if there are multiple mountpoints then
         we will return dict containing exact mountpoint where image is stored.
 
-        If image path does not start with any of the 'mountpoint' provided
-        in metadata JSON file then error is logged and empty
-        dictionary is returned.
+        The dict of the longest mountpoint the image path starts with is
+        returned. If image path does not start with any of the 'mountpoint'
+        provided in metadata JSON file then error is logged, once per
+        datadir, and empty dictionary is returned.
 
         :param filepath: Path of image on store
+        :param datadir: The datadir of the image, whose metadata is cached
         :returns: metadata dictionary
         """
-        if self.FILESYSTEM_STORE_METADATA:
-            for image_meta in self.FILESYSTEM_STORE_METADATA:
-                if filepath.startswith(image_meta['mountpoint']):
-                    return image_meta
-
-            reason = (_LE("The image path %(path)s does not match with "
-                          "any of the mountpoint defined in "
-                          "metadata: %(metadata)s. An empty dictionary "
-                          "will be returned to the client.")
-                      % dict(path=filepath,
-                             metadata=self.FILESYSTEM_STORE_METADATA))
-            LOG.error(reason)
-
+        metadata = self.FILESYSTEM_STORE_METADATA
+        if not metadata:
+            return {}
+
+        index = self._mountpoint_index
+        if index is None or index.metadata is not metadata:
+            index = self._mountpoint_index = MountpointIndex(metadata)
+        if datadir in index.datadirs:
+            return index.datadirs[datadir] or {}
+
+        image_meta = index.lookup(filepath)
+        if datadir is not None and index.resolves(datadir):
+            index.datadirs[datadir] = image_meta
+        if image_meta is not None:
+            return image_meta
+
+        reason = (_LE("The image path %(path)s does not match with "
+                      "any of the mountpoint defined in "
+                      "metadata: %(metadata)s. An empty dictionary "
+                      "will be returned to the client.")
+                  % dict(path=filepath, metadata=metadata))
+        LOG.error(reason)
         return {}
 
     @capabilities.check
@@ -467,10 +1505,41 @@ class Store(glance_store.driver.Store):
         filepath, filesize = self._resolve_location(location)
         msg = _("Found image at %s. Returning in ChunkedFile.") % filepath
         LOG.debug(msg)
+        glance_conf = self.conf.glance_store
+        length = max(0, filesize - offset)
+        if chunk_size is not None:
+            length = min(length, chunk_size)
+        if (glance_conf.filesystem_store_read_threads > 1 and
+                not glance_conf.filesystem_store_mmap_reads and
+                not filepath.endswith(_MANIFEST_SUFFIX) and
+                length >= (glance_conf.filesystem_store_parallel_read_size *
+                           units.Mi)):
+            return (ParallelChunkedFile(
+                filepath,
+                offset=offset,
+                chunk_size=self.READ_CHUNKSIZE,
+                partial_length=chunk_size,
+                threads=glance_conf.filesystem_store_read_threads,
+                sequential=glance_conf.filesystem_store_fadvise,
+                drop_cache_size=self._drop_cache_size()),
+                chunk_size or filesize)
+        if filepath.endswith(_MANIFEST_SUFFIX):
+            extents, stripe_size, size = self._read_manifest(filepath)
+            readahead = glance_conf.filesystem_store_stripe_width
+            return (StripedFile(extents, stripe_size, size,
+                                offset=offset,
+                                chunk_size=self.READ_CHUNKSIZE,
+                                partial_length=chunk_size,
+                                readahead=readahead,
+                                resolve=self._find_image_file),
+                    chunk_size or filesize)
         return (ChunkedFile(filepath,
                             offset=offset,
                             chunk_size=self.READ_CHUNKSIZE,
-                            partial_length=chunk_size),
+                            partial_length=chunk_size,
+                            use_mmap=glance_conf.filesystem_store_mmap_reads,
+                            sequential=glance_conf.filesystem_store_fadvise,
+                            drop_cache_size=self._drop_cache_size()),
                 chunk_size or filesize)
 
     def get_size(self, location, context=None):
@@ -501,8 +1570,10 @@ class Store(glance_store.driver.Store):
         :raises Forbidden if cannot delete because of permissions
         """
         loc = location.store_location
-        fn = loc.path
-        if os.path.exists(fn):
+        fn = self._find_image_file(loc.path)
+        if fn is not None:
+            if fn.endswith(_MANIFEST_SUFFIX):
+                self._delete_extents(self._read_manifest(fn)[0])
             try:
                 LOG.debug(_("Deleting image at %(fn)s"), {'fn': fn})
                 os.unlink(fn)
@@ -510,7 +1581,7 @@ class Store(glance_store.driver.Store):
                 raise exceptions.Forbidden(
                     message=(_("You cannot delete file %s") % fn))
         else:
-            raise exceptions.NotFound(image=fn)
+            raise exceptions.NotFound(image=loc.path)
 
     def _get_capacity_info(self, mount_point):
         """Calculates total available space for given mount point.
@@ -523,26 +1594,60 @@ class Store(glance_store.driver.Store):
         total_available_space = stvfs_result.f_bavail * stvfs_result.f_bsize
         return max(0, total_available_space)
 
+    def _get_total_capacity(self, mount_point):
+        """Calculates the total size of given mount point."""
+        stvfs_result = os.statvfs(mount_point)
+        return stvfs_result.f_blocks * stvfs_result.f_frsize
+
+    def _probe_capacity(self, datadir):
+        return (self._get_capacity_info(datadir),
+                self._get_total_capacity(datadir))
+
+    def update_capabilities(self):
+        """
+        Refresh the space of the datadirs, and expose it as `capacity`, a
+        dict of the total, free and reserved space of each datadir, and of
+        the fraction of its space used or reserved.
+        """
+        try:
+            datadirs = self._datadirs()
+            for datadir in datadirs:
+                self._capacity.refresh(datadir)
+            self.capacity = self._capacity.utilization(datadirs)
+        except Exception as e:
+            LOG.warn(_LW("Unable to update the space of the datadirs: %s") %
+                     utils.exception_to_str(e))
+
     def _find_best_datadir(self, image_size):
         """Finds the best datadir by priority and free space.
 
         Traverse directories returning the first one that has sufficient
         free space, in priority order. If two suitable directories have
         the same priority, choose the one with the most free space
-        available.
+        available. The free space is cached by the capacity tracker, and
+        the space of the images being added is deducted from it:
+        image_size is reserved in the datadir returned until
+        _release_space() is called, so that concurrent uploads don't all
+        pick the same datadir.
         :image_size size of image being uploaded.
         :returns best_datadir as directory path of the best priority datadir.
         :raises exceptions.StorageFull if there is no datadir in
                 self.priority_data_map that can accommodate the image.
         """
-        if not self.multiple_datadirs:
-            return self.datadir
+        with self._capacity.lock:
+            if not self.multiple_datadirs:
+                best_datadir = self.datadir
+            else:
+                best_datadir = self._find_free_datadir(image_size)
+            self._capacity.reserve(best_datadir, image_size)
+        return best_datadir
 
+    def _find_free_datadir(self, image_size):
         best_datadir = None
         max_free_space = 0
         for priority in self.priority_list:
             for datadir in self.priority_data_map.get(priority):
-                free_space = self._get_capacity_info(datadir)
+                free_space = self._capacity.free_space(datadir)
                 if free_space >= image_size and free_space > max_free_space:
                     max_free_space = free_space
                     best_datadir = datadir
@@ -560,6 +1665,10 @@ class Store(glance_store.driver.Store):
 
         return best_datadir
 
+    def _release_space(self, datadir, image_size):
+        """Release the space reserved by _find_best_datadir()."""
+        self._capacity.release(datadir, image_size)
+
     @capabilities.check
     def add(self, image_id, image_file, image_size, context=None):
         """
@@ -579,37 +1688,77 @@ class Store(glance_store.driver.Store):
         :note By default, the backend writes the image data to a file
               `/<DATADIR>/<ID>`, where <DATADIR> is the value of
               the filesystem_store_datadir configuration option and <ID>
-              is the supplied image ID.
+              is the supplied image ID, or in subdirectories of <DATADIR>
+              according to filesystem_store_fanout. The data is written
+              to a temporary file in <DATADIR> first, which is renamed
+              once complete, so that a partially written image file is
+              never found at its path.
         """
 
-        datadir = self._find_best_datadir(image_size)
-        filepath = os.path.join(datadir, str(image_id))
-
-        if os.path.exists(filepath):
-            raise exceptions.Duplicate(image=filepath)
-
-        checksum = hashlib.md5()
-        bytes_written = 0
+        checksum = utils.Checksum(self.conf)
+        fanout = self.conf.glance_store.filesystem_store_fanout
+        striping = self._find_stripe_datadirs(image_size)
+        if striping is not None:
+            datadirs, share = striping
+            datadir = datadirs[0]
+            reservations = [(d, share) for d in datadirs]
+            filepath = image_path(datadir, image_id + _MANIFEST_SUFFIX,
+                                  fanout)
+        else:
+            datadir = self._find_best_datadir(image_size)
+            reservations = [(datadir, image_size)]
+            filepath = image_path(datadir, image_id, fanout)
+
+        existing = self._find_existing_image(datadir, image_id)
+        if existing is not None:
+            for reserved_datadir, size in reservations:
+                self._release_space(reserved_datadir, size)
+            raise exceptions.Duplicate(image=existing)
+
+        temppath = os.path.join(datadir, '%s%s.%s' % (_TEMP_PREFIX, image_id,
+                                                      uuid.uuid4().hex[:8]))
+        durability = self.conf.glance_store.filesystem_store_durability
+        sync = durability == DURABILITY_FDATASYNC
+        direct_io_size = self.conf.glance_store.filesystem_store_direct_io_size
         try:
-            with open(filepath, 'wb') as f:
-                for buf in utils.chunkreadable(image_file,
-                                               self.WRITE_CHUNKSIZE):
-                    bytes_written += len(buf)
-                    checksum.update(buf)
-                    f.write(buf)
-        except IOError as e:
+            bytes_written = None
+            if striping is not None:
+                bytes_written = self._write_striped(temppath, image_id,
+                                                    image_file, checksum,
+                                                    striping[0], durability)
+            elif direct_io_size and image_size >= direct_io_size * units.Mi:
+                bytes_written = self._write_direct(temppath, image_file,
+                                                   image_size, checksum, sync)
+            if bytes_written is None:
+                bytes_written = self._write(temppath, image_file, image_size,
+                                            checksum, sync)
+        except (IOError, OSError) as e:
             if e.errno != errno.EACCES:
-                self._delete_partial(filepath, image_id)
-            errors = {errno.EFBIG: exceptions.StorageFull(),
-                      errno.ENOSPC: exceptions.StorageFull(),
-                      errno.EACCES: exceptions.StorageWriteDenied()}
-            raise errors.get(e.errno, e)
+                self._delete_partial(temppath, image_id)
+            raise self._write_error(e)
         except Exception:
             with excutils.save_and_reraise_exception():
-                self._delete_partial(filepath, image_id)
+                self._delete_partial(temppath, image_id)
+        finally:
+            # The space taken by the file is accounted by the filesystem now
+            for reserved_datadir, size in reservations:
+                self._release_space(reserved_datadir, size)
 
         checksum_hex = checksum.hexdigest()
-        metadata = self._get_metadata(filepath)
+
+        self._set_file_permission(temppath, filepath)
+
+        try:
+            self._commit(temppath, filepath, durability)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._delete_partial(temppath, image_id)
+                if striping is not None:
+                    self._delete_extents(
+                        self._read_manifest(temppath)[0])
+
+        metadata = dict(self._get_metadata(filepath, datadir),
+                        **checksum.metadata())
 
         LOG.debug(_("Wrote %(bytes_written)d bytes to %(filepath)s with "
                     "checksum %(checksum_hex)s"),
@@ -617,17 +1766,460 @@ class Store(glance_store.driver.Store):
                    'filepath': filepath,
                    'checksum_hex': checksum_hex})
 
+        return ('file://%s' % filepath, bytes_written, checksum_hex, metadata)
+
+    def clone(self, location, image_id, context=None):
+        """
+        Copy the image file at a location of this store to another image
+        of it, with a reflink or in the kernel, without reading the data.
+
+        :param location: The `glance_store.location.Location` of the image
+                         to copy
+        :param image_id: The ID of the image to copy it to
+        :retval tuple of URL in backing store, bytes copied, None as the
+               checksum, which isn't computed, and a dictionary with
+               storage system specific information, or None if the image
+               file can't be cloned within its filesystem, in which case
+               it is to be streamed
+        :raises `glance_store.exceptions.Duplicate` if the image already
+                existed
+        """
+        if not (self.conf.glance_store.filesystem_store_fast_clone and
+                self.is_capable(capabilities.BitMasks.WRITE_ACCESS)):
+            return None
+        srcpath, size = self._resolve_location(location)
+        datadir = self._clone_datadir(srcpath)
+        if datadir is None or srcpath.endswith(_MANIFEST_SUFFIX):
+            return None
+
+        existing = self._find_existing_image(datadir, image_id)
+        if existing is not None:
+            raise exceptions.Duplicate(image=existing)
+
+        filepath = image_path(datadir, image_id,
+                              self.conf.glance_store.filesystem_store_fanout)
+        temppath = os.path.join(datadir, '%s%s.%s' % (_TEMP_PREFIX, image_id,
+                                                      uuid.uuid4().hex[:8]))
+        durability = self.conf.glance_store.filesystem_store_durability
+        sync = durability == DURABILITY_FDATASYNC
+        self._capacity.reserve(datadir, size)
+        try:
+            with open(srcpath, 'rb') as src:
+                with open(temppath, 'wb') as dst:
+                    cloned = _clone_file(src.fileno(), dst.fileno(), size)
+                    if cloned and sync:
+                        _fdatasync(dst.fileno())
+        except (IOError, OSError) as e:
+            if e.errno != errno.EACCES:
+                self._delete_partial(temppath, image_id)
+            raise self._write_error(e)
+        finally:
+            self._release_space(datadir, size)
+
+        if not cloned:
+            LOG.debug("Unable to clone %(src)s within its filesystem" %
+                      {'src': srcpath})
+            self._delete_partial(temppath, image_id)
+            return None
+
+        self._set_file_permission(temppath, filepath)
+        try:
+            self._commit(temppath, filepath, durability)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._delete_partial(temppath, image_id)
+
+        LOG.debug(_("Cloned %(src)s to %(filepath)s"),
+                  {'src': srcpath, 'filepath': filepath})
+        return ('file://%s' % filepath, size, None,
+                self._get_metadata(filepath, datadir))
+
+    def _clone_datadir(self, srcpath):
+        """
+        Return the datadir to clone an image file to, which is on the same
+        filesystem, preferably the datadir of the image file, or None if
+        there is none.
+        """
+        src_dev = os.stat(srcpath).st_dev
+        datadirs = self._datadirs()
+        owners = [datadir for datadir in datadirs
+                  if srcpath.startswith(os.path.join(datadir, ''))]
+        for datadir in owners + datadirs:
+            if os.stat(datadir).st_dev == src_dev:
+                return datadir
+        return None
+
+    def _find_existing_image(self, datadir, image_id):
+        """
+        Return the path of the image file or striped image manifest of an
+        image in a datadir, in any layout, or None if there is none.
+        """
+        fanout = self.conf.glance_store.filesystem_store_fanout
+        for path in (image_path(datadir, image_id, fanout),
+                     image_path(datadir, image_id + _MANIFEST_SUFFIX, fanout)):
+            existing = self._find_image_file(path)
+            if existing is not None:
+                return existing
+        return None
+
+    @staticmethod
+    def _write_error(e):
+        """Return the exception to raise for an error writing an image."""
+        errors = {errno.EFBIG: exceptions.StorageFull(),
+                  errno.ENOSPC: exceptions.StorageFull(),
+                  errno.EACCES: exceptions.StorageWriteDenied()}
+        return errors.get(e.errno, e)
+
+    def _drop_cache_size(self):
+        """
+        Return the size above which image files are dropped from the page
+        cache, or None if they aren't.
+        """
+        if not self.conf.glance_store.filesystem_store_fadvise:
+            return None
+        glance_conf = self.conf.glance_store
+        return glance_conf.filesystem_store_drop_cache_size * units.Mi
+
+    def _create_fanout_directories(self, datadir, directory):
+        """
+        Create the subdirectories of datadir leading to directory.
+
+        :returns: the directories created
+        """
+        missing = []
+        created = []
+        while directory != datadir and not os.path.isdir(directory):
+            missing.append(directory)
+            directory = os.path.dirname(directory)
+        for directory in reversed(missing):
+            try:
+                os.mkdir(directory)
+            except OSError as e:
+                # Another upload may have created it
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                self._set_exec_permission(directory)
+                created.append(directory)
+        return created
+
+    def _preallocate(self, fd, image_size):
+        """
+        Allocate the space of an image file of a known size, if enabled.
+
+        :raises: OSError with ENOSPC if there isn't enough space left
+        """
+        if not (image_size > 0 and hasattr(os, 'posix_fallocate') and
+                self.conf.glance_store.filesystem_store_preallocate):
+            return
+        try:
+            os.posix_fallocate(fd, 0, image_size)
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.EFBIG):
+                raise
+            LOG.debug("Unable to preallocate %(size)d bytes: %(e)s" %
+                      {'size': image_size, 'e': utils.exception_to_str(e)})
+
+    def _write(self, temppath, image_file, image_size, checksum, sync):
+        """Write image data to a file through the page cache."""
+        drop_cache_size = self._drop_cache_size()
+        bytes_written = 0
+        # Dropping data from the page cache starts writing it back when it
+        # is dirty, so it is dropped again an interval later, once clean.
+        dropped = behind = 0
+        with open(temppath, 'wb') as f:
+            self._preallocate(f.fileno(), image_size)
+            for buf in utils.chunkreadable(image_file, self.WRITE_CHUNKSIZE):
+                if checksum is not None:
+                    checksum.update(buf)
+                utils.run_blocking(self._write_sparse, f, bytes_written, buf)
+                bytes_written += len(buf)
+                if (drop_cache_size is not None and
+                        bytes_written > drop_cache_size and
+                        bytes_written - dropped >= _DROP_BEHIND_INTERVAL):
+                    f.flush()
+                    _fadvise(f.fileno(), behind, bytes_written - behind,
+                             'POSIX_FADV_DONTNEED')
+                    behind, dropped = dropped, bytes_written
+            # The file may end with a hole
+            f.truncate(bytes_written)
+            if sync:
+                f.flush()
+                utils.run_blocking(_fdatasync, f.fileno())
+            if drop_cache_size is not None and bytes_written > drop_cache_size:
+                f.flush()
+                _fadvise(f.fileno(), behind, bytes_written - behind,
+                         'POSIX_FADV_DONTNEED')
+        return bytes_written
+
+    def _write_direct(self, temppath, image_file, image_size, checksum,
+                      sync):
+        """
+        Write image data to a file with O_DIRECT, bypassing the page cache,
+        through an aligned buffer.
+
+        :returns: the number of bytes written, or None if O_DIRECT isn't
+                  supported, in which case nothing was written
+        """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        try:
+            fd = os.open(temppath, flags | os.O_DIRECT, 0o666)
+        except AttributeError:
+            return None
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            LOG.warn(_LW("O_DIRECT is not supported by the filesystem of "
+                         "%s, writing through the page cache") % temppath)
+            return None
+
+        # Anonymous mappings are page aligned
+        buf = mmap.mmap(-1, _DIRECT_IO_BUFFER_SIZE)
+        view = memoryview(buf)
+        bytes_written = 0
+        flushed = filled = 0
+        try:
+            self._preallocate(fd, image_size)
+            for chunk in utils.chunkreadable(image_file, self.WRITE_CHUNKSIZE):
+                checksum.update(chunk)
+                bytes_written += len(chunk)
+                chunk = memoryview(chunk)
+                while chunk:
+                    length = min(len(chunk), _DIRECT_IO_BUFFER_SIZE - filled)
+                    view[filled:filled + length] = chunk[:length]
+                    chunk = chunk[length:]
+                    filled += length
+                    if filled == _DIRECT_IO_BUFFER_SIZE:
+                        self._write_aligned(fd, view, flushed)
+                        flushed += filled
+                        filled = 0
+            if filled:
+                # The last block is padded with zeros, then truncated
+                padded = (-(-filled // _DIRECT_IO_ALIGNMENT) *
+                          _DIRECT_IO_ALIGNMENT)
+                view[filled:padded] = b'\0' * (padded - filled)
+                self._write_aligned(fd, view[:padded], flushed)
+            os.ftruncate(fd, bytes_written)
+            if sync:
+                _fdatasync(fd)
+        finally:
+            view.release()
+            buf.close()
+            os.close(fd)
+        return bytes_written
+
+    @staticmethod
+    def _write_aligned(fd, data, offset):
+        """
+        Write aligned data at an aligned offset of a file, leaving its
+        blocks of zeros as holes.
+        """
+        for start, length in utils.data_extents(data):
+            os.lseek(fd, offset + start, os.SEEK_SET)
+            while length:
+                written = os.write(fd, data[start:start + length])
+                start += written
+                length -= written
+
+    def _rename_into_place(self, temppath, filepath, sync=False):
+        """
+        Give a complete temporary file its final name. It is hard linked
+        rather than renamed when possible, which fails rather than
+        replaces an image file added concurrently under the same name.
+
+        :returns: the directories whose entries changed, which are flushed
+                  when sync is set
+        :raises `glance_store.exceptions.Duplicate` if the image file
+                already exists
+        """
+        created = []
+        for attempt in range(_LINK_ATTEMPTS):
+            created.extend(self._create_fanout_directories(
+                os.path.dirname(temppath), os.path.dirname(filepath)))
+            try:
+                os.link(temppath, filepath)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    raise exceptions.Duplicate(image=filepath)
+                if (e.errno == errno.ENOENT and os.path.exists(temppath) and
+                        attempt + 1 < _LINK_ATTEMPTS):
+                    # An empty fan-out directory was removed in between,
+                    # e.g. by glance-store-filesystem-layout
+                    continue
+                # The filesystem doesn't support hard links
+                if os.path.exists(filepath):
+                    raise exceptions.Duplicate(image=filepath)
+                os.rename(temppath, filepath)
+            else:
+                os.unlink(temppath)
+            break
+
+        directories = [os.path.dirname(filepath)]
+        directories.extend(os.path.dirname(directory)
+                           for directory in created)
+        if sync:
+            for directory in directories:
+                utils.run_blocking(_fsync_directory, directory)
+        return directories
+
+    def _commit(self, temppath, filepath, durability):
+        """
+        Rename a complete temporary file into place, flushing it to disk as
+        the durability mode requires.
+        """
+        if durability == DURABILITY_GROUP:
+            _GROUP_COMMITTER.commit(
+                temppath,
+                lambda: self._rename_into_place(temppath, filepath, False))
+        else:
+            self._rename_into_place(temppath, filepath,
+                                    durability == DURABILITY_FDATASYNC)
+
+    @staticmethod
+    def _write_sparse(f, offset, buf):
+        """
+        Write a chunk of data at the given offset of a file, seeking over
+        its blocks of zeros rather than writing them, which leaves holes.
+        """
+        extents = utils.data_extents(buf)
+        if extents == [(0, len(buf))]:
+            f.write(buf)
+            return
+        view = memoryview(buf)
+        for start, length in extents:
+            f.seek(offset + start)
+            f.write(view[start:start + length])
+        f.seek(offset + len(buf))
+
+    def _find_stripe_datadirs(self, image_size):
+        """
+        Pick the datadirs to stripe an image over, if it is to be striped,
+        and reserve the space of its extents in them.
+
+        :returns: a tuple of the datadirs, in the order the extents are
+                  spread over them, and the space reserved in each, or
+                  None if the image isn't to be striped
+        """
+        width = self.conf.glance_store.filesystem_store_stripe_width
+        stripe_size = (self.conf.glance_store.filesystem_store_stripe_size *
+                       units.Mi)
+        if not (self.multiple_datadirs and width > 1 and
+                image_size > stripe_size):
+            return None
+
+        count = -(-image_size // stripe_size)
+        with self._capacity.lock:
+            candidates = []
+            for priority in self.priority_list:
+                candidates.extend(sorted(
+                    self.priority_data_map.get(priority),
+                    key=self._capacity.free_space, reverse=True))
+            width = min(width, count, len(candidates))
+            share = -(-count // max(width, 1)) * stripe_size
+            datadirs = [datadir for datadir in candidates
+                        if self._capacity.free_space(datadir) >= share]
+            datadirs = datadirs[:width]
+            if width < 2 or len(datadirs) < width:
+                return None
+            for datadir in datadirs:
+                self._capacity.reserve(datadir, share)
+        return datadirs, share
+
+    def _write_striped(self, temppath, image_id, image_file, checksum,
+                       datadirs, durability):
+        """
+        Write image data in extents striped over datadirs, written in
+        parallel, and the manifest listing them to temppath.
+        """
+        stripe_size = (self.conf.glance_store.filesystem_store_stripe_size *
+                       units.Mi)
+        fanout = self.conf.glance_store.filesystem_store_fanout
+        writers = [_ExtentWriter(self, datadir, durability)
+                   for datadir in datadirs]
+        extents = []
+        bytes_written = 0
+        stopped = False
+        try:
+            writer = None
+            for chunk in utils.chunkreadable(image_file,
+                                             min(self.WRITE_CHUNKSIZE,
+                                                 stripe_size)):
+                while chunk:
+                    if writer is None:
+                        writer = writers[len(extents) % len(writers)]
+                        if writer.error is not None:
+                            raise writer.error
+                        path = image_path(writer.datadir, '%s.%d' % (
+                            image_id, len(extents)), fanout)
+                        extents.append(path)
+                        writer.queue.put(path)
+                        written = 0
+                    data = chunk
+                    if len(chunk) > stripe_size - written:
+                        # Chunks of iterators may span extents
+                        data = chunk[:stripe_size - written]
+                    chunk = chunk[len(data):]
+                    checksum.update(data)
+                    writer.queue.put(data)
+                    written += len(data)
+                    bytes_written += len(data)
+                    if written == stripe_size:
+                        writer.queue.put(b'')
+                        writer = None
+            if writer is not None:
+                writer.queue.put(b'')
+            for writer in writers:
+                writer.stop()
+            stopped = True
+            for writer in writers:
+                if writer.error is not None:
+                    raise writer.error
+            with open(temppath, 'w') as f:
+                f.write(jsonutils.dumps({'size': bytes_written,
+                                         'stripe_size': stripe_size,
+                                         'extents': extents}))
+                if durability == DURABILITY_FDATASYNC:
+                    f.flush()
+                    _fdatasync(f.fileno())
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                if not stopped:
+                    for writer in writers:
+                        writer.stop()
+                self._delete_extents(extents)
+        return bytes_written
+
+    def _read_manifest(self, filepath):
+        try:
+            with open(filepath) as f:
+                manifest = jsonutils.loads(f.read())
+            return (manifest['extents'], manifest['stripe_size'],
+                    manifest['size'])
+        except (ValueError, KeyError, TypeError):
+            reason = _("Invalid manifest of striped image %s") % filepath
+            LOG.error(reason)
+            raise exceptions.BackendException(reason)
+
+    def _delete_extents(self, extents):
+        for path in extents:
+            path = self._find_image_file(path)
+            if path is not None:
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    LOG.warn(_LW("Unable to remove extent %(path)s: %(e)s") %
+                             {'path': path, 'e': utils.exception_to_str(e)})
+
+    def _set_file_permission(self, path, filepath):
         if self.conf.glance_store.filesystem_store_file_perm > 0:
             perm = int(str(self.conf.glance_store.filesystem_store_file_perm),
                        8)
             try:
-                os.chmod(filepath, perm)
+                os.chmod(path, perm)
             except (IOError, OSError):
                 LOG.warn(_LW("Unable to set permission to image: %s") %
                          filepath)
 
-        return ('file://%s' % filepath, bytes_written, checksum_hex, metadata)
-
     @staticmethod
     def _delete_partial(filepath, iid):
         try:
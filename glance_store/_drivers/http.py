@@ -13,13 +13,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
 import logging
 import socket
 
+from oslo_config import cfg
+from oslo_utils import units
 from six.moves import http_client
 from six.moves import urllib
 
 from glance_store import capabilities
+from glance_store.common import utils
 import glance_store.driver
 from glance_store import exceptions
 from glance_store.i18n import _
@@ -30,6 +34,22 @@ LOG = logging.getLogger(__name__)
 
 
 MAX_REDIRECTS = 5
+DEFAULT_DOWNLOAD_RANGE_SIZE = 64  # 64M
+
+_HTTP_OPTS = [
+    cfg.IntOpt('http_store_download_threads', default=1,
+               help=_('The number of byte ranges of an image that are '
+                      'downloaded concurrently, each over its own '
+                      'connection. Images larger than '
+                      'http_store_download_range_size are split into ranges '
+                      'when this value is greater than 1 and the server '
+                      'accepts byte range requests.')),
+    cfg.IntOpt('http_store_download_range_size',
+               default=DEFAULT_DOWNLOAD_RANGE_SIZE,
+               help=_('The size, in MB, of each byte range requested when '
+                      'downloading an image with concurrent range '
+                      'requests.'))
+]
 
 
 class StoreLocation(glance_store.location.StoreLocation):
@@ -115,6 +135,7 @@ class Store(glance_store.driver.Store):
 
     _CAPABILITIES = (capabilities.BitMasks.READ_ACCESS |
                      capabilities.BitMasks.DRIVER_REUSABLE)
+    OPTIONS = _HTTP_OPTS
 
     @capabilities.check
     def get(self, location, offset=0, chunk_size=None, context=None):
@@ -126,7 +147,32 @@ class Store(glance_store.driver.Store):
         :param location `glance_store.location.Location` object, supplied
                         from glance_store.location.get_location_from_uri()
         """
+        cs = self.READ_CHUNKSIZE
+
+        class ResponseIndexable(glance_store.Indexable):
+            def another(self):
+                try:
+                    return next(self.wrapped)
+                except StopIteration:
+                    return b''
+
+        class BufferedResponseIndexable(glance_store.Indexable):
+            # Reads the response directly, into a reused buffer
+            def another(self):
+                chunk = self.read_chunk(resp, cs)
+                if not chunk:
+                    conn.close()
+                return chunk
+
         try:
+            threads = self.conf.glance_store.http_store_download_threads
+            if threads > 1:
+                iterator, content_length = self._get_ranges(location,
+                                                            threads)
+                if iterator is not None:
+                    return (ResponseIndexable(iterator, content_length),
+                            content_length)
+
             conn, resp, content_length = self._query(location, 'GET')
         except socket.error:
             reason = _LE("Remote server where the image is present "
@@ -134,16 +180,46 @@ class Store(glance_store.driver.Store):
             LOG.error(reason)
             raise exceptions.RemoteServiceUnavailable()
 
-        iterator = http_response_iterator(conn, resp, self.READ_CHUNKSIZE)
+        iterator = http_response_iterator(conn, resp, cs)
 
-        class ResponseIndexable(glance_store.Indexable):
-            def another(self):
-                try:
-                    return next(self.wrapped)
-                except StopIteration:
-                    return ''
+        return (BufferedResponseIndexable(iterator, content_length),
+                content_length)
 
-        return (ResponseIndexable(iterator, content_length), content_length)
+    def _get_ranges(self, location, threads):
+        """
+        Returns a tuple of an iterator which downloads the image in
+        concurrent byte ranges and the image size, or (None, size) if
+        the image is too small or the server does not accept ranges.
+        """
+        conn, resp, content_length = self._query(location, 'HEAD')
+        conn.close()
+        range_size = (self.conf.glance_store.http_store_download_range_size *
+                      units.Mi)
+        if (content_length <= range_size or
+                resp.getheader('accept-ranges') != 'bytes'):
+            return (None, content_length)
+
+        LOG.debug("Downloading %(path)s in ranges of %(range)d bytes "
+                  "using %(threads)d connections" %
+                  {'path': location.store_location.path,
+                   'range': range_size, 'threads': threads})
+        fetch = functools.partial(self._get_range, location)
+        return (utils.parallel_range_iter(fetch, content_length, range_size,
+                                          threads),
+                content_length)
+
+    def _get_range(self, location, offset, length):
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+        conn, resp, _length = self._query(location, 'GET', headers=headers)
+        if resp.status != http_client.PARTIAL_CONTENT:
+            conn.close()
+            reason = (_("HTTP URL %(url)s returned a %(status)s status code "
+                        "for a byte range request.") %
+                      dict(url=location.store_location.path,
+                           status=resp.status))
+            LOG.debug(reason)
+            raise exceptions.BadStoreUri(message=reason)
+        return http_response_iterator(conn, resp, self.READ_CHUNKSIZE)
 
     def get_schemes(self):
         return ('http', 'https')
@@ -170,7 +246,7 @@ class Store(glance_store.driver.Store):
             return 0
         return size
 
-    def _query(self, location, verb, depth=0):
+    def _query(self, location, verb, depth=0, headers=None):
         if depth > MAX_REDIRECTS:
             reason = (_("The HTTP URL exceeded %s maximum "
                         "redirects.") % MAX_REDIRECTS)
@@ -179,7 +255,7 @@ class Store(glance_store.driver.Store):
         loc = location.store_location
         conn_class = self._get_conn_class(loc)
         conn = conn_class(loc.netloc)
-        conn.request(verb, loc.path, "", {})
+        conn.request(verb, loc.path, "", headers or {})
         resp = conn.getresponse()
 
         # Check for bad status codes
@@ -210,7 +286,7 @@ class Store(glance_store.driver.Store):
                                      uri=location_header,
                                      image_id=location.image_id,
                                      store_specs=location.store_specs)
-            return self._query(new_loc, verb, depth + 1)
+            return self._query(new_loc, verb, depth + 1, headers=headers)
         content_length = int(resp.getheader('content-length', 0))
         return (conn, resp, content_length)
 
@@ -18,7 +18,6 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
-import hashlib
 import logging
 import math
 
@@ -164,17 +163,61 @@ class ImageIterator(object):
                                    snapshot=self.snapshot) as image:
                         img_info = image.stat()
                         size = img_info['size']
+                        extents = self._data_extents(image, size)
                         bytes_left = size
                         while bytes_left > 0:
+                            offset = size - bytes_left
                             length = min(self.chunk_size, bytes_left)
-                            data = image.read(size - bytes_left, length)
+                            if extents.holds_data(offset, length):
+                                data = image.read(offset, length)
+                            else:
+                                # Unallocated extents read as zeros
+                                data = b'\0' * length
                             bytes_left -= len(data)
                             yield data
-                        raise StopIteration()
         except rbd.ImageNotFound:
             raise exceptions.NotFound(
                 _('RBD image %s does not exist') % self.name)
 
+    @staticmethod
+    def _data_extents(image, size):
+        extents = _Extents()
+        try:
+            image.diff_iterate(0, size, None, extents.add)
+        except Exception as e:
+            LOG.debug("Unable to list the allocated extents of the image, "
+                      "reading all of it: %s" % utils.exception_to_str(e))
+            extents.add(0, size, True)
+        return extents
+
+
+class _Extents(object):
+    """The extents of an image which hold data, in ascending order."""
+
+    def __init__(self):
+        self.extents = []
+        self._index = 0
+
+    def add(self, offset, length, exists):
+        if not exists:
+            return
+        if self.extents and self.extents[-1][1] >= offset:
+            self.extents[-1][1] = max(self.extents[-1][1], offset + length)
+        else:
+            self.extents.append([offset, offset + length])
+
+    def holds_data(self, offset, length):
+        """
+        Return True if any of the given range holds data. The ranges are
+        expected in ascending order.
+        """
+        end = offset + length
+        while (self._index < len(self.extents) and
+               self.extents[self._index][1] <= offset):
+            self._index += 1
+        return (self._index < len(self.extents) and
+                self.extents[self._index][0] < end)
+
 
 class Store(driver.Store):
     """An implementation of the RBD backend adapter."""
@@ -332,7 +375,7 @@ class Store(driver.Store):
         :raises `glance_store.exceptions.Duplicate` if the image already
                 existed
         """
-        checksum = hashlib.md5()
+        checksum = utils.Checksum(self.conf)
         image_name = str(image_id)
         with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
             fsid = None
@@ -374,8 +417,17 @@ class Store(driver.Store):
                                 image.resize(length)
                             LOG.debug(_("writing chunk at offset %s") %
                                       (offset))
-                            offset += image.write(chunk, offset)
                             checksum.update(chunk)
+                            # The image is thin provisioned, blocks of zeros
+                            # needn't be written.
+                            extents = utils.data_extents(chunk)
+                            if extents == [(0, len(chunk))]:
+                                image.write(chunk, offset)
+                            else:
+                                for start, length in extents:
+                                    image.write(chunk[start:start + length],
+                                                offset + start)
+                            offset += len(chunk)
                         if loc.snapshot:
                             image.create_snap(loc.snapshot)
                             image.protect_snap(loc.snapshot)
@@ -400,7 +452,8 @@ class Store(driver.Store):
         if image_size == 0:
             image_size = bytes_written
 
-        return (loc.get_uri(), image_size, checksum.hexdigest(), {})
+        return (loc.get_uri(), image_size, checksum.hexdigest(),
+                checksum.metadata())
 
     @capabilities.check
     def delete(self, location, context=None):
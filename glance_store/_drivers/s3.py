@@ -15,7 +15,7 @@
 
 """Storage backend for S3 or Storage Servers that follow the S3 Protocol"""
 
-import hashlib
+import functools
 import logging
 import math
 import re
@@ -45,6 +45,7 @@ DEFAULT_LARGE_OBJECT_SIZE = 100          # 100M
 DEFAULT_LARGE_OBJECT_CHUNK_SIZE = 10     # 10M
 DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE = 5  # 5M
 DEFAULT_THREAD_POOLS = 10                # 10 pools
+DEFAULT_DOWNLOAD_RANGE_SIZE = 64         # 64M
 MAX_PART_NUM = 10000                     # 10000 upload parts
 
 _S3_OPTS = [
@@ -89,7 +90,18 @@ _S3_OPTS = [
                help=_('The username to connect to the proxy.')),
     cfg.StrOpt('s3_store_proxy_password', secret=True,
                default=None,
-               help=_('The password to use when connecting over a proxy.'))
+               help=_('The password to use when connecting over a proxy.')),
+    cfg.IntOpt('s3_store_download_threads', default=1,
+               help=_('The number of byte ranges of an object that are '
+                      'downloaded concurrently, each over its own '
+                      'connection. Objects larger than '
+                      's3_store_download_range_size are split into ranges '
+                      'when this value is greater than 1.')),
+    cfg.IntOpt('s3_store_download_range_size',
+               default=DEFAULT_DOWNLOAD_RANGE_SIZE,
+               help=_('What size, in MB, should each byte range be when '
+                      'downloading an object with concurrent range '
+                      'requests.'))
 ]
 
 
@@ -309,6 +321,9 @@ class Store(glance_store.driver.Store):
     """An implementation of the s3 adapter."""
 
     _CAPABILITIES = capabilities.BitMasks.RW_ACCESS
+    # The image size only picks single or multipart uploads and the size
+    # of the parts
+    ACCEPTS_SIZE_UPPER_BOUND = True
     OPTIONS = _S3_OPTS
     EXAMPLE_URL = "s3://<ACCESS_KEY>:<SECRET_KEY>@<S3_URL>/<BUCKET>/<OBJ>"
 
@@ -427,9 +442,29 @@ class Store(glance_store.driver.Store):
 
         class ChunkedIndexable(glance_store.Indexable):
             def another(self):
-                return (self.wrapped.fp.read(cs)
+                return (self.read_chunk(self.wrapped.fp, cs)
                         if self.wrapped.fp else None)
 
+        class RangeIndexable(glance_store.Indexable):
+            def another(self):
+                try:
+                    return next(self.wrapped)
+                except StopIteration:
+                    return b''
+
+        threads = self.conf.glance_store.s3_store_download_threads
+        range_size = (self.conf.glance_store.s3_store_download_range_size *
+                      units.Mi)
+        if threads > 1 and key.size > range_size:
+            LOG.debug("Downloading key %(key)s in ranges of %(range)d bytes "
+                      "using %(threads)d connections" %
+                      {'key': location.store_location.key,
+                       'range': range_size, 'threads': threads})
+            fetch = functools.partial(self._retrieve_key_range, location)
+            ranges = utils.parallel_range_iter(fetch, key.size, range_size,
+                                               threads)
+            return (RangeIndexable(ranges, key.size), key.size)
+
         return (ChunkedIndexable(ChunkedFile(key, cs), key.size), key.size)
 
     def get_size(self, location, context=None):
@@ -464,6 +499,17 @@ class Store(glance_store.driver.Store):
 
         return key
 
+    def _retrieve_key_range(self, location, offset, length):
+        """
+        Retrieve a byte range of the key over a new S3 connection, as an
+        iterator over chunks of READ_CHUNKSIZE bytes.
+        """
+        key = self._retrieve_key(location)
+        key.BufferSize = self.READ_CHUNKSIZE
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+        key.open_read(headers=headers)
+        return ChunkedFile(key, self.READ_CHUNKSIZE)
+
     @capabilities.check
     def add(self, image_id, image_file, image_size, context=None):
         """
@@ -559,7 +605,7 @@ class Store(glance_store.driver.Store):
 
         tmpdir = self.s3_store_object_buffer_dir
         temp_file = tempfile.NamedTemporaryFile(dir=tmpdir)
-        checksum = hashlib.md5()
+        checksum = utils.Checksum(self.conf)
         for chunk in utils.chunkreadable(image_file, self.WRITE_CHUNKSIZE):
             checksum.update(chunk)
             temp_file.write(chunk)
@@ -581,7 +627,7 @@ class Store(glance_store.driver.Store):
                    'obj_name': obj_name,
                    'checksum_hex': checksum_hex})
 
-        return (loc.get_uri(), size, checksum_hex, {})
+        return (loc.get_uri(), size, checksum_hex, checksum.metadata())
 
     def add_multipart(self, image_file, image_size, bucket_obj, obj_name, loc):
         """
@@ -593,7 +639,7 @@ class Store(glance_store.driver.Store):
         :loc: The Store Location Info
         """
 
-        checksum = hashlib.md5()
+        checksum = utils.Checksum(self.conf)
         pool_size = self.s3_store_thread_pools
         pool = eventlet.greenpool.GreenPool(size=pool_size)
         mpu = bucket_obj.initiate_multipart_upload(obj_name)
@@ -669,7 +715,8 @@ class Store(glance_store.driver.Store):
                       'UploadId': mpu.id,
                       'total_size': total_size,
                       'checksum_hex': checksum_hex})
-            return (loc.get_uri(), total_size, checksum_hex, {})
+            return (loc.get_uri(), total_size, checksum_hex,
+                    checksum.metadata())
         else:
             # Abort
             bucket_obj.cancel_multipart_upload(obj_name, mpu.id)
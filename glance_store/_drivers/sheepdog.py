@@ -15,7 +15,6 @@
 
 """Storage backend for Sheepdog storage system"""
 
-import hashlib
 import logging
 
 from oslo_concurrency import processutils
@@ -25,6 +24,7 @@ from oslo_utils import units
 
 import glance_store
 from glance_store import capabilities
+from glance_store.common import utils
 import glance_store.driver
 from glance_store import exceptions
 from glance_store.i18n import _
@@ -274,7 +274,7 @@ class Store(glance_store.driver.Store):
                                        % image_id)
 
         location = StoreLocation({'image': image_id}, self.conf)
-        checksum = hashlib.md5()
+        checksum = utils.Checksum(self.conf)
 
         image.create(image_size)
 
@@ -283,16 +283,17 @@ class Store(glance_store.driver.Store):
             while left > 0:
                 length = min(self.chunk_size, left)
                 data = image_file.read(length)
+                checksum.update(data)
                 image.write(data, total - left, length)
                 left -= length
-                checksum.update(data)
         except Exception:
             # Note(zhiyan): clean up already received data when
             # error occurs such as ImageSizeLimitExceeded exceptions.
             with excutils.save_and_reraise_exception():
                 image.delete()
 
-        return (location.get_uri(), image_size, checksum.hexdigest(), {})
+        return (location.get_uri(), image_size, checksum.hexdigest(),
+                checksum.metadata())
 
     @capabilities.check
     def delete(self, location, context=None):
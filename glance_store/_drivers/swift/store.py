@@ -15,6 +15,7 @@
 
 """Storage backend for SWIFT"""
 
+import functools
 import hashlib
 import logging
 import math
@@ -45,6 +46,7 @@ _LI = i18n._LI
 DEFAULT_CONTAINER = 'glance'
 DEFAULT_LARGE_OBJECT_SIZE = 5 * units.Ki  # 5GB
 DEFAULT_LARGE_OBJECT_CHUNK_SIZE = 200  # 200M
+DEFAULT_DOWNLOAD_RANGE_SIZE = 64  # 64M
 ONE_MB = units.k * units.Ki  # Here we used the mixed meaning of MB
 
 _SWIFT_OPTS = [
@@ -117,11 +119,32 @@ _SWIFT_OPTS = [
                        'compressed format, eg qcow2.')),
     cfg.IntOpt('swift_store_retry_get_count', default=0,
                help=_('The number of times a Swift download will be retried '
-                      'before the request fails.'))
+                      'before the request fails.')),
+    cfg.IntOpt('swift_store_download_threads', default=1,
+               help=_('The number of byte ranges of an object that are '
+                      'downloaded concurrently, each over its own '
+                      'connection. Objects larger than '
+                      'swift_store_download_range_size are split into '
+                      'ranges when this value is greater than 1.')),
+    cfg.IntOpt('swift_store_download_range_size',
+               default=DEFAULT_DOWNLOAD_RANGE_SIZE,
+               help=_('The size, in MB, of each byte range requested when '
+                      'downloading an object with concurrent range '
+                      'requests.'))
 ]
 
 
-def swift_retry_iter(resp_iter, length, store, location, context):
+def swift_retry_iter(resp_iter, length, store, location, context,
+                     offset=None, connection=None):
+    """
+    Yield the data of an object, requesting the rest of it again when the
+    response ends early, up to swift_store_retry_get_count times.
+
+    :param offset: The offset of the byte range of `length` bytes being
+                   read, or None if the whole object is read
+    :param connection: The connection the rest of the data is requested
+                       with, or None to open a new one
+    """
     if not length and isinstance(resp_iter, six.BytesIO):
         if six.PY3:
             # On Python 3, io.BytesIO does not have a len attribute, instead
@@ -158,16 +181,17 @@ def swift_retry_iter(resp_iter, length, store, location, context):
                 retries += 1
                 glance_conf = store.conf.glance_store
                 retry_count = glance_conf.swift_store_retry_get_count
+                start = (offset or 0) + bytes_read
+                end = None if offset is None else offset + length - 1
                 LOG.info(_("Retrying Swift connection "
                            "(%(retries)d/%(max_retries)d) with "
                            "range=%(start)d-%(end)d") %
                          {'retries': retries,
                           'max_retries': retry_count,
-                          'start': bytes_read,
-                          'end': length})
-                (_resp_headers, resp_iter) = store._get_object(location, None,
-                                                               bytes_read,
-                                                               context=context)
+                          'start': start,
+                          'end': (offset or 0) + length})
+                (_resp_headers, resp_iter) = store._get_object(
+                    location, connection, start, context=context, end=end)
         else:
             break
 
@@ -394,6 +418,7 @@ def _is_slo(slo_header):
 class BaseStore(driver.Store):
 
     _CAPABILITIES = capabilities.BitMasks.RW_ACCESS
+    ACCEPTS_SIZE_UPPER_BOUND = True
     CHUNKSIZE = 65536
     OPTIONS = _SWIFT_OPTS + sutils.swift_opts
 
@@ -416,12 +441,15 @@ class BaseStore(driver.Store):
         self.cacert = glance_conf.swift_store_cacert
         super(BaseStore, self).configure(re_raise_bsc=re_raise_bsc)
 
-    def _get_object(self, location, connection=None, start=None, context=None):
+    def _get_object(self, location, connection=None, start=None, context=None,
+                    end=None):
         if not connection:
             connection = self.get_connection(location, context=context)
         headers = {}
         if start is not None:
             bytes_range = 'bytes=%d-' % start
+            if end is not None:
+                bytes_range += '%d' % end
             headers = {'Range': bytes_range}
 
         try:
@@ -438,19 +466,77 @@ class BaseStore(driver.Store):
 
         return (resp_headers, resp_body)
 
+    def _get_object_length(self, location, connection):
+        try:
+            resp_headers = connection.head_object(location.container,
+                                                  location.obj)
+        except swiftclient.ClientException as e:
+            if e.http_status == http_client.NOT_FOUND:
+                msg = _("Swift could not find object %s.") % location.obj
+                LOG.warn(msg)
+                raise exceptions.NotFound(message=msg)
+            else:
+                raise
+        return int(resp_headers.get('content-length', 0))
+
+    def _get_range_connection(self, connection):
+        """
+        Returns a new connection which reuses the storage url and auth
+        token of an authenticated connection, so that byte ranges can be
+        downloaded concurrently without authenticating again.
+        """
+        return swiftclient.Connection(
+            preauthurl=connection.url, preauthtoken=connection.token,
+            insecure=self.insecure, ssl_compression=self.ssl_compression,
+            cacert=self.cacert)
+
+    def _get_object_range(self, location, connection, offset, length):
+        range_connection = self._get_range_connection(connection)
+        try:
+            (_resp_headers, resp_body) = self._get_object(
+                location, range_connection, start=offset,
+                end=offset + length - 1)
+            if self.conf.glance_store.swift_store_retry_get_count > 0:
+                resp_body = swift_retry_iter(resp_body, length, self,
+                                             location, None, offset=offset,
+                                             connection=range_connection)
+            for chunk in resp_body:
+                yield chunk
+        finally:
+            range_connection.close()
+
     @capabilities.check
     def get(self, location, connection=None,
             offset=0, chunk_size=None, context=None):
         location = location.store_location
-        (resp_headers, resp_body) = self._get_object(location, connection,
-                                                     context=context)
 
         class ResponseIndexable(glance_store.Indexable):
             def another(self):
                 try:
                     return next(self.wrapped)
                 except StopIteration:
-                    return ''
+                    return b''
+
+        glance_conf = self.conf.glance_store
+        threads = glance_conf.swift_store_download_threads
+        if threads > 1:
+            if not connection:
+                connection = self.get_connection(location, context=context)
+            range_size = glance_conf.swift_store_download_range_size * ONE_MB
+            length = self._get_object_length(location, connection)
+            if length > range_size:
+                LOG.debug("Downloading %(obj)s in ranges of %(range)d bytes "
+                          "using %(threads)d connections" %
+                          {'obj': location.obj, 'range': range_size,
+                           'threads': threads})
+                fetch = functools.partial(self._get_object_range, location,
+                                          connection)
+                resp_body = cutils.parallel_range_iter(fetch, length,
+                                                       range_size, threads)
+                return (ResponseIndexable(resp_body, length), length)
+
+        (resp_headers, resp_body) = self._get_object(location, connection,
+                                                     context=context)
 
         length = int(resp_headers.get('content-length', 0))
         if self.conf.glance_store.swift_store_retry_get_count > 0:
@@ -501,13 +587,20 @@ class BaseStore(driver.Store):
 
         LOG.debug("Adding image object '%(obj_name)s' "
                   "to Swift" % dict(obj_name=location.obj))
+        checksum = cutils.Checksum(self.conf)
+        # An upper bound of the size only picks how the data is sent, the
+        # data is sent without a content length
+        exact_size = not getattr(image_file, 'size_is_upper_bound', False)
         try:
             if image_size > 0 and image_size < self.large_object_size:
                 # Image size is known, and is less than large_object_size.
                 # Send to Swift with regular PUT.
-                obj_etag = connection.put_object(location.container,
-                                                 location.obj, image_file,
-                                                 content_length=image_size)
+                reader = ChunkReader(image_file, checksum, image_size)
+                obj_etag = connection.put_object(
+                    location.container, location.obj, reader,
+                    content_length=image_size if exact_size else None)
+                if not exact_size:
+                    image_size = reader.bytes_read
             else:
                 # Write the image into Swift in chunks.
                 chunk_id = 1
@@ -523,12 +616,11 @@ class BaseStore(driver.Store):
                               "segmented object to Swift.")
                     total_chunks = '?'
 
-                checksum = hashlib.md5()
                 written_chunks = []
                 combined_chunks_size = 0
                 while True:
                     chunk_size = self.large_object_chunk_size
-                    if image_size == 0:
+                    if image_size == 0 or not exact_size:
                         content_length = None
                     else:
                         left = image_size - combined_chunks_size
@@ -579,7 +671,7 @@ class BaseStore(driver.Store):
 
                 # In the case we have been given an unknown image size,
                 # set the size to the total size of the combined chunks.
-                if image_size == 0:
+                if image_size == 0 or not exact_size:
                     image_size = combined_chunks_size
 
                 # Now we write the object manifest and return the
@@ -608,7 +700,7 @@ class BaseStore(driver.Store):
                 include_creds = True
 
             return (location.get_uri(credentials_included=include_creds),
-                    image_size, obj_etag, {})
+                    image_size, obj_etag, checksum.metadata())
         except swiftclient.ClientException as e:
             if e.http_status == http_client.CONFLICT:
                 msg = _("Swift already has an image at this location")
@@ -15,7 +15,6 @@
 
 """Storage backend for VMware Datastore"""
 
-import hashlib
 import logging
 import os
 
@@ -40,6 +39,7 @@ from six.moves import range
 
 import glance_store
 from glance_store import capabilities
+from glance_store.common import utils
 from glance_store import exceptions
 from glance_store.i18n import _
 from glance_store.i18n import _LE
@@ -135,10 +135,10 @@ def http_response_iterator(conn, response, size):
 
 class _Reader(object):
 
-    def __init__(self, data):
+    def __init__(self, data, conf=None):
         self._size = 0
         self.data = data
-        self.checksum = hashlib.md5()
+        self.checksum = utils.Checksum(conf)
 
     def read(self, size=None):
         result = self.data.read(size)
@@ -153,11 +153,11 @@ class _Reader(object):
 
 class _ChunkReader(_Reader):
 
-    def __init__(self, data, blocksize=8192):
+    def __init__(self, data, blocksize=8192, conf=None):
         self.blocksize = blocksize
         self.current_chunk = b""
         self.closed = False
-        super(_ChunkReader, self).__init__(data)
+        super(_ChunkReader, self).__init__(data, conf=conf)
 
     def read(self, size=None):
         ret = b""
@@ -480,13 +480,13 @@ class Store(glance_store.Store):
         ds = self.select_datastore(image_size)
         if image_size > 0:
             headers = {'Content-Length': image_size}
-            image_file = _Reader(image_file)
+            image_file = _Reader(image_file, conf=self.conf)
         else:
             # NOTE (arnaud): use chunk encoding when the image is still being
             # generated by the server (ex: stream optimized disks generated by
             # Nova).
             headers = {'Transfer-Encoding': 'chunked'}
-            image_file = _ChunkReader(image_file)
+            image_file = _ChunkReader(image_file, conf=self.conf)
         loc = StoreLocation({'scheme': self.scheme,
                              'server_host': self.server_host,
                              'image_dir': self.store_image_dir,
@@ -536,7 +536,8 @@ class Store(glance_store.Store):
             raise exceptions.BackendException(msg)
 
         return (loc.get_uri(), image_file.size,
-                image_file.checksum.hexdigest(), {})
+                image_file.checksum.hexdigest(),
+                image_file.checksum.metadata())
 
     @capabilities.check
     def get(self, location, offset=0, chunk_size=None, context=None):
@@ -548,15 +549,17 @@ class Store(glance_store.Store):
                         from glance_store.location.get_location_from_uri()
         """
         conn, resp, content_length = self._query(location, 'GET')
-        iterator = http_response_iterator(conn, resp, self.READ_CHUNKSIZE)
+        cs = self.READ_CHUNKSIZE
+        iterator = http_response_iterator(conn, resp, cs)
 
         class ResponseIndexable(glance_store.Indexable):
 
+            # Reads the response directly, into a reused buffer
             def another(self):
-                try:
-                    return next(self.wrapped)
-                except StopIteration:
-                    return ''
+                chunk = self.read_chunk(resp, cs)
+                if not chunk:
+                    conn.close()
+                return chunk
 
         return (ResponseIndexable(iterator, content_length), content_length)
 
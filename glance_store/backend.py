@@ -13,18 +13,35 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import hashlib
 import logging
+import threading
+import weakref
 
 from oslo_config import cfg
+from oslo_utils import excutils
+from oslo_utils import units
 import six
+from six.moves import queue
 from stevedore import driver
 from stevedore import extension
 
+try:
+    from importlib import metadata as importlib_metadata
+except ImportError:
+    importlib_metadata = None
+    import pkg_resources
+
+from glance_store import cache
 from glance_store import capabilities
 from glance_store.common import utils
+from glance_store import compression
 from glance_store import exceptions
 from glance_store import i18n
 from glance_store import location
+from glance_store import metrics
 
 
 CONF = cfg.CONF
@@ -46,11 +63,114 @@ _STORE_OPTS = [
                       "update logic will be executed only when interval "
                       "seconds elapsed and an operation of store has "
                       "triggered. The feature will be enabled only when "
-                      "the option value greater then zero."))
+                      "the option value greater then zero.")),
+    cfg.StrOpt('store_cache_dir',
+               help=_("Directory in which image data read from remote "
+                      "stores is cached. Repeated reads of a cached image "
+                      "are served from local disk instead of the backend. "
+                      "The cache is disabled when this option is unset.")),
+    cfg.IntOpt('store_cache_max_size', default=10 * units.Gi,
+               help=_("The upper limit, in bytes, of image data kept in "
+                      "store_cache_dir. Cached images are evicted once "
+                      "this limit is exceeded.")),
+    cfg.StrOpt('store_cache_eviction_policy', default='lru',
+               choices=('lru', 'lfu'),
+               help=_("The policy used to pick cached images to evict: "
+                      "'lru' evicts the least recently used image, 'lfu' "
+                      "the least frequently used one.")),
+    cfg.ListOpt('store_cache_schemes',
+                default=['swift', 'swift+http', 'swift+https',
+                         'swift+config', 's3', 's3+http', 's3+https',
+                         'rbd', 'http', 'https', 'vsphere'],
+                help=_("List of location schemes whose image data is "
+                       "cached in store_cache_dir.")),
+    cfg.IntOpt('store_driver_pool_size', default=10,
+               help=_("The maximum number of idle, configured instances "
+                      "kept per store whose driver is not reusable, e.g. "
+                      "swift, rbd or s3. An operation checks an instance "
+                      "out of the pool and returns it afterwards, which "
+                      "avoids loading and configuring a new driver every "
+                      "time. Set to 0 to create a new instance for every "
+                      "operation.")),
+    cfg.IntOpt('store_fanout_buffer_size', default=16 * units.Mi,
+               help=_("The maximum number of bytes of image data buffered "
+                      "for each store while the same image is added to "
+                      "several stores at once. Reading the source data is "
+                      "paused while any store is this far behind.")),
+    cfg.ListOpt('store_checksum_algorithms', default=[],
+                help=_("Digests to compute while image data is added to a "
+                       "store, in addition to the md5 checksum, e.g. "
+                       "sha256 or sha512. They are computed in the same "
+                       "pass as the checksum and returned in the location "
+                       "metadata under the algorithm name.")),
+    cfg.IntOpt('store_checksum_threads', default=0,
+               help=_("Compute the checksums of large chunks of image "
+                      "data in eventlet's pool of native threads when "
+                      "threading is monkey patched, so that hashing "
+                      "doesn't stall the other greenthreads. Any value "
+                      "above 0 enables it, the size of the pool is set "
+                      "by EVENTLET_THREADPOOL_SIZE. Set to 0 to compute "
+                      "them inline.")),
+    cfg.StrOpt('store_metrics_statsd_address',
+               help=_("The host:port address of a statsd server to send "
+                      "the metrics of every store operation to.")),
+    cfg.BoolOpt('store_lazy_load', default=False,
+                help=_("Register the schemes of the configured stores "
+                       "without importing their drivers, and only import "
+                       "and configure a driver when one of its schemes is "
+                       "first used. Drivers which don't declare their "
+                       "schemes as glance_store.schemes entry points are "
+                       "still loaded at startup.")),
+    cfg.IntOpt('store_location_cache_size', default=4096,
+               help=_("The number of image locations parsed from their "
+                      "URIs which are kept in memory, so that operations "
+                      "on the same images don't parse their URIs again. "
+                      "Set to 0 to disable.")),
+    cfg.StrOpt('store_compression', choices=('zlib', 'zstd'),
+               help=_("Codec to compress the image data added to the "
+                      "stores of store_compression_schemes with. zstd "
+                      "requires the zstandard library. Data is only "
+                      "compressed when its size is known up front, and "
+                      "compression is disabled when this option is "
+                      "unset.")),
+    cfg.IntOpt('store_compression_level',
+               help=_("Compression level of the codec, its own default "
+                      "level is used when unset.")),
+    cfg.IntOpt('store_compression_frame_size', default=4 * units.Mi,
+               help=_("The number of bytes of image data compressed on "
+                      "their own. Ranged reads decompress whole frames, "
+                      "so smaller frames make them cheaper at the expense "
+                      "of the compression ratio.")),
+    cfg.ListOpt('store_compression_schemes', default=[],
+                help=_("List of location schemes whose image data is "
+                       "compressed when store_compression is set, e.g. "
+                       "swift,swift+https,s3. Image data read from these "
+                       "schemes is decompressed if it was stored "
+                       "compressed, even once store_compression is unset, "
+                       "so schemes must stay listed while compressed "
+                       "images are stored with them. The image data of "
+                       "the other schemes is read and sized as is."))
 ]
 
 _STORE_CFG_GROUP = 'glance_store'
 
+# Entry points naming each scheme of a driver registered as a
+# glance_store.drivers entry point, with the same target as that entry
+# point, so that the schemes can be registered without importing the
+# driver when store_lazy_load is enabled.
+_SCHEMES_GROUP = 'glance_store.schemes'
+# Target of a driver entry point -> the schemes its entry points name
+_DRIVER_SCHEMES = None
+
+_IMAGE_CACHE = None
+_STATSD_SINK = None
+
+# Registered store -> _DriverPool of instances handed out in its place
+_DRIVER_POOLS = weakref.WeakKeyDictionary()
+# Checked out store instance -> _DriverPool it belongs to
+_CHECKED_OUT_STORES = weakref.WeakKeyDictionary()
+_DRIVER_POOLS_LOCK = threading.Lock()
+
 
 def _list_opts():
     driver_opts = []
@@ -72,8 +192,15 @@ def _list_opts():
             [(_STORE_CFG_GROUP, driver_opts)])
 
 
-def register_opts(conf):
-    opts = _list_opts()
+def register_opts(conf, lazy=False):
+    """
+    Register the glance_store options and those of all the drivers.
+
+    :param lazy: only register the glance_store options. The options of
+                 a driver are then registered when the driver is loaded,
+                 so that no driver is imported here.
+    """
+    opts = _list_opts() if not lazy else [(_STORE_CFG_GROUP, _STORE_OPTS)]
     for group, opt_list in opts:
         LOG.debug("Registering options for group %s" % group)
         for opt in opt_list:
@@ -88,6 +215,11 @@ class Indexable(object):
     Store.get() is passed to Store.add() when adding a Copy-From image to a
     Store where the client library relies on eventlet GreenSockets, in which
     case the data to be written is indexed over.
+
+    Indexing hands out memoryview slices of the current chunk rather than
+    copies of it, and subclasses may read the chunks into a buffer which is
+    reused, see read_chunk(). Data obtained by indexing is therefore only
+    valid until the next index past it, which is how sendall() consumes it.
     """
 
     def __init__(self, wrapped, size):
@@ -102,6 +234,7 @@ class Indexable(object):
                                             if hasattr(wrapped, 'len') else 0)
         self.cursor = 0
         self.chunk = None
+        self._buffer = None
 
     def __iter__(self):
         """
@@ -119,7 +252,7 @@ class Indexable(object):
         """
         start = i.start if isinstance(i, slice) else i
         if start < self.cursor:
-            return self.chunk[(start - self.cursor):]
+            return memoryview(self.chunk)[(start - self.cursor):]
 
         self.chunk = self.another()
         if self.chunk:
@@ -131,6 +264,20 @@ class Indexable(object):
         """Implemented by subclasses to return the next element."""
         raise NotImplementedError
 
+    def read_chunk(self, fp, size):
+        """
+        Read up to size bytes from a file-like object into a buffer which
+        is reused for every chunk, and return a memoryview of them.
+
+        Falls back to fp.read() if fp doesn't support readinto().
+        """
+        readinto = getattr(fp, 'readinto', None)
+        if readinto is None:
+            return fp.read(size)
+        if self._buffer is None or len(self._buffer) != size:
+            self._buffer = bytearray(size)
+        return memoryview(self._buffer)[:readinto(self._buffer) or 0]
+
     def getvalue(self):
         """
         Return entire string value... used in testing
@@ -144,6 +291,49 @@ class Indexable(object):
         return self.size
 
 
+class _DriverPool(object):
+    """
+    Bounded pool of configured instances of a driver which is not
+    stateless, and so can't be shared by concurrent operations.
+
+    Instances are checked out for the duration of one operation and
+    returned afterwards. New instances are only loaded and configured
+    when no idle one is available.
+    """
+
+    def __init__(self, conf, store_entry, max_size):
+        self.conf = conf
+        self.store_entry = store_entry
+        self.max_size = max_size
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        store = _load_store(self.conf, self.store_entry, invoke_load=True)
+        store.configure()
+        return store
+
+    def put(self, store):
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(store)
+
+
+def _get_driver_pool(store, store_entry):
+    pool = _DRIVER_POOLS.get(store)
+    if pool is None:
+        with _DRIVER_POOLS_LOCK:
+            pool = _DRIVER_POOLS.get(store)
+            if pool is None:
+                max_size = store.conf.glance_store.store_driver_pool_size
+                pool = _DriverPool(store.conf, store_entry, max_size)
+                _DRIVER_POOLS[store] = pool
+    return pool
+
+
 def _load_store(conf, store_entry, invoke_load=True):
     try:
         LOG.debug("Attempting to import store %s", store_entry)
@@ -157,8 +347,10 @@ def _load_store(conf, store_entry, invoke_load=True):
                  "The driver will be disabled" % dict(driver=str([driver, e])))
 
 
-def _load_stores(conf):
-    for store_entry in set(conf.glance_store.stores):
+def _load_stores(conf, store_entries=None):
+    if store_entries is None:
+        store_entries = set(conf.glance_store.stores)
+    for store_entry in store_entries:
         try:
             # FIXME(flaper87): Don't hide BadStoreConfiguration
             # exceptions. These exceptions should be propagated
@@ -174,45 +366,229 @@ def _load_stores(conf):
             continue
 
 
+def _register_store(store_entry, store_instance):
+    """
+    Configure a loaded store and register its schemes.
+
+    :returns: the registered scheme map, or None if the store doesn't
+              implement get_schemes()
+    """
+    try:
+        schemes = store_instance.get_schemes()
+        store_instance.configure(re_raise_bsc=False)
+    except NotImplementedError:
+        return None
+    if not schemes:
+        raise exceptions.BackendException('Unable to register store %s. '
+                                          'No schemes associated with it.'
+                                          % store_entry)
+    LOG.debug("Registering store %s with schemes %s",
+              store_entry, schemes)
+
+    scheme_map = {}
+    loc_cls = store_instance.get_store_location_class()
+    for scheme in schemes:
+        scheme_map[scheme] = {
+            'store': store_instance,
+            'location_class': loc_cls,
+            'store_entry': store_entry
+        }
+    location.register_scheme_map(scheme_map)
+    return scheme_map
+
+
+def _entry_points(group):
+    """
+    Return the (name, target) of the entry points of a group, where the
+    target is the "module:attribute" they point at, without loading them.
+    """
+    if importlib_metadata is None:
+        return [(ep.name, '%s:%s' % (ep.module_name, '.'.join(ep.attrs)))
+                for ep in pkg_resources.iter_entry_points(group)]
+    entry_points = importlib_metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=group)
+    else:
+        entry_points = entry_points.get(group, [])
+    return [(ep.name, ep.value) for ep in entry_points]
+
+
+def _driver_schemes(store_entry):
+    """
+    Return the schemes of a driver declared by the glance_store.schemes
+    entry points, or None if there are none.
+    """
+    global _DRIVER_SCHEMES
+    if _DRIVER_SCHEMES is None:
+        driver_schemes = {}
+        for scheme, target in _entry_points(_SCHEMES_GROUP):
+            driver_schemes.setdefault(target, []).append(scheme)
+        _DRIVER_SCHEMES = driver_schemes
+    for name, target in _entry_points('glance_store.drivers'):
+        if name == store_entry and target in _DRIVER_SCHEMES:
+            return tuple(_DRIVER_SCHEMES[target])
+    return None
+
+
+class _LazyStore(object):
+    """
+    A store whose schemes are registered, but whose driver is only
+    imported and configured when one of them is first used.
+    """
+
+    def __init__(self, conf, store_entry, schemes):
+        self.conf = conf
+        self.store_entry = store_entry
+        self.schemes = schemes
+        self._scheme_map = None
+        self._loading = False
+        self._lock = threading.RLock()
+
+    def register(self):
+        LOG.debug("Registering store %s with schemes %s, the driver is "
+                  "loaded on first use", self.store_entry, self.schemes)
+        location.register_scheme_map(dict(
+            (scheme, _LazySchemeInfo(self, scheme))
+            for scheme in self.schemes))
+
+    def resolve(self, scheme):
+        """Return the scheme info of the scheme, loading the driver."""
+        with self._lock:
+            if self._scheme_map is None:
+                if self._loading:
+                    # Looked up by the driver while it is loaded
+                    raise exceptions.UnknownScheme(scheme=scheme)
+                self._loading = True
+                try:
+                    self._scheme_map = self._load()
+                finally:
+                    self._loading = False
+        if scheme not in self._scheme_map:
+            raise exceptions.UnknownScheme(scheme=scheme)
+        return self._scheme_map[scheme]
+
+    def _load(self):
+        # The placeholders of the schemes stay registered while the driver
+        # is loaded, so that concurrent lookups wait for it rather than
+        # find the schemes unknown. The loaded store replaces them, and
+        # those it doesn't replace are unregistered.
+        store_instance = None
+        scheme_map = None
+        try:
+            store_instance = _load_store(self.conf, self.store_entry)
+        except exceptions.BadStoreConfiguration:
+            pass
+        if store_instance is not None:
+            scheme_map = _register_store(self.store_entry, store_instance)
+
+        for scheme in self.schemes:
+            info = location.SCHEME_TO_CLS_MAP.get(scheme)
+            if (isinstance(info, _LazySchemeInfo) and
+                    info.lazy_store is self):
+                del location.SCHEME_TO_CLS_MAP[scheme]
+        if scheme_map is None:
+            LOG.warn(_("Unable to load store %s, its schemes are "
+                       "unregistered") % self.store_entry)
+            return {}
+        return scheme_map
+
+
+class _LazySchemeInfo(dict):
+    """
+    Entry of location.SCHEME_TO_CLS_MAP standing for a scheme of a
+    _LazyStore, the driver is loaded once its store or location class
+    is looked up.
+    """
+
+    def __init__(self, lazy_store, scheme):
+        super(_LazySchemeInfo, self).__init__(
+            store_entry=lazy_store.store_entry)
+        self.lazy_store = lazy_store
+        self.scheme = scheme
+
+    def __getitem__(self, key):
+        if key in ('store', 'location_class'):
+            return self.lazy_store.resolve(self.scheme)[key]
+        return super(_LazySchemeInfo, self).__getitem__(key)
+
+
 def create_stores(conf=CONF):
     """
     Registers all store modules and all schemes
     from the given config. Duplicates are not re-registered.
+
+    With store_lazy_load enabled the schemes of the drivers are
+    registered right away, but the drivers are only imported and
+    configured when they are first used.
     """
     store_count = 0
-
-    for (store_entry, store_instance) in _load_stores(conf):
-        try:
-            schemes = store_instance.get_schemes()
-            store_instance.configure(re_raise_bsc=False)
-        except NotImplementedError:
-            continue
-        if not schemes:
-            raise exceptions.BackendException('Unable to register store %s. '
-                                              'No schemes associated with it.'
-                                              % store_entry)
-        else:
-            LOG.debug("Registering store %s with schemes %s",
-                      store_entry, schemes)
-
-            scheme_map = {}
-            loc_cls = store_instance.get_store_location_class()
-            for scheme in schemes:
-                scheme_map[scheme] = {
-                    'store': store_instance,
-                    'location_class': loc_cls,
-                    'store_entry': store_entry
-                }
-            location.register_scheme_map(scheme_map)
+    store_entries = set(conf.glance_store.stores)
+
+    if conf.glance_store.store_lazy_load:
+        for store_entry in list(store_entries):
+            schemes = _driver_schemes(store_entry)
+            if schemes:
+                _LazyStore(conf, store_entry, schemes).register()
+                store_entries.remove(store_entry)
+                store_count += 1
+
+    for (store_entry, store_instance) in _load_stores(conf, store_entries):
+        if _register_store(store_entry, store_instance) is not None:
             store_count += 1
 
+    location.set_location_cache_size(
+        conf.glance_store.store_location_cache_size)
+    _configure_image_cache(conf)
+    _configure_metrics(conf)
     return store_count
 
 
+def _configure_image_cache(conf):
+    global _IMAGE_CACHE
+    _IMAGE_CACHE = None
+    if not conf.glance_store.store_cache_dir:
+        return
+    try:
+        _IMAGE_CACHE = cache.ImageCache(conf)
+    except (IOError, OSError) as e:
+        LOG.warn(_("Unable to initialize the image cache in %(dir)s, "
+                   "caching is disabled: %(e)s") %
+                 dict(dir=conf.glance_store.store_cache_dir,
+                      e=utils.exception_to_str(e)))
+
+
+def _configure_metrics(conf):
+    global _STATSD_SINK
+    if _STATSD_SINK is not None:
+        metrics.unregister_sink(_STATSD_SINK)
+        _STATSD_SINK = None
+    address = conf.glance_store.store_metrics_statsd_address
+    if not address:
+        return
+    host, _sep, port = address.rpartition(':')
+    try:
+        _STATSD_SINK = metrics.StatsdSink(host, int(port))
+    except (ValueError, IOError, OSError) as e:
+        LOG.warn(_("Unable to send store metrics to %(address)s: %(e)s") %
+                 dict(address=address, e=utils.exception_to_str(e)))
+        return
+    metrics.register_sink(_STATSD_SINK)
+
+
+def get_store_stats():
+    """
+    Return the metrics of the operations on each store, as a dict of the
+    form {scheme: {operation: stats}}, where stats is a dict with the
+    'count', 'errors', 'bytes', 'seconds' spent, 'throughput' in bytes
+    per second, and the 'p50', 'p95' and 'p99' latencies in seconds.
+    """
+    return metrics.get_stats()
+
+
 def verify_default_store():
     scheme = CONF.glance_store.default_store
     try:
-        get_store_from_scheme(scheme)
+        release_store(get_store_from_scheme(scheme))
     except exceptions.UnknownScheme:
         msg = _("Store for scheme %s not found") % scheme
         raise RuntimeError(msg)
@@ -227,52 +603,111 @@ def get_store_from_scheme(scheme):
     """
     Given a scheme, return the appropriate store object
     for handling that scheme.
+
+    Stores whose driver isn't reusable are checked out of a pool, and
+    must be handed back with release_store() once the operation they are
+    used for is done, including reading the data returned by get().
+    checked_out_store() does both.
     """
     if scheme not in location.SCHEME_TO_CLS_MAP:
         raise exceptions.UnknownScheme(scheme=scheme)
     scheme_info = location.SCHEME_TO_CLS_MAP[scheme]
     store = scheme_info['store']
     if not store.is_capable(capabilities.BitMasks.DRIVER_REUSABLE):
-        # Driver instance isn't stateless so it can't
-        # be reused safely and need recreation.
-        store_entry = scheme_info['store_entry']
-        store = _load_store(store.conf, store_entry, invoke_load=True)
-        store.configure()
-        try:
-            scheme_map = {}
-            loc_cls = store.get_store_location_class()
-            for scheme in store.get_schemes():
-                scheme_map[scheme] = {
-                    'store': store,
-                    'location_class': loc_cls,
-                    'store_entry': store_entry
-                }
-                location.register_scheme_map(scheme_map)
-        except NotImplementedError:
-            scheme_info['store'] = store
+        # Driver instance isn't stateless so it can't be shared
+        # safely, hand out an instance of its own from the pool.
+        pool = _get_driver_pool(store, scheme_info['store_entry'])
+        store = pool.get()
+        _CHECKED_OUT_STORES[store] = pool
     return store
 
 
+def release_store(store):
+    """
+    Return a store obtained from get_store_from_scheme() once the
+    operation it was used for is done, so that it can be reused.
+
+    Releasing a stateless store, or releasing a store twice, is a no-op.
+    """
+    pool = _CHECKED_OUT_STORES.pop(store, None)
+    if pool is not None:
+        pool.put(store)
+
+
+@contextlib.contextmanager
+def checked_out_store(scheme):
+    """
+    Context manager returning the store for a scheme, as
+    get_store_from_scheme() does, and releasing it on exit.
+    """
+    store = get_store_from_scheme(scheme)
+    try:
+        yield store
+    finally:
+        release_store(store)
+
+
 def get_store_from_uri(uri):
     """
     Given a URI, return the store object that would handle
     operations on the URI.
 
+    The store must be released as those of get_store_from_scheme() are.
+
     :param uri: URI to analyze
     """
     scheme = uri[0:uri.find('/') - 1]
     return get_store_from_scheme(scheme)
 
 
+class _ReleasingIterator(utils.ChunkObserver):
+    """
+    Wrapper of the data returned by get() of a checked out store, which
+    releases the store once the data is read or closed, since the data is
+    still read through the store until then. It is indexable when the data
+    is an Indexable.
+    """
+
+    def __init__(self, store, wrapped):
+        super(_ReleasingIterator, self).__init__(wrapped)
+        self.store = store
+
+    def on_end(self, complete, error):
+        release_store(self.store)
+
+
 def get_from_backend(uri, offset=0, chunk_size=None, context=None):
     """Yields chunks of data from backend specified by uri."""
 
     loc = location.get_location_from_uri(uri, conf=CONF)
     store = get_store_from_uri(uri)
 
-    return store.get(loc, offset=offset,
-                     chunk_size=chunk_size,
-                     context=context)
+    def fetch(offset=0, chunk_size=None):
+        if _IMAGE_CACHE and _IMAGE_CACHE.is_cacheable(loc.store_name):
+            return _IMAGE_CACHE.get(uri, store, loc, offset=offset,
+                                    chunk_size=chunk_size,
+                                    context=context)
+
+        return store.get(loc, offset=offset,
+                         chunk_size=chunk_size,
+                         context=context)
+
+    try:
+        if compression.is_compressed_scheme(store.conf, loc.store_name):
+            # NOTE: The offset and chunk size are those of the image data,
+            # so they can't be passed on to the store.
+            chunks, size = fetch()
+            chunks, size = compression.decompress(chunks, size,
+                                                  offset=offset,
+                                                  chunk_size=chunk_size)
+        else:
+            chunks, size = fetch(offset, chunk_size)
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            release_store(store)
+    if store not in _CHECKED_OUT_STORES:
+        return (chunks, size)
+    return (_ReleasingIterator(store, chunks), size)
 
 
 def get_size_from_backend(uri, context=None):
@@ -280,7 +715,15 @@ def get_size_from_backend(uri, context=None):
 
     loc = location.get_location_from_uri(uri, conf=CONF)
     store = get_store_from_uri(uri)
-    return store.get_size(loc, context=context)
+    try:
+        if compression.is_compressed_scheme(store.conf, loc.store_name):
+            # The uncompressed size is in the header of the image data
+            chunks, size = store.get(loc, context=context)
+            return compression.get_size(chunks, size)
+        with metrics.timed(metrics.store_scheme(store), 'get_size'):
+            return store.get_size(loc, context=context)
+    finally:
+        release_store(store)
 
 
 def delete_from_backend(uri, context=None):
@@ -288,7 +731,12 @@ def delete_from_backend(uri, context=None):
 
     loc = location.get_location_from_uri(uri, conf=CONF)
     store = get_store_from_uri(uri)
-    return store.delete(loc, context=context)
+    if _IMAGE_CACHE:
+        _IMAGE_CACHE.invalidate(uri)
+    try:
+        return store.delete(loc, context=context)
+    finally:
+        release_store(store)
 
 
 def get_store_from_location(uri):
@@ -334,10 +782,28 @@ def store_add_to_backend(image_id, data, size, store, context=None):
              the checksum of the data
              the storage systems metadata dictionary for the location
     """
-    (location, size, checksum, metadata) = store.add(image_id,
-                                                     data,
-                                                     size,
-                                                     context=context)
+    codec = compression.get_codec(store.conf, store) if size else None
+    if codec is not None:
+        reader = compression.CompressingReader(
+            data, size, codec,
+            store.conf.glance_store.store_compression_frame_size,
+            conf=store.conf)
+        # The compressed size isn't known up front. Stores which only use
+        # the size to pick how to write the data are given an upper bound.
+        bound = 0
+        if store.ACCEPTS_SIZE_UPPER_BOUND:
+            bound = reader.max_size
+        (location, _size, _checksum, metadata) = store.add(image_id,
+                                                           reader,
+                                                           bound,
+                                                           context=context)
+        checksum = reader.checksum.hexdigest()
+        metadata = dict(metadata or {}, **reader.metadata())
+    else:
+        (location, size, checksum, metadata) = store.add(image_id,
+                                                         data,
+                                                         size,
+                                                         context=context)
     if metadata is not None:
         if not isinstance(metadata, dict):
             msg = (_("The storage driver %(driver)s returned invalid "
@@ -362,7 +828,307 @@ def add_to_backend(conf, image_id, data, size, scheme=None, context=None):
     if scheme is None:
         scheme = conf['glance_store']['default_store']
     store = get_store_from_scheme(scheme)
-    return store_add_to_backend(image_id, data, size, store, context)
+    try:
+        return store_add_to_backend(image_id, data, size, store, context)
+    finally:
+        release_store(store)
+
+
+class _QueueReader(object):
+    """
+    File-like object handed to a store's add() while the image data is
+    produced by another thread.
+
+    Chunks are fed in by the thread reading the source data through a
+    bounded queue, so a store which writes slowly pauses the reader.
+    """
+
+    _EOF = object()
+    _ABORT = object()
+
+    def __init__(self, max_chunks):
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = bytearray()
+        self._eof = False
+        self._closed = False
+
+    def feed(self, chunk):
+        """
+        Queue a chunk of data, blocking while the queue is full.
+
+        :return: False if the reader was closed and wants no more data
+        """
+        if self._closed:
+            return False
+        self._queue.put(chunk)
+        return True
+
+    def finish(self):
+        self.feed(self._EOF)
+
+    def abort(self):
+        self.feed(self._ABORT)
+
+    def _next_chunk(self):
+        chunk = self._queue.get()
+        if chunk is self._ABORT:
+            self._eof = True
+            raise exceptions.BackendException(
+                _("Reading the image data was aborted"))
+        if chunk is self._EOF:
+            self._eof = True
+            return b''
+        return chunk
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def drain(self):
+        """Discard data until the source is exhausted or aborted."""
+        del self._buffer[:]
+        while not self._eof:
+            try:
+                self._next_chunk()
+            except exceptions.BackendException:
+                pass
+
+    def close(self):
+        """Stop accepting data and unblock the thread feeding it."""
+        self._closed = True
+        self._eof = True
+        del self._buffer[:]
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+
+def add_to_backends(conf, image_id, data, size, schemes, context=None):
+    """
+    Add the same image data to several stores, reading it only once.
+
+    The data is read from `data` in a single pass and written to every
+    store concurrently. Each store buffers at most
+    ``store_fanout_buffer_size`` bytes, so the slowest store sets the
+    pace of the whole operation.
+
+    If adding the image to any store fails, the data already written to
+    the other stores is deleted and the first error is raised.
+
+    :param data: The file-like object to read the image data from
+    :param size: The length of the data in bytes, or 0 if unknown
+    :param schemes: The schemes of the stores to add the image to
+    :return: A list of (location, size, checksum, metadata) tuples, one
+             per scheme, which all share the checksum of the source data
+    """
+    chunk_size = 64 * units.Ki
+    max_chunks = max(1, conf.glance_store.store_fanout_buffer_size //
+                     chunk_size)
+    stores = []
+    try:
+        for scheme in schemes:
+            stores.append(get_store_from_scheme(scheme))
+
+        readers = [_QueueReader(max_chunks) for store in stores]
+        results = [None] * len(stores)
+        # Failures in the order they happened, the first is the cause
+        errors = []
+
+        def add(index):
+            reader = readers[index]
+            try:
+                results[index] = store_add_to_backend(
+                    image_id, reader, size, stores[index], context)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                reader.drain()
+
+        threads = [threading.Thread(target=add, args=(index,))
+                   for index in range(len(stores))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        checksum = hashlib.md5()
+        error = None
+        try:
+            for chunk in utils.chunkreadable(data, chunk_size):
+                if errors:
+                    break
+                checksum.update(chunk)
+                for reader in readers:
+                    reader.feed(chunk)
+        except Exception as e:
+            LOG.error(_("Failed to read image data for %(image)s: %(e)s") %
+                      dict(image=image_id, e=utils.exception_to_str(e)))
+            error = e
+        for reader in readers:
+            if error is not None or errors:
+                reader.abort()
+            else:
+                reader.finish()
+        for thread in threads:
+            thread.join()
+    finally:
+        for store in stores:
+            release_store(store)
+
+    checksum = checksum.hexdigest()
+    if error is None and errors:
+        error = errors[0]
+    if error is None:
+        for scheme, result in zip(schemes, results):
+            if result[2] != checksum:
+                error = exceptions.BackendException(
+                    _("The %(scheme)s store returned checksum %(actual)s "
+                      "for image %(image)s, expected %(expected)s") %
+                    dict(scheme=scheme, actual=result[2], image=image_id,
+                         expected=checksum))
+                break
+
+    if error is not None:
+        for result in results:
+            if result is not None:
+                _delete_quietly(result[0], context=context)
+        raise error
+    return results
+
+
+def _delete_quietly(uri, context=None):
+    try:
+        delete_from_backend(uri, context=context)
+    except Exception as e:
+        LOG.warn(_("Unable to delete image data at %(uri)s: %(e)s") %
+                 dict(uri=uri, e=utils.exception_to_str(e)))
+
+
+def _clone_within_store(src_uri, dst_scheme, image_id, checksum, context,
+                        conf):
+    """
+    Have the store holding the image data copy it itself, when it is the
+    destination store too.
+
+    :return: The (location, size, checksum, metadata) tuple, or None if
+             the store can't copy the data itself
+    """
+    if src_uri[0:src_uri.find('/') - 1] != dst_scheme:
+        return None
+    loc = location.get_location_from_uri(src_uri, conf=CONF)
+    store = get_store_from_scheme(dst_scheme)
+    try:
+        result = store.clone(loc, image_id, context=context)
+    finally:
+        release_store(store)
+    if result is None:
+        return None
+
+    uri, size, store_checksum, metadata = result
+    try:
+        if compression.is_compressed_scheme(conf, loc.store_name):
+            # The data was copied as stored, possibly compressed
+            size = get_size_from_backend(uri, context=context)
+        if checksum is None:
+            checksum = store_checksum
+        if checksum is None:
+            digests = utils.Checksum(conf)
+            chunks = get_from_backend(uri, context=context)[0]
+            for chunk in chunks:
+                digests.update(chunk)
+            checksum = digests.hexdigest()
+            metadata = dict(metadata or {}, **digests.metadata())
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            _delete_quietly(uri, context=context)
+    return uri, size, checksum, metadata
+
+
+def copy_between_stores(src_uri, dst_scheme, image_id, context=None,
+                        conf=CONF, checksum=None):
+    """
+    Copy image data from a location to another store.
+
+    When the image data is in the destination store already, the store
+    is asked to copy it itself first, which the filesystem store does
+    with a reflink or in the kernel.
+
+    Otherwise the source data is read on a separate thread and handed to
+    the destination store through a queue of at most
+    ``store_fanout_buffer_size`` bytes, so reading from the source and
+    writing to the destination overlap.
+
+    :param src_uri: The location URI of the image data to copy
+    :param dst_scheme: The scheme of the store to copy the data to
+    :param image_id: The image ID to use in the destination store
+    :param checksum: The known checksum of the image data, returned when
+                     a store copies the data itself instead of it being
+                     read again to compute it
+    :return: The (location, size, checksum, metadata) tuple returned by
+             the destination store
+    """
+    result = _clone_within_store(src_uri, dst_scheme, image_id, checksum,
+                                 context, conf)
+    if result is not None:
+        return result
+
+    chunk_size = 64 * units.Ki
+    max_chunks = max(1, conf.glance_store.store_fanout_buffer_size //
+                     chunk_size)
+
+    data, size = get_from_backend(src_uri, context=context)
+    reader = _QueueReader(max_chunks)
+    errors = []
+
+    def produce():
+        try:
+            for chunk in data:
+                if not reader.feed(chunk):
+                    break
+        except Exception as e:
+            errors.append(e)
+            reader.abort()
+        else:
+            reader.finish()
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        result = add_to_backend(conf, image_id, reader, size,
+                                scheme=dst_scheme, context=context)
+    except Exception:
+        reader.close()
+        thread.join()
+        if errors:
+            LOG.error(_("Failed to read image data from %(uri)s: %(e)s") %
+                      dict(uri=src_uri, e=utils.exception_to_str(errors[0])))
+            raise errors[0]
+        raise
+    reader.close()
+    thread.join()
+
+    if size and result[1] != size:
+        _delete_quietly(result[0], context=context)
+        msg = (_("Copied %(copied)d bytes of image %(image)s to the "
+                 "%(scheme)s store, expected %(size)d") %
+               dict(copied=result[1], image=image_id, scheme=dst_scheme,
+                    size=size))
+        LOG.error(msg)
+        raise exceptions.BackendException(msg)
+    return result
 
 
 def set_acls(location_uri, public=False, read_tenants=[],
@@ -381,3 +1147,5 @@ def set_acls(location_uri, public=False, read_tenants=[],
                        context=context)
     except NotImplementedError:
         LOG.debug(_("Skipping store.set_acls... not implemented."))
+    finally:
+        release_store(store)
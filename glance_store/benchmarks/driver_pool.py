@@ -0,0 +1,63 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the per-operation overhead of obtaining a driver instance for a
+store which is not DRIVER_REUSABLE, with and without the driver pool.
+
+Usage: python -m glance_store.benchmarks.driver_pool [store] [iterations]
+"""
+
+import sys
+import timeit
+
+from oslo_config import cfg
+
+import glance_store as store
+from glance_store import backend
+
+
+def _time_checkout(conf, scheme, pool_size, iterations):
+    conf.set_override('store_driver_pool_size', pool_size,
+                      group='glance_store')
+    store.create_stores(conf)
+
+    def checkout():
+        backend.release_store(backend.get_store_from_scheme(scheme))
+
+    checkout()
+    return timeit.timeit(checkout, number=iterations) / iterations
+
+
+def main():
+    scheme = sys.argv[1] if len(sys.argv) > 1 else 'rbd'
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    conf = cfg.ConfigOpts()
+    conf(args=[])
+    store.register_opts(conf)
+    conf.set_override('stores', [scheme], group='glance_store')
+    conf.set_override('default_store', scheme, group='glance_store')
+
+    unpooled = _time_checkout(conf, scheme, 0, iterations)
+    pooled = _time_checkout(conf, scheme, 10, iterations)
+    print("%s: %d iterations" % (scheme, iterations))
+    print("  without pool: %8.2f us/op" % (unpooled * 1e6))
+    print("  with pool:    %8.2f us/op" % (pooled * 1e6))
+    print("  speedup:      %8.1fx" % (unpooled / pooled))
+
+
+if __name__ == '__main__':
+    main()
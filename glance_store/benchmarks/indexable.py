@@ -0,0 +1,102 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the copies made while an Indexable is sent the way eventlet's
+GreenSocket.sendall() sends it in copy-from flows: by indexing past the
+bytes each send() took, which is rarely a whole chunk.
+
+Usage: python -m glance_store.benchmarks.indexable [chunk_size] [send_size]
+"""
+
+import sys
+import time
+import tracemalloc
+
+import six
+
+from glance_store import backend
+from glance_store.benchmarks import runner
+
+IMAGE_SIZE = 64 << 20
+
+
+class _FileIndexable(backend.Indexable):
+    """Reads the chunks into a reused buffer and hands out views."""
+
+    chunk_size = None
+
+    def another(self):
+        return self.read_chunk(self.wrapped, self.chunk_size)
+
+
+class _CopyingFileIndexable(backend.Indexable):
+    """Behaves as Indexable did before it handed out memoryviews."""
+
+    chunk_size = None
+    copied = 0
+
+    def another(self):
+        return self.wrapped.read(self.chunk_size)
+
+    def __getitem__(self, i):
+        start = i.start if isinstance(i, slice) else i
+        if start < self.cursor:
+            tail = self.chunk[(start - self.cursor):]
+            self.copied += len(tail)
+            return tail
+        return super(_CopyingFileIndexable, self).__getitem__(i)
+
+
+def _sendall(data, send_size):
+    # GreenSocket.sendall(), with a socket taking send_size bytes a time
+    tail = 0
+    while tail < len(data):
+        tail += min(len(data[tail:]), send_size)
+
+
+def _measure(indexable_class, data, chunk_size, send_size):
+    indexable = indexable_class(six.BytesIO(data), len(data))
+    indexable.chunk_size = chunk_size
+    tracemalloc.start()
+    start = time.time()
+    _sendall(indexable, send_size)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, getattr(indexable, 'copied', 0)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    chunk_size = runner.parse_size(argv[0]) if argv else 8 << 20
+    send_size = runner.parse_size(argv[1]) if len(argv) > 1 else 64 << 10
+    data = b'x' * IMAGE_SIZE
+
+    print("Sending %s in %s chunks, %s per send()" %
+          (runner.format_size(IMAGE_SIZE), runner.format_size(chunk_size),
+           runner.format_size(send_size)))
+    for name, indexable_class in (('copying slices', _CopyingFileIndexable),
+                                  ('memoryviews', _FileIndexable)):
+        elapsed, peak, copied = _measure(indexable_class, data, chunk_size,
+                                         send_size)
+        print("  %-15s %8.3fs %8.1f MiB/s  peak alloc %8.1f MiB  "
+              "tail copies %10.1f MiB" %
+              (name, elapsed, IMAGE_SIZE / elapsed / (1 << 20),
+               peak / float(1 << 20), copied / float(1 << 20)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the lookup of the filesystem store metadata of the mountpoint of
+an image path, made on every add(), as the number of mountpoints grows.
+
+Usage: python -m glance_store.benchmarks.metadata_lookup [lookups]
+"""
+
+import sys
+import time
+import uuid
+
+from glance_store._drivers import filesystem
+
+MOUNTPOINT_COUNTS = (1, 10, 50, 200, 1000)
+
+
+def _linear_scan(metadata, path):
+    # _get_metadata() before the index
+    for image_meta in metadata:
+        if path.startswith(image_meta['mountpoint']):
+            return image_meta
+    return None
+
+
+def _metadata(count):
+    return [{'id': 'share%d' % i, 'mountpoint': '/mnt/nfs/share%04d' % i}
+            for i in range(count)]
+
+
+def _measure(lookup, paths):
+    start = time.time()
+    for path in paths:
+        lookup(path)
+    return (time.time() - start) / len(paths)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    lookups = int(argv[0]) if argv else 20000
+    print("%d lookups of paths in the last mountpoint" % lookups)
+    print('%11s %12s %12s %12s' % ('mountpoints', 'scan us', 'index us',
+                                   'cached us'))
+    for count in MOUNTPOINT_COUNTS:
+        metadata = _metadata(count)
+        datadir = metadata[-1]['mountpoint']
+        paths = ['%s/%s' % (datadir, uuid.uuid4()) for _i in range(lookups)]
+        index = filesystem.MountpointIndex(metadata)
+        index.datadirs[datadir] = index.lookup(paths[0])
+
+        scan = _measure(lambda path: _linear_scan(metadata, path), paths)
+        indexed = _measure(index.lookup, paths)
+        cached = _measure(lambda path: index.datadirs[datadir], paths)
+        print('%11d %12.3f %12.3f %12.3f' %
+              (count, scan * 1e6, indexed * 1e6, cached * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the add, get and delete throughput and latency of the drivers
+against local stand-ins of their storage systems.
+
+Every combination of driver, image size, chunk size and concurrency is
+run in a child process of its own, so that its peak RSS can be reported.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from oslo_config import cfg
+import six
+
+import glance_store
+from glance_store import backend
+from glance_store.benchmarks import standins
+
+_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def parse_size(value):
+    """Parse a size such as 64K, 16M or 1G into a number of bytes."""
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    suffix = value[-1:] if value[-1:] in _UNITS else ''
+    return int(value[:len(value) - len(suffix)]) * _UNITS[suffix]
+
+
+def format_size(size):
+    for suffix in ('G', 'M', 'K'):
+        if size >= _UNITS[suffix] and size % _UNITS[suffix] == 0:
+            return '%d%s' % (size // _UNITS[suffix], suffix)
+    return str(size)
+
+
+def _percentile(latencies, percent):
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    index = int(round(percent / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def _run_phase(concurrency, jobs, func):
+    """
+    Run func on every job using `concurrency` threads and return the
+    wall clock time, the latencies and the number of bytes moved.
+    """
+    jobs = list(jobs)
+    latencies = []
+    moved = [0]
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not jobs or errors:
+                    return
+                job = jobs.pop()
+            start = time.time()
+            try:
+                nbytes = func(job)
+            except Exception:
+                with lock:
+                    errors.append(traceback.format_exc())
+                return
+            with lock:
+                latencies.append(time.time() - start)
+                moved[0] += nbytes
+
+    threads = [threading.Thread(target=worker) for _i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError(errors[0])
+    return time.time() - start, latencies, moved[0]
+
+
+def _phase_result(elapsed, latencies, nbytes):
+    return {'ops': len(latencies),
+            'seconds': elapsed,
+            'throughput': nbytes / elapsed if elapsed else 0.0,
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99)}
+
+
+def run_case(driver, image_size, chunk_size, concurrency, iterations):
+    """
+    Run one benchmark case in the current process.
+
+    `iterations` images are added by each of the `concurrency` threads,
+    then read back and deleted.
+
+    :returns: a dict with the results of the 'add', 'get' and 'delete'
+              phases, and the 'peak_rss' of the process in KiB
+    """
+    conf = cfg.CONF
+    conf(args=[], project='glance_store-benchmark')
+    glance_store.register_opts(conf)
+
+    standin = standins.STANDINS[driver]()
+    standin.start(conf)
+    try:
+        conf.set_override('stores', [standin.store], group='glance_store')
+        conf.set_override('default_store', standin.scheme,
+                          group='glance_store')
+        standin.set_chunk_size(conf, chunk_size)
+        glance_store.create_stores(conf)
+
+        data = os.urandom(image_size)
+        image_ids = [str(uuid.uuid4())
+                     for _i in range(iterations * concurrency)]
+        uris = {}
+        results = {}
+
+        def add(image_id):
+            uri = backend.add_to_backend(conf, image_id,
+                                         six.BytesIO(data), image_size)[0]
+            uris[image_id] = uri
+            return image_size
+
+        def get(image_id):
+            chunks, size = backend.get_from_backend(uris[image_id])
+            return sum(len(chunk) for chunk in chunks)
+
+        def delete(image_id):
+            backend.delete_from_backend(uris[image_id])
+            return 0
+
+        if standin.read_only:
+            for image_id in image_ids:
+                uris[image_id] = standin.put(image_id, data)
+        else:
+            results['add'] = _phase_result(
+                *_run_phase(concurrency, image_ids, add))
+        results['get'] = _phase_result(*_run_phase(concurrency, image_ids,
+                                                   get))
+        if not standin.read_only:
+            results['delete'] = _phase_result(
+                *_run_phase(concurrency, image_ids, delete))
+    finally:
+        standin.stop()
+
+    results['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def _run_case_in_child(queue, args):
+    try:
+        queue.put(('ok', run_case(*args)))
+    except standins.Unavailable as e:
+        queue.put(('unavailable', str(e)))
+    except Exception:
+        queue.put(('error', traceback.format_exc()))
+
+
+def run_isolated(*args):
+    """
+    Run a benchmark case in a child process.
+
+    :returns: a tuple of the status ('ok', 'unavailable' or 'error') and
+              the results of run_case() or a description of the problem
+    """
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_case_in_child,
+                                    args=(queue, args))
+    child.start()
+    result = queue.get()
+    child.join()
+    return result
+
+
+def _print_header():
+    print('%-7s %6s %6s %4s %-6s %6s %10s %9s %9s %9s %9s' %
+          ('driver', 'size', 'chunk', 'conc', 'op', 'ops', 'MiB/s',
+           'p50 ms', 'p95 ms', 'p99 ms', 'rss MiB'))
+
+
+def _print_case(case, status, result):
+    prefix = '%-7s %6s %6s %4d' % (case['driver'],
+                                   format_size(case['image_size']),
+                                   format_size(case['chunk_size']),
+                                   case['concurrency'])
+    if status != 'ok':
+        print('%s %s: %s' % (prefix, status, result.strip().splitlines()[-1]))
+        return
+    for op in ('add', 'get', 'delete'):
+        if op not in result:
+            continue
+        stats = result[op]
+        print('%s %-6s %6d %10.1f %9.2f %9.2f %9.2f %9.1f' %
+              (prefix, op, stats['ops'], stats['throughput'] / (1 << 20),
+               stats['p50'] * 1000, stats['p95'] * 1000,
+               stats['p99'] * 1000, result['peak_rss'] / 1024.0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the glance_store drivers against local '
+                    'stand-ins of their storage systems.')
+    parser.add_argument('--drivers', default=','.join(sorted(
+        standins.STANDINS)),
+        help='Comma separated drivers to benchmark (default: %(default)s)')
+    parser.add_argument('--sizes', default='1M,16M',
+                        help='Comma separated image sizes '
+                             '(default: %(default)s)')
+    parser.add_argument('--chunk-sizes', default='64K,1M',
+                        help='Comma separated READ_CHUNKSIZE and '
+                             'WRITE_CHUNKSIZE values (default: %(default)s)')
+    parser.add_argument('--concurrency', default='1,4',
+                        help='Comma separated numbers of concurrent '
+                             'operations (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=4,
+                        help='Images added, read and deleted by each '
+                             'thread (default: %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    args = parser.parse_args(argv)
+
+    drivers = [d.strip() for d in args.drivers.split(',') if d.strip()]
+    for driver in drivers:
+        if driver not in standins.STANDINS:
+            parser.error('unknown driver %s' % driver)
+
+    cases = []
+    for driver in drivers:
+        for image_size in args.sizes.split(','):
+            for chunk_size in args.chunk_sizes.split(','):
+                for concurrency in args.concurrency.split(','):
+                    cases.append({'driver': driver,
+                                  'image_size': parse_size(image_size),
+                                  'chunk_size': parse_size(chunk_size),
+                                  'concurrency': int(concurrency)})
+
+    if not args.json:
+        _print_header()
+    report = []
+    failed = False
+    for case in cases:
+        status, result = run_isolated(case['driver'], case['image_size'],
+                                      case['chunk_size'],
+                                      case['concurrency'], args.iterations)
+        failed = failed or status == 'error'
+        if args.json:
+            report.append(dict(case, status=status, result=result))
+        else:
+            _print_case(case, status, result)
+            sys.stdout.flush()
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
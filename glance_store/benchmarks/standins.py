@@ -0,0 +1,563 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Local stand-ins for the storage systems behind each driver.
+
+Each stand-in configures the glance_store options of its driver to use a
+local replacement of the real storage system: a directory on tmpfs for
+the filesystem store, in-process HTTP servers speaking enough of the
+HTTP, Swift, S3 and vSphere datastore protocols, and in-memory rados and
+rbd modules.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves import urllib
+
+
+class Unavailable(Exception):
+    """The driver or a library it needs can't be used here."""
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = []
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                if not length:
+                    self.rfile.readline()
+                    return b''.join(body)
+                body.append(self.rfile.read(length))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _dispatch(self):
+        body = self._read_body() if self.command == 'PUT' else b''
+        url = urllib.parse.urlsplit(self.path)
+        status, headers, data = self.server.standin.handle(
+            self.command, urllib.parse.unquote(url.path), url.query,
+            self.headers, body)
+        if self.command != 'HEAD':
+            headers.setdefault('Content-Length', str(len(data)))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_GET = do_HEAD = do_PUT = do_DELETE = do_POST = _dispatch
+
+
+def _get_object(objects, path, method, headers):
+    """Serve a GET or HEAD of an object, honouring byte ranges."""
+    data = objects.get(path)
+    if data is None:
+        return 404, {}, b''
+    etag = hashlib.md5(data).hexdigest()
+    response = {'ETag': '"%s"' % etag, 'Accept-Ranges': 'bytes',
+                'Last-Modified': 'Thu, 01 Jan 2015 00:00:00 GMT',
+                'Content-Type': 'application/octet-stream',
+                'Content-Length': str(len(data))}
+    match = re.match(r'bytes=(\d+)-(\d*)$', headers.get('Range') or '')
+    status = 200
+    if match:
+        start = int(match.group(1))
+        end = int(match.group(2) or len(data) - 1)
+        data = data[start:end + 1]
+        response['Content-Length'] = str(len(data))
+        response['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, start + len(data) - 1, len(objects[path]))
+        status = 206
+    return status, response, (b'' if method == 'HEAD' else data)
+
+
+class StandIn(object):
+
+    """
+    Base class of the stand-ins.
+
+    :cvar store: name of the store in the `stores` option
+    :cvar scheme: scheme of the locations returned by the store
+    :cvar read_only: True if images have to be put in place by the
+                     stand-in since the driver can't add them
+    """
+
+    store = None
+    scheme = None
+    read_only = False
+
+    def start(self, conf):
+        """Start the stand-in and point the driver options at it."""
+
+    def stop(self):
+        """Stop the stand-in and release what it used."""
+
+    def set_chunk_size(self, conf, chunk_size):
+        """Make the driver read and write data in chunks of this size."""
+
+    def put(self, image_id, data):
+        """Put an image in place for a read-only driver, return its URI."""
+        raise NotImplementedError()
+
+    @staticmethod
+    def _override(conf, **kwargs):
+        for name, value in kwargs.items():
+            conf.set_override(name, value, group='glance_store')
+
+    @staticmethod
+    def _set_class_chunk_size(store_class, chunk_size):
+        store_class.READ_CHUNKSIZE = chunk_size
+        store_class.WRITE_CHUNKSIZE = chunk_size
+
+
+class HTTPServerStandIn(StandIn):
+
+    """A stand-in backed by an in-process HTTP server."""
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self, conf):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.standin = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def address(self):
+        return '127.0.0.1:%d' % self.server.server_address[1]
+
+    def handle(self, method, path, query, headers, body):
+        if method in ('GET', 'HEAD'):
+            return _get_object(self.objects, path, method, headers)
+        if method == 'PUT':
+            with self.lock:
+                self.objects[path] = body
+            return 201, {'ETag': '"%s"' % hashlib.md5(body).hexdigest()}, b''
+        if method == 'DELETE':
+            with self.lock:
+                found = self.objects.pop(path, None) is not None
+            return (204 if found else 404), {}, b''
+        return 405, {}, b''
+
+
+class FilesystemStandIn(StandIn):
+
+    """The filesystem store writing to a directory on tmpfs."""
+
+    store = 'file'
+    scheme = 'file'
+
+    def start(self, conf):
+        shm = '/dev/shm'
+        parent = shm if os.access(shm, os.W_OK) else None
+        self.datadir = tempfile.mkdtemp(prefix='glance-store-bench-',
+                                        dir=parent)
+        self._override(conf, filesystem_store_datadir=self.datadir)
+
+    def stop(self):
+        shutil.rmtree(self.datadir, ignore_errors=True)
+
+    def set_chunk_size(self, conf, chunk_size):
+        from glance_store._drivers import filesystem
+        self._set_class_chunk_size(filesystem.Store, chunk_size)
+
+
+class HTTPStandIn(HTTPServerStandIn):
+
+    """The read-only http store reading from an HTTP server."""
+
+    store = 'http'
+    scheme = 'http'
+    read_only = True
+
+    def put(self, image_id, data):
+        path = '/images/%s' % image_id
+        with self.lock:
+            self.objects[path] = data
+        return 'http://%s%s' % (self.address, path)
+
+    def set_chunk_size(self, conf, chunk_size):
+        from glance_store._drivers import http
+        self._set_class_chunk_size(http.Store, chunk_size)
+
+
+class SwiftStandIn(HTTPServerStandIn):
+
+    """The swift store talking to a fake Swift with v1 authentication."""
+
+    store = 'swift'
+    scheme = 'swift+http'
+    ACCOUNT = '/v1/AUTH_bench'
+
+    def start(self, conf):
+        try:
+            from glance_store._drivers.swift import store  # noqa
+        except Exception as e:
+            raise Unavailable(str(e))
+        super(SwiftStandIn, self).start(conf)
+        self.containers = set()
+        self._override(conf, swift_store_auth_version='1',
+                       swift_store_auth_address='http://%s/auth/v1.0' %
+                       self.address,
+                       swift_store_user='bench:bench',
+                       swift_store_key='key',
+                       swift_store_container='glance',
+                       swift_store_create_container_on_put=True)
+
+    def handle(self, method, path, query, headers, body):
+        if path.startswith('/auth/'):
+            return 200, {'X-Storage-Url': 'http://%s%s' % (self.address,
+                                                           self.ACCOUNT),
+                         'X-Auth-Token': 'token'}, b''
+        parts = path[len(self.ACCOUNT):].strip('/').split('/', 1)
+        if len(parts) == 1:
+            if method == 'PUT':
+                self.containers.add(parts[0])
+                return 201, {}, b''
+            return (204 if parts[0] in self.containers else 404), {}, b''
+        return super(SwiftStandIn, self).handle(method, path, query,
+                                                headers, body)
+
+    def set_chunk_size(self, conf, chunk_size):
+        from glance_store._drivers.swift import store
+        store.Store.CHUNKSIZE = chunk_size
+        self._set_class_chunk_size(store.Store, chunk_size)
+
+
+class S3StandIn(HTTPServerStandIn):
+
+    """The s3 store talking to a fake S3 with path-style buckets."""
+
+    store = 's3'
+    scheme = 's3'
+
+    def start(self, conf):
+        try:
+            import boto.s3.connection  # noqa
+        except ImportError as e:
+            raise Unavailable(str(e))
+        super(S3StandIn, self).start(conf)
+        self.buckets = set()
+        self._override(conf, s3_store_host=self.address,
+                       s3_store_access_key='access',
+                       s3_store_secret_key='secret',
+                       s3_store_bucket='glance',
+                       s3_store_bucket_url_format='path',
+                       s3_store_create_bucket_on_put=True)
+
+    def handle(self, method, path, query, headers, body):
+        parts = path.strip('/').split('/', 1)
+        if len(parts) == 1:
+            if method == 'PUT':
+                self.buckets.add(parts[0])
+                return 200, {}, b''
+            return (200 if parts[0] in self.buckets else 404), {}, b''
+        status, headers, data = super(S3StandIn, self).handle(
+            method, path, query, headers, body)
+        if method == 'PUT':
+            status = 200
+        return status, headers, data
+
+    def set_chunk_size(self, conf, chunk_size):
+        from glance_store._drivers import s3
+        self._set_class_chunk_size(s3.Store, chunk_size)
+
+
+class _FakeCookie(object):
+    name = 'vmware_soap_session'
+    value = 'bench'
+
+
+class _FakeVim(object):
+
+    class client(object):
+        class options(object):
+            class transport(object):
+                cookiejar = [_FakeCookie()]
+
+    class service_content(object):
+        fileManager = None
+
+
+class _FakeDatastore(object):
+
+    class datacenter(object):
+        path = 'dc1'
+
+    name = 'ds1'
+    ref = None
+    freespace = 1 << 60
+
+
+class _FakeVMwareSession(object):
+
+    def __init__(self, standin):
+        self.standin = standin
+        self.vim = _FakeVim()
+
+    def is_current_session_active(self):
+        return True
+
+    def invoke_api(self, module, method, *args, **kwargs):
+        if method == 'DeleteDatastoreFile_Task':
+            # '[ds1] openstack_glance/<id>' -> '/folder/openstack_glance/<id>'
+            path = '/folder/' + kwargs['name'].split('] ', 1)[1]
+            with self.standin.lock:
+                self.standin.objects.pop(path, None)
+
+    def wait_for_task(self, task):
+        pass
+
+
+class VMwareStandIn(HTTPServerStandIn):
+
+    """
+    The vmware store uploading to and downloading from an HTTP server
+    which plays the part of the datastore. The vSphere API session is
+    faked, so only the data path of the driver is measured.
+    """
+
+    store = 'vmware'
+    scheme = 'vsphere'
+
+    def start(self, conf):
+        from glance_store._drivers import vmware_datastore as vm_store
+        super(VMwareStandIn, self).start(conf)
+        standin = self
+
+        class FakeAPI(object):
+            @staticmethod
+            def VMwareAPISession(*args, **kwargs):
+                return _FakeVMwareSession(standin)
+
+        self._saved = (vm_store.api,
+                       vm_store.Store._build_datastore_weighted_map,
+                       vm_store.Store._get_freespace,
+                       vm_store.Store._get_datacenter)
+        vm_store.api = FakeAPI
+        vm_store.Store._build_datastore_weighted_map = (
+            lambda self, datastores: {0: [_FakeDatastore()]})
+        vm_store.Store._get_freespace = lambda self, ds: ds.freespace
+        vm_store.Store._get_datacenter = lambda self, path: _FakeDatastore()
+        self._override(conf, vmware_server_host=self.address,
+                       vmware_server_username='bench',
+                       vmware_server_password='bench',
+                       vmware_api_insecure=True,
+                       vmware_datastore_name='ds1',
+                       vmware_datacenter_path='dc1')
+
+    def stop(self):
+        from glance_store._drivers import vmware_datastore as vm_store
+        (vm_store.api,
+         vm_store.Store._build_datastore_weighted_map,
+         vm_store.Store._get_freespace,
+         vm_store.Store._get_datacenter) = self._saved
+        super(VMwareStandIn, self).stop()
+
+    def set_chunk_size(self, conf, chunk_size):
+        from glance_store._drivers import vmware_datastore as vm_store
+        self._set_class_chunk_size(vm_store.Store, chunk_size)
+
+
+class _FakeRados(object):
+
+    """In-memory replacement of the rados module."""
+
+    class ObjectNotFound(Exception):
+        pass
+
+    class Ioctx(object):
+
+        def __init__(self, pool):
+            self.pool = pool
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def close(self):
+            pass
+
+    class Rados(object):
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def connect(self):
+            pass
+
+        def shutdown(self):
+            pass
+
+        def get_fsid(self):
+            return 'bench-fsid'
+
+        def conf_get(self, name):
+            return None
+
+        def open_ioctx(self, pool):
+            return _FakeRados.Ioctx(pool)
+
+
+class _FakeRBD(object):
+
+    """In-memory replacement of the rbd module."""
+
+    RBD_FEATURE_LAYERING = 1
+    images = {}
+    lock = threading.Lock()
+
+    class ImageExists(Exception):
+        pass
+
+    class ImageNotFound(Exception):
+        pass
+
+    class ImageBusy(Exception):
+        pass
+
+    class RBD(object):
+
+        def create(self, ioctx, name, size, order, old_format=True,
+                   features=0):
+            key = (ioctx.pool, name)
+            with _FakeRBD.lock:
+                if key in _FakeRBD.images:
+                    raise _FakeRBD.ImageExists()
+                _FakeRBD.images[key] = bytearray(size)
+
+        def remove(self, ioctx, name):
+            with _FakeRBD.lock:
+                if _FakeRBD.images.pop((ioctx.pool, name), None) is None:
+                    raise _FakeRBD.ImageNotFound()
+
+    class Image(object):
+
+        def __init__(self, ioctx, name, snapshot=None):
+            try:
+                self.data = _FakeRBD.images[(ioctx.pool, name)]
+            except KeyError:
+                raise _FakeRBD.ImageNotFound()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def stat(self):
+            return {'size': len(self.data)}
+
+        def size(self):
+            return len(self.data)
+
+        def resize(self, size):
+            if size > len(self.data):
+                self.data.extend(bytearray(size - len(self.data)))
+            else:
+                del self.data[size:]
+
+        def write(self, data, offset):
+            self.data[offset:offset + len(data)] = data
+            return len(data)
+
+        def read(self, offset, length):
+            return bytes(self.data[offset:offset + length])
+
+        def create_snap(self, name):
+            pass
+
+        def protect_snap(self, name):
+            pass
+
+        def unprotect_snap(self, name):
+            pass
+
+        def remove_snap(self, name):
+            pass
+
+
+class RBDStandIn(StandIn):
+
+    """The rbd store using in-memory rados and rbd modules."""
+
+    store = 'rbd'
+    scheme = 'rbd'
+
+    def start(self, conf):
+        from glance_store._drivers import rbd
+        self._saved = (rbd.rados, rbd.rbd)
+        rbd.rados, rbd.rbd = _FakeRados, _FakeRBD
+
+    def stop(self):
+        from glance_store._drivers import rbd
+        rbd.rados, rbd.rbd = self._saved
+        _FakeRBD.images.clear()
+
+    def set_chunk_size(self, conf, chunk_size):
+        # NOTE: The rbd chunk size is configured in MiB and sets the
+        # object size of the images, so it is never less than 1MiB.
+        self._override(conf, rbd_store_chunk_size=max(1, chunk_size >> 20))
+
+
+STANDINS = {
+    'file': FilesystemStandIn,
+    'http': HTTPStandIn,
+    'swift': SwiftStandIn,
+    's3': S3StandIn,
+    'rbd': RBDStandIn,
+    'vmware': VMwareStandIn,
+}
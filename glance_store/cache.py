@@ -0,0 +1,313 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A read-through local disk cache for image data.
+
+Image data read from a remote store (swift, s3, rbd, http, ...) is written
+to a local cache directory while it is streamed to the caller. Subsequent
+reads of the same location are then served straight from local disk.
+
+Cached files are named after a digest of the location URI, so credentials
+which may be embedded in the URI never end up on the local filesystem.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from glance_store.common import utils
+from glance_store import i18n
+
+LOG = logging.getLogger(__name__)
+_ = i18n._
+_LW = i18n._LW
+
+# NOTE: A fill which has not written anything for this many seconds is
+# assumed to belong to a dead process and may be removed.
+STALE_FILL_AGE = 60 * 60
+
+
+class ImageCache(object):
+
+    """
+    Bounded, read-through cache of image data on local disk.
+
+    The total size of the cached data is kept below
+    ``store_cache_max_size`` bytes by evicting entries according to
+    ``store_cache_eviction_policy`` ('lru' or 'lfu').
+    """
+
+    READ_CHUNKSIZE = 64 * 1024
+
+    def __init__(self, conf):
+        self.conf = conf
+        glance_conf = conf.glance_store
+        self.cache_dir = glance_conf.store_cache_dir
+        self.incomplete_dir = os.path.join(self.cache_dir, 'incomplete')
+        self.max_size = glance_conf.store_cache_max_size
+        self.policy = glance_conf.store_cache_eviction_policy
+        self.schemes = set(glance_conf.store_cache_schemes)
+
+        self._lock = threading.Lock()
+        # Cache entry name -> [size, last access time, hit count]
+        self._entries = {}
+        self._current_size = 0
+        # Cache entry name -> whether it was invalidated, of the fills in
+        # progress. Invalidated fills are discarded when they finish.
+        self._fills = {}
+
+        for path in (self.cache_dir, self.incomplete_dir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self._clean_stale_fills()
+        self._load_entries()
+
+    def _clean_stale_fills(self):
+        now = time.time()
+        for name in os.listdir(self.incomplete_dir):
+            path = os.path.join(self.incomplete_dir, name)
+            try:
+                if now - os.path.getmtime(path) > STALE_FILL_AGE:
+                    LOG.debug("Removing stale cache fill %s", path)
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def _load_entries(self):
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if not os.path.isfile(path):
+                    continue
+                st = os.stat(path)
+                self._entries[name] = [st.st_size, st.st_atime, 0]
+                self._current_size += st.st_size
+        self._evict()
+
+    @staticmethod
+    def _key(uri):
+        return hashlib.sha256(uri.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def is_cacheable(self, scheme):
+        """Return True if data for the given scheme should be cached."""
+        return scheme in self.schemes
+
+    def is_cached(self, uri):
+        return os.path.exists(self._path(self._key(uri)))
+
+    @property
+    def current_size(self):
+        return self._current_size
+
+    def get(self, uri, store, location, offset=0, chunk_size=None,
+            context=None):
+        """
+        Return a tuple of (iterator, size) for the image at the given
+        location, serving it from the cache when possible and filling
+        the cache from the store otherwise.
+
+        :param uri: The location URI used as the cache key
+        :param store: The store which handles the location
+        :param location: `glance_store.location.Location` for the URI
+        """
+        key = self._key(uri)
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            # NOTE: Imported here since the filesystem driver imports
+            # glance_store, which imports this module.
+            from glance_store._drivers import filesystem
+            import glance_store
+            data = filesystem.ChunkedFile(path, offset=offset,
+                                          chunk_size=self.READ_CHUNKSIZE,
+                                          partial_length=chunk_size)
+        except (IOError, OSError):
+            pass
+        else:
+            self._touch(key, size)
+            LOG.debug("Serving image data for %s from local cache", key)
+
+            # Indexable, as the data of the stores it is cached for may be
+            class CachedIndexable(glance_store.Indexable):
+                def another(self):
+                    return next(self.wrapped, b'')
+
+                def close(self):
+                    data.close()
+
+            if chunk_size:
+                size = max(0, min(chunk_size, size - offset))
+            else:
+                size = size - offset
+            return (CachedIndexable(iter(data), size), size)
+
+        data, size = store.get(location, offset=offset,
+                               chunk_size=chunk_size, context=context)
+        if offset or chunk_size or size > self.max_size:
+            return (data, size)
+
+        fp = self._start_fill(key)
+        if fp is None:
+            return (data, size)
+        return (_CacheFiller(self, key, data, size, fp), size)
+
+    def _start_fill(self, key):
+        """
+        Open the incomplete file for a cache fill, or return None if
+        another fill of the same image is already in progress.
+        """
+        path = os.path.join(self.incomplete_dir, key)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                LOG.warn(_LW("Unable to start caching image data in "
+                             "%(path)s: %(e)s") %
+                         dict(path=path, e=utils.exception_to_str(e)))
+            return None
+        with self._lock:
+            self._fills[key] = False
+        return os.fdopen(fd, 'wb')
+
+    def _finish_fill(self, key, fp, complete):
+        incomplete_path = os.path.join(self.incomplete_dir, key)
+        fp.close()
+        if not complete:
+            LOG.debug("Discarding incomplete cache fill for %s", key)
+            self._discard_fill(key, incomplete_path)
+            return
+
+        size = os.path.getsize(incomplete_path)
+        if size > self.max_size:
+            self._discard_fill(key, incomplete_path)
+            return
+        with self._lock:
+            # NOTE: Checked and renamed under the lock, so a location
+            # invalidated while its data was streamed is never cached.
+            if self._fills.pop(key, False):
+                LOG.debug("Discarding invalidated cache fill for %s", key)
+                _unlink_quietly(incomplete_path)
+                return
+            os.rename(incomplete_path, self._path(key))
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._current_size -= old[0]
+            self._entries[key] = [size, time.time(), 0]
+            self._current_size += size
+        LOG.debug("Cached %(size)d bytes of image data as %(key)s",
+                  {'size': size, 'key': key})
+        self._evict()
+
+    def _discard_fill(self, key, incomplete_path):
+        with self._lock:
+            self._fills.pop(key, None)
+        _unlink_quietly(incomplete_path)
+
+    def _touch(self, key, size):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Filled by another process sharing the cache directory.
+                entry = self._entries[key] = [size, 0, 0]
+                self._current_size += size
+            entry[1] = time.time()
+            entry[2] += 1
+
+    def _victim(self):
+        def lru(key):
+            return self._entries[key][1]
+
+        def lfu(key):
+            return (self._entries[key][2], self._entries[key][1])
+
+        return min(self._entries, key=lfu if self.policy == 'lfu' else lru)
+
+    def _evict(self):
+        with self._lock:
+            while self._entries and self._current_size > self.max_size:
+                key = self._victim()
+                size = self._entries.pop(key)[0]
+                self._current_size -= size
+                LOG.debug("Evicting cached image data %s", key)
+                _unlink_quietly(self._path(key))
+
+    def invalidate(self, uri):
+        """Remove any cached data for the given location URI."""
+        key = self._key(uri)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._current_size -= entry[0]
+            if key in self._fills:
+                self._fills[key] = True
+            _unlink_quietly(self._path(key))
+
+
+class _CacheFiller(utils.ChunkObserver):
+
+    """
+    Wrapper which tees the data returned by the store into a cache file.
+    It is indexable when the data is an Indexable.
+
+    The cache entry only becomes visible once the wrapped data has been
+    fully read and the expected amount of data was written.
+    """
+
+    def __init__(self, cache, key, wrapped, size, fp):
+        super(_CacheFiller, self).__init__(wrapped)
+        self.cache = cache
+        self.key = key
+        self.size = size
+        self.fp = fp
+        self.bytes_written = 0
+
+    def on_chunk(self, chunk):
+        if self.fp is not None:
+            try:
+                self.fp.write(chunk)
+                self.bytes_written += len(chunk)
+            except (IOError, OSError) as e:
+                LOG.warn(_LW("Failed to write image data to the "
+                             "cache: %s") % utils.exception_to_str(e))
+                self._finish(False)
+
+    def on_end(self, complete, error):
+        self._finish(complete and (not self.size or
+                                   self.bytes_written == self.size))
+
+    def _finish(self, complete):
+        if self.fp is not None:
+            fp, self.fp = self.fp, None
+            self.cache._finish_fill(self.key, fp, complete)
+
+    def __len__(self):
+        return self.size
+
+
+def _unlink_quietly(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            LOG.warn(_LW("Unable to remove cached image data %(path)s: "
+                         "%(e)s") % dict(path=path,
+                                         e=utils.exception_to_str(e)))
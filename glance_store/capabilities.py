@@ -25,6 +25,7 @@ from oslo_utils import reflection
 
 from glance_store import exceptions
 from glance_store import i18n
+from glance_store import metrics
 
 _LW = i18n._LW
 _STORE_CAPABILITES_UPDATE_SCHEDULING_BOOK = {}
@@ -223,6 +224,6 @@ def check(store_op_fun):
                 kwargs.setdefault('chunk_size', None)
                 raise op_exec_map[op](**kwargs)
 
-        return store_op_fun(store, *args, **kwargs)
+        return metrics.call(store, op, store_op_fun, *args, **kwargs)
 
     return op_checker
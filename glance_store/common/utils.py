@@ -18,15 +18,29 @@
 System-level utilities and helper functions.
 """
 
+import collections
+import hashlib
 import logging
 import uuid
 
 try:
+    from eventlet import greenpool
+    from eventlet import patcher
     from eventlet import sleep
+    from eventlet import tpool
 except ImportError:
+    greenpool = None
+    patcher = None
+    tpool = None
     from time import sleep
 from oslo_utils import encodeutils
 import six
+from six.moves import range
+
+from glance_store import exceptions
+from glance_store import i18n
+
+_ = i18n._
 
 
 LOG = logging.getLogger(__name__)
@@ -45,15 +59,90 @@ def is_uuid_like(val):
         return False
 
 
+def run_blocking(func, *args, **kwargs):
+    """
+    Call a function which blocks in system calls, e.g. reading or syncing
+    a file, in eventlet's pool of native threads when threading is monkey
+    patched, as it is in glance. The threads glance_store starts are then
+    green threads, which would otherwise block the hub, and each other,
+    rather than make the calls in parallel.
+    """
+    if patcher is not None and patcher.is_monkey_patched('thread'):
+        return tpool.execute(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
 def chunkreadable(iter, chunk_size=65536):
     """
     Wrap a readable iterator with a reader yielding chunks of
     a preferred size, otherwise leave iterator unchanged.
 
+    Chunks are yielded as bytes. Image data read from a store may come as
+    memoryviews, e.g. of a memory mapped file, which the client libraries
+    of other stores don't accept.
+
     :param iter: an iter which may also be readable
     :param chunk_size: maximum size of chunk
     """
-    return chunkiter(iter, chunk_size) if hasattr(iter, 'read') else iter
+    chunks = chunkiter(iter, chunk_size) if hasattr(iter, 'read') else iter
+    for chunk in chunks:
+        yield chunk if isinstance(chunk, bytes) else bytes(chunk)
+
+
+# Granularity at which blocks of zeros are left out of sparse writes
+SPARSE_BLOCK_SIZE = 4096
+_ZERO_BLOCK = b'\0' * SPARSE_BLOCK_SIZE
+
+
+def _is_zeros(buf, offset, length, zeros):
+    """Tell whether the length bytes of buf at offset are all zeros."""
+    if length < len(zeros):
+        zeros = zeros[:length]
+    if hasattr(buf, 'startswith'):
+        return buf.startswith(zeros, offset)
+    # Compared in place, as memoryviews only compare item by item
+    return zeros.startswith(buf[offset:offset + length])
+
+
+def data_extents(buf, block_size=SPARSE_BLOCK_SIZE):
+    """
+    Return the (offset, length) extents of a chunk of data which hold
+    anything but zeros, at the granularity of block_size, so that the
+    blocks of zeros in between can be skipped when writing it.
+
+    Only the blocks starting with a zero byte are compared with zeros, so
+    a chunk without holes is told apart by the first byte of each block,
+    without scanning or copying it.
+
+    :param buf: the chunk of data, as bytes, a bytearray or a memoryview
+    :param block_size: size of the blocks checked for zeros
+    """
+    size = len(buf)
+    firsts = buf[::block_size]
+    if isinstance(firsts, memoryview):
+        firsts = firsts.tobytes()
+    if b'\0' not in firsts:
+        return [(0, size)] if size else []
+    if not firsts.strip(b'\0') and _is_zeros(buf, 0, size, b'\0' * size):
+        # A chunk of zeros, e.g. within a hole of the image, is compared
+        # whole rather than block by block
+        return []
+    zeros = (_ZERO_BLOCK if block_size == SPARSE_BLOCK_SIZE
+             else b'\0' * block_size)
+    extents = []
+    start = None
+    for index, first in enumerate(six.iterbytes(firsts)):
+        offset = index * block_size
+        if first == 0 and _is_zeros(buf, offset,
+                                    min(block_size, size - offset), zeros):
+            if start is not None:
+                extents.append((start, offset - start))
+                start = None
+        elif start is None:
+            start = offset
+    if start is not None:
+        extents.append((start, size - start))
+    return extents
 
 
 def chunkiter(fp, chunk_size=65536):
@@ -102,6 +191,61 @@ def cooperative_read(fd):
     return readfn
 
 
+def parallel_range_iter(fetch, size, range_size, concurrency):
+    """
+    Return an iterator over `size` bytes of data which are fetched as
+    byte ranges of `range_size` bytes, up to `concurrency` at a time.
+
+    Chunks are yielded in order. At most `concurrency` ranges are
+    buffered, which bounds the memory used to reorder them. Without
+    eventlet, the ranges are fetched one after the other.
+
+    :param fetch: a callable taking an offset and a length which returns
+                  an iterable over the data of that range
+    :param size: total size of the data
+    :param range_size: size of each byte range
+    :param concurrency: maximum number of ranges fetched concurrently
+    """
+    def fetch_range(offset, length):
+        chunks = list(fetch(offset, length))
+        received = sum(len(chunk) for chunk in chunks)
+        if received != length:
+            msg = (_("Range request at offset %(offset)d returned "
+                     "%(received)d bytes, expected %(length)d") %
+                   dict(offset=offset, received=received, length=length))
+            LOG.error(msg)
+            raise exceptions.BackendException(msg)
+        return chunks
+
+    if greenpool is None:
+        for offset in range(0, size, range_size):
+            for chunk in fetch_range(offset, min(range_size, size - offset)):
+                yield chunk
+        return
+
+    pool = greenpool.GreenPool(size=concurrency)
+    offsets = iter(range(0, size, range_size))
+    pending = collections.deque()
+
+    def spawn_next():
+        for offset in offsets:
+            length = min(range_size, size - offset)
+            pending.append(pool.spawn(fetch_range, offset, length))
+            break
+
+    try:
+        for _i in range(concurrency):
+            spawn_next()
+        while pending:
+            chunks = pending.popleft().wait()
+            spawn_next()
+            for chunk in chunks:
+                yield chunk
+    finally:
+        for thread in pending:
+            thread.kill()
+
+
 class CooperativeReader(object):
     """
     An eventlet thread friendly class for reading in image data.
@@ -141,6 +285,155 @@ class CooperativeReader(object):
         return cooperative_iter(self.fd.__iter__())
 
 
+class ChunkObserver(object):
+    """
+    Base of the wrappers of the data returned by Store.get() which act on
+    the chunks read through them, and once the data has been read, has
+    failed to be read or is closed.
+
+    The wrapped data is read through the wrapper both when iterated and,
+    when it is an Indexable, when indexed, through its another(). This
+    keeps Indexables indexable, as eventlet's GreenSocket.sendall() needs
+    them to be when copying image data between stores.
+
+    Subclasses implement on_chunk() and on_end().
+    """
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.cursor = 0
+        self.chunk = None
+        self._ended = False
+
+    def on_chunk(self, chunk):
+        """Called with every chunk read."""
+
+    def on_end(self, complete, error):
+        """
+        Called once, when all the data has been read, which complete is
+        set for, when reading it failed, which error is set for, or when
+        it is closed or left unread.
+        """
+
+    def end(self, complete=False, error=False):
+        if not self._ended:
+            self._ended = True
+            self.on_end(complete, error)
+
+    def __iter__(self):
+        complete = False
+        try:
+            for chunk in self.wrapped:
+                self.on_chunk(chunk)
+                yield chunk
+            complete = True
+        except Exception:
+            self.end(error=True)
+            raise
+        finally:
+            self.end(complete=complete)
+
+    def __getitem__(self, i):
+        """Index into the chunks read with another(), as Indexable does."""
+        start = i.start if isinstance(i, slice) else i
+        if start < self.cursor:
+            return memoryview(self.chunk)[(start - self.cursor):]
+
+        self.chunk = self.another()
+        if self.chunk:
+            self.cursor += len(self.chunk)
+            # The last chunk isn't followed by another() when the size
+            # is known, as sendall() stops once it has sent that much
+            if self.cursor >= len(self) > 0:
+                self.end(complete=True)
+        return self.chunk
+
+    def another(self):
+        if not hasattr(self.wrapped, 'another'):
+            raise TypeError("%s is not indexable" %
+                            type(self.wrapped).__name__)
+        try:
+            chunk = self.wrapped.another()
+        except Exception:
+            self.end(error=True)
+            raise
+        if chunk:
+            self.on_chunk(chunk)
+        else:
+            self.end(complete=True)
+        return chunk
+
+    def close(self):
+        try:
+            if hasattr(self.wrapped, 'close'):
+                self.wrapped.close()
+        finally:
+            self.end()
+
+    def __len__(self):
+        return len(self.wrapped)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+
+class Checksum(object):
+    """
+    Computes the md5 checksum of image data, along with the additional
+    digests listed in ``store_checksum_algorithms``, in a single pass.
+
+    This has the same interface as the hashlib objects. When
+    ``store_checksum_threads`` is set, large chunks are hashed through
+    run_blocking(), so that they don't stall the other greenthreads.
+    """
+
+    # Smaller chunks are hashed inline, handing them over costs more
+    OFFLOAD_MIN_SIZE = 16 * 1024
+
+    def __init__(self, conf=None):
+        self._hashes = collections.OrderedDict(md5=hashlib.md5())
+        self._offload = False
+        if conf is None:
+            return
+
+        for name in conf.glance_store.store_checksum_algorithms:
+            try:
+                self._hashes[name] = hashlib.new(name)
+            except ValueError:
+                msg = _("Unsupported checksum algorithm %s") % name
+                LOG.error(msg)
+                raise exceptions.BackendException(msg)
+        self._offload = conf.glance_store.store_checksum_threads > 0
+
+    def _update(self, data):
+        for digest in self._hashes.values():
+            digest.update(data)
+
+    def update(self, data):
+        if self._offload and len(data) >= self.OFFLOAD_MIN_SIZE:
+            run_blocking(self._update, data)
+        else:
+            self._update(data)
+
+    def hexdigest(self):
+        """Return the md5 checksum of the data."""
+        return self._hashes['md5'].hexdigest()
+
+    def hexdigests(self):
+        """Return a dict mapping each algorithm to its hex digest."""
+        return dict((name, digest.hexdigest())
+                    for name, digest in self._hashes.items())
+
+    def metadata(self):
+        """
+        Return the additional digests as location metadata, e.g.
+        {'sha256': u'...'}, or an empty dict if there are none.
+        """
+        return dict((name, six.text_type(digest))
+                    for name, digest in self.hexdigests().items()
+                    if name != 'md5')
+
+
 def exception_to_str(exc):
     try:
         error = six.text_type(exc)
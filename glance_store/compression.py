@@ -0,0 +1,337 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Transparent compression of the image data kept in a store.
+
+Compressed image data is stored in a seekable framed format::
+
+    header: magic (8 bytes), codec id (1 byte), raw frame size (4 bytes),
+            raw image size (8 bytes)
+    frames: raw length (4 bytes), compressed length (4 bytes), payload
+
+Every frame is compressed on its own, so a ranged read skips the frames
+before the requested offset without decompressing them, and stops once
+it has the requested length. Data without the magic is passed through
+as is, so images stored before compression was enabled remain readable.
+"""
+
+import logging
+import struct
+import zlib
+
+import six
+
+from glance_store.common import utils
+from glance_store import exceptions
+from glance_store import i18n
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = logging.getLogger(__name__)
+_ = i18n._
+
+MAGIC = b'\x89GSZ\r\n\x1a\n'
+_HEADER = struct.Struct('>8sBIQ')
+_FRAME = struct.Struct('>II')
+# The most zlib and zstd add to a frame besides an eighth of its size
+_MAX_CODEC_OVERHEAD = 64
+
+
+class _ZlibCodec(object):
+
+    name = 'zlib'
+    id = 1
+
+    def __init__(self, level=None):
+        self.level = 6 if level is None else level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, raw_length):
+        return zlib.decompress(data)
+
+
+class _ZstdCodec(object):
+
+    name = 'zstd'
+    id = 2
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise exceptions.BackendException(
+                _("The zstandard library is required to use the zstd "
+                  "compression codec"))
+        self._compressor = zstandard.ZstdCompressor(
+            level=3 if level is None else level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data, raw_length):
+        return self._decompressor.decompress(data,
+                                             max_output_size=raw_length)
+
+
+CODECS = dict((codec.name, codec) for codec in (_ZlibCodec, _ZstdCodec))
+_CODECS_BY_ID = dict((codec.id, codec) for codec in CODECS.values())
+
+
+def is_compressed_scheme(conf, scheme):
+    """Return True if image data of this scheme may be compressed."""
+    return scheme in conf.glance_store.store_compression_schemes
+
+
+def get_codec(conf, store):
+    """
+    Return the codec to compress the image data added to a store with, or
+    None if it isn't to be compressed.
+    """
+    name = conf.glance_store.store_compression
+    if not name or not any(is_compressed_scheme(conf, scheme)
+                           for scheme in store.get_schemes()):
+        return None
+    return CODECS[name](conf.glance_store.store_compression_level)
+
+
+def max_compressed_size(size, frame_size):
+    """
+    Return an upper bound of the size of `size` bytes of image data
+    compressed in frames of `frame_size` bytes, with either codec.
+    """
+    frames = (size + frame_size - 1) // frame_size
+    return (_HEADER.size + size + size // 8 +
+            frames * (_FRAME.size + _MAX_CODEC_OVERHEAD))
+
+
+class CompressingReader(object):
+    """
+    File-like object reading image data from another one and returning
+    it compressed in the framed format.
+
+    The checksum and size are those of the uncompressed data. The size
+    of the compressed data is at most `max_size`, which is what stores
+    are given as the image size, hence `size_is_upper_bound`.
+    """
+
+    size_is_upper_bound = True
+
+    def __init__(self, data, size, codec, frame_size, conf=None):
+        self.data = data
+        self.size = size
+        self.codec = codec
+        self.frame_size = frame_size
+        self.checksum = utils.Checksum(conf)
+        self.raw_size = 0
+        self.compressed_size = 0
+        self.max_size = max_compressed_size(size, frame_size)
+        self._pending = bytearray(_HEADER.pack(MAGIC, codec.id,
+                                               frame_size, size))
+        self._eof = False
+
+    def _read_frame(self):
+        parts = []
+        left = self.frame_size
+        while left > 0:
+            chunk = self.data.read(left)
+            if not chunk:
+                break
+            parts.append(chunk)
+            left -= len(chunk)
+        return b''.join(parts)
+
+    def _compress_frame(self):
+        raw = self._read_frame()
+        if not raw:
+            self._eof = True
+            if self.raw_size != self.size:
+                raise exceptions.BackendException(
+                    _("Expected %(size)d bytes of image data, got "
+                      "%(read)d") % dict(size=self.size, read=self.raw_size))
+            return
+        self.raw_size += len(raw)
+        self.checksum.update(raw)
+        payload = self.codec.compress(raw)
+        self._pending += _FRAME.pack(len(raw), len(payload))
+        self._pending += payload
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._pending) < size):
+            self._compress_frame()
+        if size < 0:
+            size = len(self._pending)
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        self.compressed_size += len(data)
+        return data
+
+    def metadata(self):
+        """Location metadata recording how the data was stored."""
+        return dict(self.checksum.metadata(),
+                    compression=six.text_type(self.codec.name),
+                    compressed_size=six.text_type(self.compressed_size))
+
+
+class _ChunkReader(object):
+    """Reads exact lengths of data from an iterator of chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, length):
+        parts = [self.buffer]
+        have = len(self.buffer)
+        while have < length:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        data = b''.join(parts)
+        self.buffer = data[length:]
+        return data[:length]
+
+    def skip(self, length):
+        """Skip length bytes without joining them."""
+        if len(self.buffer) >= length:
+            self.buffer = self.buffer[length:]
+            return
+        length -= len(self.buffer)
+        self.buffer = b''
+        while length > 0:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                return
+            if len(chunk) > length:
+                self.buffer = chunk[length:]
+            length -= len(chunk)
+
+    def remaining(self):
+        if self.buffer:
+            yield self.buffer
+        for chunk in self.chunks:
+            yield chunk
+
+
+def _close(iterator):
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+
+
+def _passthrough(reader, chunks, offset, length):
+    """Yield the requested range of data which isn't compressed."""
+    try:
+        for chunk in reader.remaining():
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            chunk = chunk[offset:]
+            offset = 0
+            if length is not None:
+                chunk = chunk[:length]
+                length -= len(chunk)
+            if chunk:
+                yield chunk
+            if length is not None and length <= 0:
+                return
+    finally:
+        _close(chunks)
+
+
+def _decompress(reader, codec, chunks, offset, length):
+    try:
+        while length is None or length > 0:
+            frame = reader.read(_FRAME.size)
+            if not frame:
+                return
+            if len(frame) < _FRAME.size:
+                raise exceptions.BackendException(
+                    _("Compressed image data is truncated"))
+            raw_length, payload_length = _FRAME.unpack(frame)
+            if offset >= raw_length:
+                # The frame is before the requested range
+                offset -= raw_length
+                reader.skip(payload_length)
+                continue
+            payload = reader.read(payload_length)
+            if len(payload) < payload_length:
+                raise exceptions.BackendException(
+                    _("Compressed image data is truncated"))
+            raw = codec.decompress(payload, raw_length)[offset:]
+            offset = 0
+            if length is not None:
+                raw = raw[:length]
+                length -= len(raw)
+            yield raw
+    finally:
+        _close(chunks)
+
+
+def _range_size(size, offset, chunk_size):
+    size = max(0, size - offset)
+    return min(chunk_size, size) if chunk_size else size
+
+
+def decompress(chunks, size, offset=0, chunk_size=None):
+    """
+    Take the result of a store's get(), called without offset and
+    chunk_size, and return it with the image data decompressed and only
+    the requested range of it, if it is compressed.
+
+    :returns: a tuple of the iterator over the image data and its size
+    """
+    reader = _ChunkReader(chunks)
+    header = reader.read(_HEADER.size)
+    if len(header) < _HEADER.size or not header.startswith(MAGIC):
+        reader.buffer = header + reader.buffer
+        return (_passthrough(reader, chunks, offset, chunk_size),
+                _range_size(size, offset, chunk_size))
+
+    _magic, codec_id, _frame_size, raw_size = _HEADER.unpack(header)
+    try:
+        if codec_id not in _CODECS_BY_ID:
+            raise exceptions.BackendException(
+                _("Unknown compression codec %d") % codec_id)
+        codec = _CODECS_BY_ID[codec_id]()
+    except exceptions.BackendException:
+        _close(chunks)
+        raise
+    LOG.debug("Decompressing %(codec)s compressed image data" %
+              {'codec': codec.name})
+    return (_decompress(reader, codec, chunks, offset, chunk_size),
+            _range_size(raw_size, offset, chunk_size))
+
+
+def get_size(chunks, size):
+    """
+    Return the size of the image data from the result of a store's get(),
+    which is the uncompressed size if it is compressed.
+    """
+    try:
+        header = _ChunkReader(chunks).read(_HEADER.size)
+    finally:
+        _close(chunks)
+    if len(header) == _HEADER.size and header.startswith(MAGIC):
+        return _HEADER.unpack(header)[3]
+    return size
@@ -36,6 +36,10 @@ class Store(capabilities.StoreCapability):
     OPTIONS = None
     READ_CHUNKSIZE = 4 * units.Mi  # 4M
     WRITE_CHUNKSIZE = READ_CHUNKSIZE
+    # Whether add() takes an upper bound of the size of the image data
+    # as image_size when image_file has a true size_is_upper_bound, as
+    # compressed data does. Other stores are given a size of 0.
+    ACCEPTS_SIZE_UPPER_BOUND = False
 
     def __init__(self, conf):
         """
@@ -160,6 +164,21 @@ class Store(capabilities.StoreCapability):
         """
         raise NotImplementedError
 
+    def clone(self, location, image_id, context=None):
+        """
+        Copies the image data at a location of this store to another image
+        of it within the backend storage system, without streaming it.
+
+        :param location: `glance_store.location.Location` object of the
+                         image data to copy
+        :param image_id: The opaque identifier of the image to copy it to
+        :retval tuple of URL in backing store, bytes copied, checksum, which
+               may be None when the data isn't read, and a dictionary with
+               storage system specific information, or None if the backend
+               can't copy the data itself
+        """
+        return None
+
     def set_acls(self, location, public=False, read_tenants=[],
                  write_tenants=[], context=None):
         """
@@ -37,7 +37,10 @@ that it stores in its storage backends. It **may contain** security
 credentials and is **not** user-facing.
 """
 
+import collections
+import hashlib
 import logging
+import threading
 
 from oslo_config import cfg
 from six.moves import urllib
@@ -50,6 +53,89 @@ LOG = logging.getLogger(__name__)
 SCHEME_TO_CLS_MAP = {}
 
 
+class _LocationCache(object):
+    """
+    Bounded LRU cache of the Location objects parsed from URIs.
+
+    Storage URIs may contain credentials, so entries are keyed by a digest
+    of the URI rather than the URI itself. The cached objects are never
+    handed out, callers get a copy which they are free to modify.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(uri, conf):
+        if isinstance(uri, bytes):
+            uri = uri.decode('utf-8')
+        return (hashlib.sha256(uri.encode('utf-8')).digest(), id(conf))
+
+    def get(self, uri, conf):
+        if not self.max_size:
+            return None
+        key = self._key(uri, conf)
+        with self._lock:
+            loc = self._entries.pop(key, None)
+            if loc is None:
+                return None
+            self._entries[key] = loc
+
+        # The scheme may have been registered again since, with another
+        # location class or conf.
+        scheme_info = SCHEME_TO_CLS_MAP.get(loc.store_name)
+        if (loc.conf is not conf or scheme_info is None or
+                scheme_info['location_class'] is not
+                type(loc.store_location)):
+            return None
+        return _copy_location(loc)
+
+    def put(self, uri, conf, loc):
+        if not self.max_size:
+            return
+        key = self._key(uri, conf)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = _copy_location(loc)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _shallow_copy(obj):
+    # NOTE: Much cheaper than copy.copy(), which would cost about as
+    # much as parsing the URI again.
+    new = object.__new__(type(obj))
+    new.__dict__.update(obj.__dict__)
+    return new
+
+
+def _copy_location(loc):
+    loc = _shallow_copy(loc)
+    loc.store_location = _shallow_copy(loc.store_location)
+    return loc
+
+
+_LOCATION_CACHE = _LocationCache()
+
+
+def set_location_cache_size(max_size):
+    """
+    Set the number of parsed locations get_location_from_uri() keeps,
+    0 disables caching. Cached locations are dropped.
+    """
+    _LOCATION_CACHE.resize(max_size)
+
+
 def get_location_from_uri(uri, conf=CONF):
     """
     Given a URI, return a Location object that has had an appropriate
@@ -70,12 +156,18 @@ def get_location_from_uri(uri, conf=CONF):
         file:///var/lib/glance/images/1
         cinder://volume-id
     """
+    loc = _LOCATION_CACHE.get(uri, conf)
+    if loc is not None:
+        return loc
+
     pieces = urllib.parse.urlparse(uri)
     if pieces.scheme not in SCHEME_TO_CLS_MAP.keys():
         raise exceptions.UnknownScheme(scheme=pieces.scheme)
     scheme_info = SCHEME_TO_CLS_MAP[pieces.scheme]
-    return Location(pieces.scheme, scheme_info['location_class'],
-                    conf, uri=uri)
+    loc = Location(pieces.scheme, scheme_info['location_class'],
+                   conf, uri=uri)
+    _LOCATION_CACHE.put(uri, conf, loc)
+    return loc
 
 
 def register_scheme_map(scheme_map):
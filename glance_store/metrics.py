@@ -0,0 +1,261 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Per-store operation metrics.
+
+Every get, add, delete and get_size operation on a store is recorded
+per scheme and operation: the number of calls and errors, the bytes
+moved and a histogram of the latencies. A get takes until its data has
+been read. Each record is also passed to
+the registered sinks, e.g. a StatsdSink.
+"""
+
+import bisect
+import contextlib
+import logging
+import socket
+import threading
+import time
+
+from glance_store.common import utils
+from glance_store import i18n
+
+LOG = logging.getLogger(__name__)
+_LW = i18n._LW
+
+# Upper bounds, in seconds, of the latency histogram buckets: 1ms to
+# about 17 minutes, doubling each time.
+BUCKETS = tuple(0.001 * 2 ** i for i in range(21))
+
+
+class OperationStats(object):
+
+    """Statistics of one operation on the stores of one scheme."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        # The last bucket counts everything above the last bound
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def record(self, duration, nbytes, error):
+        self.count += 1
+        self.errors += int(error)
+        self.bytes += nbytes
+        self.seconds += duration
+        self.histogram[bisect.bisect_left(BUCKETS, duration)] += 1
+
+    def percentile(self, percent):
+        """
+        Return the upper bound of the histogram bucket the given
+        percentile of the latencies falls in, or None without data.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, hits in enumerate(self.histogram):
+            seen += hits
+            if seen >= rank:
+                break
+        return BUCKETS[min(index, len(BUCKETS) - 1)]
+
+    def as_dict(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'seconds': self.seconds,
+                'throughput': (self.bytes / self.seconds
+                               if self.seconds else 0.0),
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+
+_LOCK = threading.Lock()
+# (scheme, operation) -> OperationStats
+_STATS = {}
+_SINKS = []
+
+
+def store_scheme(store):
+    """Return the name under which the metrics of a store are recorded."""
+    try:
+        return store.get_schemes()[0]
+    except (AttributeError, IndexError, NotImplementedError):
+        return type(store).__module__.rsplit('.', 1)[-1]
+
+
+def record(scheme, operation, duration, nbytes=0, error=False):
+    """Record one operation and pass it on to the registered sinks."""
+    with _LOCK:
+        stats = _STATS.get((scheme, operation))
+        if stats is None:
+            stats = _STATS[(scheme, operation)] = OperationStats()
+        stats.record(duration, nbytes, error)
+
+    for sink in list(_SINKS):
+        try:
+            sink(scheme, operation, duration, nbytes, error)
+        except Exception as e:
+            LOG.warn(_LW("Unable to send store metrics to %(sink)s: %(e)s") %
+                     dict(sink=sink, e=utils.exception_to_str(e)))
+
+
+class _TimedIterator(utils.ChunkObserver):
+
+    """
+    Wrapper of the data returned by get(), which records the get once the
+    data has been read or closed, with the bytes actually read and the
+    time taken until then. It is indexable when the data is an Indexable.
+    """
+
+    def __init__(self, scheme, wrapped, start):
+        super(_TimedIterator, self).__init__(wrapped)
+        self.scheme = scheme
+        self.start = start
+        self.bytes = 0
+
+    def on_chunk(self, chunk):
+        self.bytes += len(chunk)
+
+    def on_end(self, complete, error):
+        record(self.scheme, 'get', time.time() - self.start,
+               nbytes=self.bytes, error=error)
+
+
+def call(store, operation, func, *args, **kwargs):
+    """
+    Call a store operation and record its metrics.
+
+    A get is recorded once the data it returns has been read or closed.
+    """
+    start = time.time()
+    try:
+        result = func(store, *args, **kwargs)
+    except Exception:
+        record(store_scheme(store), operation, time.time() - start,
+               error=True)
+        raise
+    if operation == 'get':
+        return (_TimedIterator(store_scheme(store), result[0], start),
+                result[1])
+    nbytes = 0
+    if operation == 'add':
+        # add() returns (location, size, checksum, metadata)
+        nbytes = result[1] or 0
+    record(store_scheme(store), operation, time.time() - start,
+           nbytes=nbytes)
+    return result
+
+
+@contextlib.contextmanager
+def timed(scheme, operation):
+    """Context manager recording the time spent in its block."""
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        record(scheme, operation, time.time() - start, error=True)
+        raise
+    record(scheme, operation, time.time() - start)
+
+
+def get_stats():
+    """
+    Return the metrics recorded so far as a dict of the form
+    {scheme: {operation: {'count': ..., 'p99': ...}}}.
+    """
+    with _LOCK:
+        stats = {}
+        for (scheme, operation), op_stats in _STATS.items():
+            stats.setdefault(scheme, {})[operation] = op_stats.as_dict()
+        return stats
+
+
+def reset():
+    """Forget all the metrics recorded so far."""
+    with _LOCK:
+        _STATS.clear()
+
+
+def register_sink(sink):
+    """
+    Register a callable which is called with the scheme, operation,
+    duration, bytes and error flag of every recorded operation.
+    """
+    if sink not in _SINKS:
+        _SINKS.append(sink)
+
+
+def unregister_sink(sink):
+    if sink in _SINKS:
+        _SINKS.remove(sink)
+
+
+class StatsdSink(object):
+
+    """Sends every recorded operation to a statsd server over UDP."""
+
+    def __init__(self, host, port, prefix='glance_store'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, scheme, operation, duration, nbytes, error):
+        name = '%s.%s.%s' % (self.prefix, scheme, operation)
+        lines = ['%s.count:1|c' % name,
+                 '%s.latency:%d|ms' % (name, duration * 1000)]
+        if nbytes:
+            lines.append('%s.bytes:%d|c' % (name, nbytes))
+        if error:
+            lines.append('%s.errors:1|c' % name)
+        self.sock.sendto('\n'.join(lines).encode('utf-8'), self.address)
+
+    def __repr__(self):
+        return 'StatsdSink(%s:%d)' % self.address
+
+
+def format_prometheus(prefix='glance_store'):
+    """Return the metrics recorded so far in Prometheus text format."""
+    lines = []
+    with _LOCK:
+        items = sorted(_STATS.items())
+        for metric, attr in (('operations_total', 'count'),
+                             ('errors_total', 'errors'),
+                             ('bytes_total', 'bytes')):
+            lines.append('# TYPE %s_%s counter' % (prefix, metric))
+            for (scheme, operation), stats in items:
+                lines.append('%s_%s{scheme="%s",operation="%s"} %d' %
+                             (prefix, metric, scheme, operation,
+                              getattr(stats, attr)))
+
+        name = '%s_latency_seconds' % prefix
+        lines.append('# TYPE %s histogram' % name)
+        for (scheme, operation), stats in items:
+            labels = 'scheme="%s",operation="%s"' % (scheme, operation)
+            cumulative = 0
+            for bound, hits in zip(BUCKETS, stats.histogram):
+                cumulative += hits
+                lines.append('%s_bucket{%s,le="%g"} %d' %
+                             (name, labels, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' %
+                         (name, labels, stats.count))
+            lines.append('%s_sum{%s} %f' % (name, labels, stats.seconds))
+            lines.append('%s_count{%s} %d' % (name, labels, stats.count))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,70 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from six.moves import http_client
+from six.moves import urllib
+
+from oslotest import base
+
+from glance_store.benchmarks import runner
+from glance_store.benchmarks import standins
+
+
+class TestBenchmarkRunner(base.BaseTestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(512, runner.parse_size('512'))
+        self.assertEqual(64 * 1024, runner.parse_size('64K'))
+        self.assertEqual(16 * 1024 ** 2, runner.parse_size('16MiB'))
+        self.assertEqual(1024 ** 3, runner.parse_size('1g'))
+        self.assertEqual('64K', runner.format_size(64 * 1024))
+        self.assertEqual('1536K', runner.format_size(1536 * 1024))
+
+    def test_run_phase(self):
+        elapsed, latencies, nbytes = runner._run_phase(
+            3, range(10), lambda job: job)
+        self.assertEqual(10, len(latencies))
+        self.assertEqual(45, nbytes)
+        result = runner._phase_result(elapsed, latencies, nbytes)
+        self.assertEqual(10, result['ops'])
+        self.assertLessEqual(result['p50'], result['p99'])
+
+    def test_run_phase_error(self):
+        def fail(job):
+            raise IOError('boom')
+
+        self.assertRaises(RuntimeError, runner._run_phase, 2, range(4), fail)
+
+
+class TestHTTPServerStandIn(base.BaseTestCase):
+
+    def test_ranged_get(self):
+        standin = standins.HTTPStandIn()
+        standin.start(None)
+        self.addCleanup(standin.stop)
+        uri = standin.put('img', b'0123456789')
+
+        parts = urllib.parse.urlparse(uri)
+        conn = http_client.HTTPConnection(parts.netloc)
+        self.addCleanup(conn.close)
+        conn.request('GET', parts.path, headers={'Range': 'bytes=2-4'})
+        resp = conn.getresponse()
+        self.assertEqual(206, resp.status)
+        self.assertEqual(b'234', resp.read())
+
+        conn.request('HEAD', '/images/missing')
+        resp = conn.getresponse()
+        resp.read()
+        self.assertEqual(404, resp.status)
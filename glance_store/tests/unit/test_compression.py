@@ -0,0 +1,151 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import os
+
+import mock
+import six
+import testtools
+
+from glance_store._drivers import filesystem
+from glance_store import backend
+from glance_store import compression
+from glance_store import exceptions
+from glance_store.tests import base
+
+
+class TestCompression(base.StoreBaseTest):
+
+    def setUp(self):
+        super(TestCompression, self).setUp()
+        self.config(filesystem_store_datadir=self.test_dir,
+                    store_compression='zlib',
+                    store_compression_frame_size=1000,
+                    store_compression_schemes=['file', 'filesystem'])
+        self.store = filesystem.Store(self.conf)
+        self.store.configure()
+        self.register_store_schemes(self.store, 'file')
+        self.data = b''.join(six.b('%06d' % i) for i in range(1000))
+
+    def _add(self, data=None, size=None):
+        data = self.data if data is None else data
+        return backend.store_add_to_backend(
+            'img', six.BytesIO(data), len(data) if size is None else size,
+            self.store)
+
+    def _get(self, uri, offset=0, chunk_size=None):
+        chunks, size = backend.get_from_backend(uri, offset=offset,
+                                                chunk_size=chunk_size)
+        return b''.join(chunks), size
+
+    def test_add_get(self):
+        uri, size, checksum, metadata = self._add()
+        self.assertEqual(len(self.data), size)
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), checksum)
+        self.assertEqual(u'zlib', metadata['compression'])
+
+        with open(uri[len('file://'):], 'rb') as f:
+            stored = f.read()
+        self.assertTrue(stored.startswith(compression.MAGIC))
+        self.assertEqual(len(stored), int(metadata['compressed_size']))
+        self.assertLess(len(stored), len(self.data) / 2)
+
+        self.assertEqual((self.data, len(self.data)), self._get(uri))
+        self.assertEqual(len(self.data), backend.get_size_from_backend(uri))
+
+    def test_ranged_get(self):
+        uri = self._add()[0]
+        for offset, length in ((0, 10), (995, 10), (2000, 1000),
+                               (5999, None), (5990, 100)):
+            data, size = self._get(uri, offset=offset, chunk_size=length)
+            end = offset + length if length else None
+            self.assertEqual(self.data[offset:end], data)
+
+    def test_uncompressed_data_passed_through(self):
+        self.config(store_compression=None)
+        uri, size, checksum, metadata = self._add()
+        self.assertNotIn('compression', metadata)
+        self.assertEqual((self.data, len(self.data)), self._get(uri))
+        self.assertEqual(self.data[10:30],
+                         self._get(uri, offset=10, chunk_size=20)[0])
+        self.assertEqual(len(self.data), backend.get_size_from_backend(uri))
+
+    def test_passthrough_ranged_size(self):
+        chunks = iter([self.data[:100], self.data[100:]])
+        data, size = compression.decompress(chunks, 6000, offset=5990,
+                                            chunk_size=100)
+        self.assertEqual((self.data[5990:], 10), (b''.join(data), size))
+        data, size = compression.decompress(iter([self.data]), 6000,
+                                            offset=10)
+        self.assertEqual(5990, size)
+
+    def test_uncompressed_schemes_read_from_store(self):
+        self.conf.clear_override('store_compression_schemes',
+                                 group='glance_store')
+        self.assertEqual([], self.conf.glance_store.store_compression_schemes)
+        uri, size, checksum, metadata = self._add()
+        self.assertNotIn('compression', metadata)
+
+        with mock.patch.object(self.store, 'get_size',
+                               return_value=6000) as get_size:
+            self.assertEqual(6000, backend.get_size_from_backend(uri))
+            self.assertTrue(get_size.called)
+        with mock.patch.object(self.store, 'get',
+                               return_value=(iter([b'data']), 4)) as get:
+            self.assertEqual((b'data', 4),
+                             self._get(uri, offset=10, chunk_size=4))
+            self.assertEqual(10, get.call_args[1]['offset'])
+            self.assertEqual(4, get.call_args[1]['chunk_size'])
+
+    def test_stores_given_size_upper_bound(self):
+        data = os.urandom(5500)
+        self.store.ACCEPTS_SIZE_UPPER_BOUND = True
+        with mock.patch.object(self.store, 'add',
+                               wraps=self.store.add) as add:
+            metadata = self._add(data)[3]
+        bound = add.call_args[0][2]
+        self.assertEqual(compression.max_compressed_size(5500, 1000), bound)
+        self.assertLessEqual(int(metadata['compressed_size']), bound)
+        self.assertGreater(int(metadata['compressed_size']), 5500)
+
+        self.store.ACCEPTS_SIZE_UPPER_BOUND = False
+        result = ('file:///img2', 0, '', {})
+        with mock.patch.object(self.store, 'add', return_value=result) as add:
+            self._add(data)
+        self.assertEqual(0, add.call_args[0][2])
+
+    def test_unknown_size_not_compressed(self):
+        uri, size, checksum, metadata = self._add(size=0)
+        self.assertNotIn('compression', metadata)
+        self.assertEqual(self.data, self._get(uri)[0])
+
+    def test_size_mismatch(self):
+        self.assertRaises(exceptions.BackendException, self._add,
+                          size=len(self.data) + 1)
+
+    def test_checksum_algorithms(self):
+        self.config(store_checksum_algorithms=['sha256'])
+        metadata = self._add()[3]
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(),
+                         metadata['sha256'])
+
+    @testtools.skipIf(compression.zstandard is None,
+                      'zstandard is not installed')
+    def test_zstd(self):
+        self.config(store_compression='zstd')
+        uri = self._add()[0]
+        self.assertEqual(self.data[10:3000],
+                         self._get(uri, offset=10, chunk_size=2990)[0])
@@ -0,0 +1,118 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import uuid
+
+import fixtures
+from oslotest import base
+
+from glance_store._drivers import filesystem
+from glance_store.tools import filesystem_layout
+
+
+class TestFilesystemLayout(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestFilesystemLayout, self).setUp()
+        self.datadir = self.useFixture(fixtures.TempDir()).path
+        self.image_ids = [str(uuid.uuid4()) for _i in range(10)]
+        for image_id in self.image_ids:
+            with open(os.path.join(self.datadir, image_id), 'wb') as f:
+                f.write(image_id.encode('ascii'))
+        # Not image files
+        open(os.path.join(self.datadir, '.glance-tmp-x.0'), 'wb').close()
+        os.mkdir(os.path.join(self.datadir, 'zz'))
+        open(os.path.join(self.datadir, 'zz', 'other'), 'wb').close()
+
+    def _assert_layout(self, fanout):
+        for image_id in self.image_ids:
+            path = filesystem.image_path(self.datadir, image_id, fanout)
+            with open(path, 'rb') as f:
+                self.assertEqual(image_id.encode('ascii'), f.read())
+        self.assertTrue(os.path.exists(os.path.join(self.datadir, 'zz',
+                                                    'other')))
+
+    def test_find_image_files(self):
+        self.assertEqual(
+            sorted(os.path.join(self.datadir, image_id)
+                   for image_id in self.image_ids),
+            sorted(filesystem_layout.find_image_files(self.datadir)))
+
+    def test_migrate(self):
+        self.assertEqual((10, 0), filesystem_layout.migrate([self.datadir],
+                                                            2, workers=3))
+        self._assert_layout(2)
+        self.assertEqual(10, len(list(
+            filesystem_layout.find_image_files(self.datadir))))
+        self.assertEqual((0, 0), filesystem_layout.migrate([self.datadir],
+                                                           2))
+
+        self.assertEqual((10, 0), filesystem_layout.migrate([self.datadir],
+                                                            0))
+        self._assert_layout(0)
+        self.assertEqual(sorted(self.image_ids + ['.glance-tmp-x.0', 'zz']),
+                         sorted(os.listdir(self.datadir)))
+
+    def test_migrate_keeps_directories_of_new_fanout(self):
+        filesystem_layout.migrate([self.datadir], 2)
+        # Directories a store with the new fan-out may be adding files to,
+        # which none of the image files were moved to
+        shard = next(name for name in ('%02x' % i for i in range(256))
+                     if not os.path.exists(os.path.join(self.datadir, name)))
+        os.mkdir(os.path.join(self.datadir, shard))
+        os.mkdir(os.path.join(self.datadir, shard, 'cd'))
+        filesystem_layout.migrate([self.datadir], 1)
+        self._assert_layout(1)
+        self.assertTrue(os.path.isdir(os.path.join(self.datadir, shard)))
+        self.assertFalse(os.path.exists(os.path.join(self.datadir, shard,
+                                                     'cd')))
+
+    def test_move_does_not_replace(self):
+        path = os.path.join(self.datadir, self.image_ids[0])
+        target = filesystem.image_path(self.datadir, self.image_ids[0], 1)
+        os.makedirs(os.path.dirname(target))
+        with open(target, 'wb') as f:
+            f.write(b'added concurrently')
+        self.assertRaises(OSError, filesystem_layout.move_image_file,
+                          self.datadir, path, 1)
+        with open(target, 'rb') as f:
+            self.assertEqual(b'added concurrently', f.read())
+        self.assertTrue(os.path.exists(path))
+
+    def test_migrate_dry_run(self):
+        self.assertEqual((10, 0), filesystem_layout.migrate(
+            [self.datadir], 1, dry_run=True))
+        self._assert_layout(0)
+
+    def test_migrate_conflict(self):
+        target = filesystem.image_path(self.datadir, self.image_ids[0], 1)
+        os.makedirs(os.path.dirname(target))
+        open(target, 'wb').close()
+        self.assertEqual((9, 1), filesystem_layout.migrate([self.datadir],
+                                                           1))
+        self.assertTrue(os.path.exists(os.path.join(self.datadir,
+                                                    self.image_ids[0])))
+
+    def test_main_with_config_file(self):
+        config_file = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                   'glance-api.conf')
+        with open(config_file, 'w') as f:
+            f.write('[glance_store]\n'
+                    'filesystem_store_datadirs = %s:100\n'
+                    'filesystem_store_fanout = 1\n' % self.datadir)
+        self.assertEqual(0, filesystem_layout.main(['--config-file',
+                                                    config_file]))
+        self._assert_layout(1)
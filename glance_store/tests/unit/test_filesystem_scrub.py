@@ -0,0 +1,170 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import json
+import os
+import time
+
+import fixtures
+import mock
+from oslotest import base
+
+from glance_store._drivers import filesystem
+from glance_store.tools import filesystem_scrub
+
+
+class TestFilesystemScrub(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestFilesystemScrub, self).setUp()
+        self.datadirs = [self.useFixture(fixtures.TempDir()).path
+                         for _i in range(2)]
+        a, b = self.datadirs
+        self.old = time.time() - 7200
+        self.paths = {}
+        self._write(a, 'img1', b'one')
+        self._write(a, 'img2', b'two')
+        self._write(b, 'img3', b'three', fanout=1)
+        self._write(a, 'img4', b'')
+        self._write(a, '.glance-tmp-img8.0123abcd', b'partial')
+        self._write(a, 'img5.0', b'striped ')
+        self._write(b, 'img5.1', b'data', fanout=2)
+        self._write_manifest(a, 'img5', ['img5.0', 'img5.1'])
+        self._write(b, 'img6.0', b'orphan')
+        self._write_manifest(b, 'img7', ['img7.0'])
+        # An upload in progress
+        self._write(b, '.glance-tmp-img9.0123abcd', b'writing', old=False)
+        # Not the files of images
+        self._write(os.path.join(a, 'zz'), 'other', b'other')
+
+    def _write(self, datadir, name, data, fanout=0, old=True):
+        path = filesystem.image_path(datadir, name, fanout)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        if old:
+            os.utime(path, (self.old, self.old))
+        self.paths[name] = path
+        return path
+
+    def _write_manifest(self, datadir, image_id, extents):
+        manifest = json.dumps({
+            'size': 0, 'stripe_size': 8,
+            'extents': [os.path.join(datadir, name) for name in extents]})
+        return self._write(datadir, image_id + '.stripes',
+                           manifest.encode('ascii'))
+
+    def _scan(self, **kwargs):
+        return sorted(
+            (f.kind, f.image_id) for f in
+            filesystem_scrub.scan(self.datadirs, workers=3, **kwargs))
+
+    def test_scan(self):
+        self.assertEqual([('empty', 'img4'),
+                          ('incomplete', 'img7'),
+                          ('orphan_extent', 'img6'),
+                          ('partial', 'img8')], self._scan())
+
+    def test_scan_unreferenced(self):
+        found = self._scan(known=['img1', 'img3', 'img5'])
+        self.assertIn(('unreferenced', 'img2'), found)
+        self.assertEqual(5, len(found))
+        found = self._scan(known=lambda image_id: image_id != 'img5')
+        self.assertIn(('unreferenced', 'img5'), found)
+
+    def test_scan_checksums(self):
+        checksums = {'img1': hashlib.md5(b'one').hexdigest(),
+                     'img2': hashlib.md5(b'wrong').hexdigest(),
+                     'img5': hashlib.md5(b'striped data').hexdigest()}
+        with mock.patch.object(time, 'sleep') as sleep:
+            found = self._scan(checksums=checksums, bandwidth=1024)
+        self.assertIn(('checksum_mismatch', 'img2'), found)
+        self.assertEqual(5, len(found))
+        # img1, img2 and the two extents of img5
+        self.assertEqual(4, sleep.call_count)
+
+    def test_recent_files_left_alone(self):
+        self.assertEqual([], self._scan(temp_file_max_age=86400,
+                                        known=[]))
+
+    def test_extents_of_uploads_in_progress_not_orphaned(self):
+        a, b = self.datadirs
+        # A striped upload whose manifest isn't renamed into place yet
+        self._write(a, 'img10.0', b'striped ')
+        self._write(a, '.glance-tmp-img10.0123abcd', b'{}', old=False)
+        # A striped upload writing an extent
+        self._write(b, 'img11.0', b'striped ')
+        self._write(a, '.glance-tmp-img11.1.0123abcd', b'data', old=False)
+        self.assertEqual([('empty', 'img4'),
+                          ('incomplete', 'img7'),
+                          ('orphan_extent', 'img6'),
+                          ('partial', 'img8')], self._scan())
+
+    def test_extents_of_unreadable_manifest_not_orphaned(self):
+        a, b = self.datadirs
+        self._write(a, 'img10.0', b'striped ')
+        self._write(b, 'img10.stripes', b'not json')
+        self.assertNotIn(('orphan_extent', 'img10'), self._scan())
+
+    def test_orphans_need_all_datadirs_scanned(self):
+        a, b = self.datadirs
+        # The manifest of img5 is in a, its second extent in b
+        found = sorted((f.kind, f.image_id) for f in filesystem_scrub.scan(
+            [b], store_datadirs=self.datadirs))
+        self.assertEqual([('incomplete', 'img7')], found)
+        found = sorted((f.kind, f.image_id) for f in filesystem_scrub.scan(
+            [b, a], store_datadirs=[a + '/', b]))
+        self.assertIn(('orphan_extent', 'img6'), found)
+
+    def test_remove(self):
+        findings = filesystem_scrub.scan(self.datadirs,
+                                         known=['img1', 'img3'])
+        partial = self.paths['.glance-tmp-img8.0123abcd']
+        self.assertEqual((1, 0), filesystem_scrub.remove(findings,
+                                                         dry_run=True))
+        self.assertTrue(os.path.exists(partial))
+
+        # Only the partial files are removed by default
+        self.assertEqual((1, 0), filesystem_scrub.remove(findings))
+        self.assertFalse(os.path.exists(partial))
+        self.assertTrue(os.path.exists(self.paths['img6.0']))
+        self.assertTrue(os.path.exists(self.paths['img4']))
+
+        self.assertEqual((1, 0), filesystem_scrub.remove(
+            findings, [filesystem_scrub.ORPHAN_EXTENT]))
+        self.assertFalse(os.path.exists(self.paths['img6.0']))
+
+        # The extents of striped images go with their manifest
+        self.assertEqual((4, 0), filesystem_scrub.remove(
+            findings, [filesystem_scrub.UNREFERENCED]))
+        for name in ('img2', 'img5.stripes', 'img5.0', 'img5.1'):
+            self.assertFalse(os.path.exists(self.paths[name]))
+        self.assertTrue(os.path.exists(self.paths['img1']))
+        self.assertTrue(os.path.exists(self.paths['img3']))
+
+    def test_main(self):
+        known_ids = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'known')
+        with open(known_ids, 'w') as f:
+            f.write('img1\nimg2\nimg3\nimg5\n')
+        self.assertEqual(0, filesystem_scrub.main(
+            self.datadirs + ['--known-ids', known_ids,
+                             '--remove', 'partial,empty']))
+        self.assertFalse(os.path.exists(self.paths['img4']))
+        self.assertTrue(os.path.exists(self.paths['img6.0']))
+        self.assertRaises(SystemExit, filesystem_scrub.main,
+                          self.datadirs + ['--remove', 'nope'])
@@ -20,7 +20,10 @@ import hashlib
 import json
 import mock
 import os
+import socket
 import stat
+import threading
+import time
 import uuid
 
 import fixtures
@@ -30,8 +33,12 @@ from six.moves import builtins
 # NOTE(jokke): simplified transition to py3, behaves like py2 xrange
 from six.moves import range
 
+from glance_store._drivers import filesystem
 from glance_store._drivers.filesystem import ChunkedFile
+from glance_store._drivers.filesystem import ParallelChunkedFile
 from glance_store._drivers.filesystem import Store
+from glance_store import backend
+from glance_store.common import utils
 from glance_store import exceptions
 from glance_store import location
 from glance_store.tests import base
@@ -183,6 +190,363 @@ class TestStore(base.StoreBaseTest,
         self.assertEqual(expected_file_contents, new_image_contents)
         self.assertEqual(expected_file_size, new_image_file_size)
 
+    def test_add_with_checksum_algorithms(self):
+        self.config(store_checksum_algorithms=['sha256'],
+                    store_checksum_threads=1)
+        contents = b"*" * (100 * units.Ki)
+        loc, size, checksum, metadata = self.store.add(
+            str(uuid.uuid4()), six.BytesIO(contents), len(contents))
+        self.assertEqual(hashlib.md5(contents).hexdigest(), checksum)
+        self.assertEqual({'sha256': hashlib.sha256(contents).hexdigest()},
+                         metadata)
+
+    def test_add_writes_temporary_file(self):
+        """Test the image file only appears once complete"""
+        image_id = str(uuid.uuid4())
+        path = os.path.join(self.test_dir, image_id)
+        image_file = six.BytesIO(b"*" * units.Ki)
+        read = image_file.read
+
+        def fake_read(size):
+            self.assertFalse(os.path.exists(path))
+            return read(size)
+
+        with mock.patch.object(image_file, 'read', side_effect=fake_read):
+            self.store.add(image_id, image_file, units.Ki)
+        self.assertEqual([image_id], os.listdir(self.test_dir))
+        with open(path, 'rb') as f:
+            self.assertEqual(b"*" * units.Ki, f.read())
+
+    def test_add_durability_fdatasync(self):
+        self.config(filesystem_store_durability='fdatasync')
+        with mock.patch.object(os, 'fsync') as fsync:
+            with mock.patch.object(os, 'fdatasync', create=True) as fdatasync:
+                self.store.add(str(uuid.uuid4()), six.BytesIO(b"*"), 1)
+        self.assertEqual(1, fdatasync.call_count)
+        self.assertEqual(1, fsync.call_count)
+
+    def test_add_durability_fdatasync_with_fanout(self):
+        self.config(filesystem_store_durability='fdatasync',
+                    filesystem_store_fanout=2)
+        with mock.patch.object(os, 'fsync') as fsync:
+            with mock.patch.object(os, 'fdatasync', create=True) as fdatasync:
+                self.store.add(str(uuid.uuid4()), six.BytesIO(b"*"), 1)
+        self.assertEqual(1, fdatasync.call_count)
+        # The directory of the file and those of the new subdirectories
+        self.assertEqual(3, fsync.call_count)
+
+    def test_add_durability_group(self):
+        self.config(filesystem_store_durability='group')
+        image_id = str(uuid.uuid4())
+        with mock.patch.object(filesystem.GroupCommitter, '_commit',
+                               side_effect=filesystem.GroupCommitter._commit
+                               ) as commit:
+            loc = self.store.add(image_id, six.BytesIO(b"*" * 10), 10)[0]
+        self.assertEqual(1, commit.call_count)
+        self.assertEqual('file://%s/%s' % (self.test_dir, image_id), loc)
+        self.assertEqual([image_id], os.listdir(self.test_dir))
+
+    def test_group_committer_syncs_directories_once(self):
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(self.test_dir, 'tmp%d' % i))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'*')
+        batch = [{'path': path, 'error': None, 'done': threading.Event(),
+                  'publish': lambda: [self.test_dir]} for path in paths]
+        batch[1]['publish'] = mock.Mock(
+            side_effect=exceptions.Duplicate(image='tmp1'))
+        with mock.patch.object(os, 'fsync') as fsync:
+            with mock.patch.object(os, 'fdatasync', create=True) as fdatasync:
+                filesystem.GroupCommitter._commit(batch)
+        self.assertEqual(3, fdatasync.call_count)
+        self.assertEqual(1, fsync.call_count)
+        self.assertEqual([None, exceptions.Duplicate, None],
+                         [r['error'] and type(r['error']) for r in batch])
+        self.assertTrue(all(r['done'].is_set() for r in batch))
+
+    def _add_concurrently(self, count):
+        """
+        Add count images concurrently, with flushes taking a while each on
+        a disk writing back one at a time, and return the time taken and
+        the number of flushes.
+        """
+        disk = threading.Lock()
+        flushes = []
+
+        def flush(*args):
+            with disk:
+                flushes.append(args)
+                time.sleep(0.01)
+
+        image_ids = [str(uuid.uuid4()) for i in range(count)]
+        threads = [threading.Thread(target=self.store.add,
+                                    args=(image_id,
+                                          six.BytesIO(b"*" * units.Ki),
+                                          units.Ki))
+                   for image_id in image_ids]
+        with mock.patch.object(filesystem, '_fdatasync', side_effect=flush):
+            with mock.patch.object(filesystem, '_fsync_directory',
+                                   side_effect=flush):
+                start = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.time() - start
+        for image_id in image_ids:
+            self.assertTrue(os.path.exists(os.path.join(self.test_dir,
+                                                        image_id)))
+        return elapsed, len(flushes)
+
+    def test_durability_group_not_slower_than_fdatasync(self):
+        self.config(filesystem_store_durability='fdatasync')
+        fdatasync_time, fdatasync_flushes = self._add_concurrently(8)
+        self.assertEqual(16, fdatasync_flushes)
+        self.config(filesystem_store_durability='group')
+        group_time, group_flushes = self._add_concurrently(8)
+        # The directory is flushed once per batch rather than per image
+        self.assertLess(group_flushes, fdatasync_flushes)
+        self.assertLess(group_time, fdatasync_time)
+
+    def test_group_committer_flushes_concurrently(self):
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(self.test_dir, 'tmp%d' % i))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'*')
+        batch = [{'path': path, 'error': None, 'done': threading.Event(),
+                  'publish': lambda: [self.test_dir]} for path in paths]
+        # Each flush waits for the others, which only the concurrent
+        # flushes of the batch get past
+        started = []
+        all_started = threading.Event()
+
+        def fdatasync(fd):
+            started.append(fd)
+            if len(started) == len(batch):
+                all_started.set()
+            if not all_started.wait(10):
+                raise OSError(errno.EIO, 'flushed one at a time')
+
+        with mock.patch.object(filesystem, '_fdatasync',
+                               side_effect=fdatasync):
+            with mock.patch.object(filesystem, '_fsync_directory'):
+                filesystem.GroupCommitter._commit(batch)
+        self.assertEqual([None] * 3, [r['error'] for r in batch])
+
+    def test_group_committer_flushes_off_the_hub(self):
+        path = os.path.join(self.test_dir, 'tmp')
+        with open(path, 'wb') as f:
+            f.write(b'*')
+        batch = [{'path': path, 'error': None, 'done': threading.Event(),
+                  'publish': lambda: [self.test_dir]}]
+        with mock.patch.object(utils, 'run_blocking',
+                               side_effect=utils.run_blocking) as blocking:
+            filesystem.GroupCommitter._commit(batch)
+        self.assertEqual([filesystem._fdatasync_path,
+                          filesystem._fsync_directory],
+                         [c[0][0] for c in blocking.call_args_list])
+        self.assertIsNone(batch[0]['error'])
+
+    def test_add_duplicate_while_writing(self):
+        """Test an image file added concurrently is not replaced"""
+        image_id = str(uuid.uuid4())
+        path = os.path.join(self.test_dir, image_id)
+        image_file = six.BytesIO(b"*" * units.Ki)
+        read = image_file.read
+
+        def fake_read(size):
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(b"other")
+            return read(size)
+
+        with mock.patch.object(image_file, 'read', side_effect=fake_read):
+            self.assertRaises(exceptions.Duplicate, self.store.add,
+                              image_id, image_file, units.Ki)
+        self.assertEqual([image_id], os.listdir(self.test_dir))
+        with open(path, 'rb') as f:
+            self.assertEqual(b"other", f.read())
+
+    def test_configure_removes_stale_temporary_files(self):
+        stale = os.path.join(self.test_dir, '.glance-tmp-stale.0')
+        recent = os.path.join(self.test_dir, '.glance-tmp-recent.0')
+        other = os.path.join(self.test_dir, '.other')
+        for path in (stale, recent, other):
+            with open(path, 'wb') as f:
+                f.write(b"*")
+        old = time.time() - 7200
+        os.utime(stale, (old, old))
+        os.utime(other, (old, old))
+
+        self.store.configure()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(other))
+
+    def test_add_sparse(self):
+        """Test blocks of zeros are left as holes and read back as zeros"""
+        self.store.WRITE_CHUNKSIZE = 64 * units.Ki
+        contents = (b"*" * units.Ki + b"\0" * units.Mi + b"*" * 10 +
+                    b"\0" * units.Mi)
+        loc, size, checksum, metadata = self.store.add(
+            str(uuid.uuid4()), six.BytesIO(contents), len(contents))
+        self.assertEqual(len(contents), size)
+        self.assertEqual(hashlib.md5(contents).hexdigest(), checksum)
+
+        filepath = loc[len('file://'):]
+        st = os.stat(filepath)
+        self.assertEqual(len(contents), st.st_size)
+        self.assertLess(st.st_blocks * 512, units.Mi)
+
+        uri = location.get_location_from_uri(loc, conf=self.conf)
+        (image_file, image_size) = self.store.get(uri)
+        self.assertEqual(contents, b"".join(image_file))
+        (image_file, image_size) = self.store.get(uri, offset=units.Ki - 1,
+                                                  chunk_size=units.Mi + 3)
+        self.assertEqual(contents[units.Ki - 1:units.Ki + units.Mi + 2],
+                         b"".join(image_file))
+
+    def _write_file(self, contents):
+        path = os.path.join(self.test_dir, str(uuid.uuid4()))
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def test_chunked_file_advertises_range(self):
+        path = self._write_file(b"*" * 100)
+        chunked = ChunkedFile(path, offset=10, partial_length=50)
+        self.addCleanup(chunked.close)
+        self.assertEqual(10, chunked.offset)
+        self.assertEqual(50, chunked.length)
+        self.assertEqual(os.fstat(chunked.fileno()).st_ino,
+                         os.stat(path).st_ino)
+        self.assertEqual(90, ChunkedFile(path, offset=10).length)
+        self.assertEqual(0, ChunkedFile(path, offset=200).length)
+
+    def _test_sendfile(self, **kwargs):
+        contents = b"".join(six.b("%05d" % i) for i in range(1000))
+        path = self._write_file(contents)
+        out_path = os.path.join(self.test_dir, 'out')
+        chunked = ChunkedFile(path, offset=7, partial_length=3000, **kwargs)
+        with open(out_path, 'wb') as out:
+            self.assertEqual(3000, chunked.sendfile(out))
+        self.assertIsNone(chunked.fp)
+        with open(out_path, 'rb') as f:
+            self.assertEqual(contents[7:3007], f.read())
+
+    def test_chunked_file_sendfile(self):
+        self._test_sendfile()
+
+    def test_chunked_file_sendfile_unavailable(self):
+        with mock.patch.object(os, 'sendfile', None, create=True):
+            self._test_sendfile(chunk_size=64)
+
+    def test_chunked_file_sendfile_socket(self):
+        contents = b"*" * (5 * units.Ki)
+        chunked = ChunkedFile(self._write_file(contents))
+        sock, peer = socket.socketpair()
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        self.assertEqual(len(contents), chunked.sendfile(sock))
+        sock.shutdown(socket.SHUT_WR)
+        received = b""
+        while len(received) < len(contents):
+            received += peer.recv(units.Ki)
+        self.assertEqual(contents, received)
+
+    def test_chunked_file_mmap(self):
+        contents = b"".join(six.b("%05d" % i) for i in range(1000))
+        path = self._write_file(contents)
+        chunked = ChunkedFile(path, offset=7, chunk_size=1000,
+                              partial_length=3000, use_mmap=True)
+        chunks = list(chunked)
+        self.assertIsInstance(chunks[0], memoryview)
+        self.assertEqual([1000, 1000, 1000], [len(c) for c in chunks])
+        self.assertEqual(contents[7:3007], b"".join(chunks))
+        self.assertIsNone(chunked.fp)
+
+        self.assertEqual(b"", b"".join(
+            ChunkedFile(self._write_file(b""), use_mmap=True)))
+
+    def test_get_mmap_reads(self):
+        self.config(filesystem_store_mmap_reads=True)
+        contents = b"*" * units.Ki
+        loc = self.store.add(str(uuid.uuid4()), six.BytesIO(contents),
+                             len(contents))[0]
+        uri = location.get_location_from_uri(loc, conf=self.conf)
+        image_file, image_size = self.store.get(uri)
+        self.assertTrue(image_file.use_mmap)
+        self.assertEqual(contents, b"".join(image_file))
+
+    def _test_add_direct_io(self):
+        self.config(filesystem_store_direct_io_size=1)
+        self.store.WRITE_CHUNKSIZE = 10000
+        contents = (b"*" * units.Mi + b"\0" * (200 * units.Ki) +
+                    b"*" * 10)
+        image_id = str(uuid.uuid4())
+        loc, size, checksum, _ = self.store.add(
+            image_id, six.BytesIO(contents), len(contents))
+        self.assertEqual(len(contents), size)
+        self.assertEqual(hashlib.md5(contents).hexdigest(), checksum)
+        with open(os.path.join(self.test_dir, image_id), 'rb') as f:
+            self.assertEqual(contents, f.read())
+        self.assertEqual([image_id], os.listdir(self.test_dir))
+
+    @mock.patch('glance_store._drivers.filesystem._DIRECT_IO_BUFFER_SIZE',
+                64 * units.Ki)
+    def test_add_direct_io(self):
+        os_open = os.open
+        with mock.patch.object(os, 'open', side_effect=os_open) as mock_open:
+            self._test_add_direct_io()
+        self.assertTrue(mock_open.call_args[0][1] & os.O_DIRECT)
+
+    def test_add_direct_io_unsupported(self):
+        with mock.patch.object(os, 'open',
+                               side_effect=OSError(errno.EINVAL, 'nope')):
+            self._test_add_direct_io()
+
+    @mock.patch('glance_store._drivers.filesystem._DROP_BEHIND_INTERVAL',
+                units.Ki)
+    @mock.patch('glance_store._drivers.filesystem._fadvise')
+    def test_add_drops_cache(self, fadvise):
+        self.config(filesystem_store_fadvise=True,
+                    filesystem_store_drop_cache_size=0)
+        self.store.WRITE_CHUNKSIZE = units.Ki
+        self.store.add(str(uuid.uuid4()), six.BytesIO(b"*" * (3 * units.Ki)),
+                       3 * units.Ki)
+        self.assertEqual([(0, units.Ki), (0, 2 * units.Ki),
+                          (units.Ki, 2 * units.Ki), (2 * units.Ki, units.Ki)],
+                         [c[0][1:3] for c in fadvise.call_args_list])
+        self.assertEqual(set(['POSIX_FADV_DONTNEED']),
+                         set(c[0][3] for c in fadvise.call_args_list))
+
+    @mock.patch('glance_store._drivers.filesystem._DROP_BEHIND_INTERVAL',
+                units.Ki)
+    @mock.patch('glance_store._drivers.filesystem._READAHEAD', units.Ki)
+    @mock.patch('glance_store._drivers.filesystem._fadvise')
+    def test_get_fadvise(self, fadvise):
+        self.config(filesystem_store_fadvise=True,
+                    filesystem_store_drop_cache_size=0)
+        contents = b"*" * (2 * units.Ki + 10)
+        loc = self.store.add(str(uuid.uuid4()), six.BytesIO(contents),
+                             len(contents))[0]
+        fadvise.reset_mock()
+        uri = location.get_location_from_uri(loc, conf=self.conf)
+        Store.READ_CHUNKSIZE = units.Ki
+        image_file, image_size = self.store.get(uri)
+        self.assertEqual(contents, b"".join(image_file))
+        self.assertEqual(
+            [(0, len(contents), 'POSIX_FADV_SEQUENTIAL'),
+             (0, units.Ki, 'POSIX_FADV_WILLNEED'),
+             (units.Ki, units.Ki, 'POSIX_FADV_WILLNEED'),
+             (0, units.Ki, 'POSIX_FADV_DONTNEED'),
+             (2 * units.Ki, 10, 'POSIX_FADV_WILLNEED'),
+             (units.Ki, units.Ki, 'POSIX_FADV_DONTNEED'),
+             (2 * units.Ki, 10, 'POSIX_FADV_DONTNEED')],
+            [c[0][1:] for c in fadvise.call_args_list])
+
     def test_add_check_metadata_with_invalid_mountpoint_location(self):
         in_metadata = [{'id': 'abcdefg',
                        'mountpoint': '/xyz/images'}]
@@ -201,6 +565,45 @@ class TestStore(base.StoreBaseTest,
         location, size, checksum, metadata = self._store_image(in_metadata)
         self.assertEqual(in_metadata[0], metadata)
 
+    def test_add_check_metadata_longest_mountpoint(self):
+        in_metadata = [{'id': 'abcdefg', 'mountpoint': '/'},
+                       {'id': 'xyz1234', 'mountpoint': self.test_dir},
+                       {'id': 'pqr5678', 'mountpoint': self.test_dir + 'x'}]
+        metadata = self._store_image(in_metadata)[3]
+        self.assertEqual('xyz1234', metadata['id'])
+
+    def test_get_metadata_cached_per_datadir(self):
+        self.store.FILESYSTEM_STORE_METADATA = [
+            {'id': 'abcdefg', 'mountpoint': '/xyz'}]
+        path = os.path.join(self.test_dir, 'image')
+        with mock.patch.object(filesystem.LOG, 'error') as error:
+            for _i in range(3):
+                self.assertEqual({}, self.store._get_metadata(path,
+                                                              self.test_dir))
+        self.assertEqual(1, error.call_count)
+
+        self.store.FILESYSTEM_STORE_METADATA = [
+            {'id': 'abcdefg', 'mountpoint': self.test_dir}]
+        with mock.patch.object(filesystem.MountpointIndex,
+                               'lookup') as lookup:
+            lookup.return_value = {'id': 'abcdefg'}
+            for _i in range(3):
+                self.assertEqual({'id': 'abcdefg'},
+                                 self.store._get_metadata(path,
+                                                          self.test_dir))
+        self.assertEqual(1, lookup.call_count)
+
+    def test_mountpoint_index(self):
+        index = filesystem.MountpointIndex(
+            [{'id': 'a', 'mountpoint': '/mnt/nfs'},
+             {'id': 'b', 'mountpoint': '/mnt/nfs/b'},
+             {'id': 'c', 'mountpoint': '/mnt/nfs/b'}])
+        self.assertEqual('b', index.lookup('/mnt/nfs/b/img')['id'])
+        self.assertEqual('a', index.lookup('/mnt/nfs/c/img')['id'])
+        self.assertIsNone(index.lookup('/mnt/other/img'))
+        self.assertTrue(index.resolves('/mnt/nfs/b'))
+        self.assertFalse(index.resolves('/mnt'))
+
     def test_add_check_metadata_bad_nosuch_file(self):
         expected_image_id = str(uuid.uuid4())
         jsonfilename = os.path.join(self.test_dir,
@@ -306,6 +709,7 @@ class TestStore(base.StoreBaseTest,
                               self.store.add,
                               image_id, image_file, 0)
             self.assertFalse(os.path.exists(path))
+            self.assertEqual([], os.listdir(self.test_dir))
 
     def test_delete(self):
         """
@@ -610,6 +1014,509 @@ class TestStore(base.StoreBaseTest,
                               expected_image_id, image_file,
                               expected_file_size)
 
+    def test_find_best_datadir_deducts_reserved_space(self):
+        store_map = [self.useFixture(fixtures.TempDir()).path,
+                     self.useFixture(fixtures.TempDir()).path]
+        self.conf.clear_override('filesystem_store_datadir',
+                                 group='glance_store')
+        self.conf.set_override('filesystem_store_datadirs',
+                               [store_map[0] + ":100",
+                                store_map[1] + ":100"],
+                               group='glance_store')
+        self.store.configure_add()
+
+        capacity = {store_map[0]: 10 * units.Ki, store_map[1]: 8 * units.Ki}
+        with mock.patch.object(self.store, '_get_capacity_info',
+                               side_effect=capacity.get):
+            self.assertEqual(store_map[0],
+                             self.store._find_best_datadir(5 * units.Ki))
+            # The first upload is still running
+            self.assertEqual(store_map[1],
+                             self.store._find_best_datadir(5 * units.Ki))
+            self.assertRaises(exceptions.StorageFull,
+                              self.store._find_best_datadir, 6 * units.Ki)
+
+            self.store._release_space(store_map[0], 5 * units.Ki)
+            self.assertEqual(store_map[0],
+                             self.store._find_best_datadir(6 * units.Ki))
+            self.store._release_space(store_map[0], 6 * units.Ki)
+            self.store._release_space(store_map[1], 5 * units.Ki)
+        self.assertEqual({}, self.store._capacity._reserved)
+
+    def test_capacity_tracker_caches_space(self):
+        probe = mock.Mock(return_value=(100, 1000))
+        tracker = filesystem.CapacityTracker(probe, ttl=60)
+        self.assertEqual(100, tracker.free_space('/a'))
+        tracker.reserve('/a', 30)
+        self.assertEqual(70, tracker.free_space('/a'))
+        self.assertEqual(1, probe.call_count)
+
+        tracker.ttl = 0
+        self.assertEqual(70, tracker.free_space('/a'))
+        self.assertEqual(2, probe.call_count)
+
+        tracker.release('/a', 30)
+        self.assertEqual({'/a': {'total': 1000, 'free': 100, 'reserved': 0,
+                                 'utilization': 0.9}},
+                         tracker.utilization(['/a']))
+
+    def test_capacity_tracker_refreshes_in_background(self):
+        probe = mock.Mock(return_value=(100, 1000))
+        tracker = filesystem.CapacityTracker(probe, ttl=60)
+        tracker.free_space('/a')
+        probe.return_value = (50, 1000)
+        with mock.patch.object(time, 'time', return_value=time.time() + 61):
+            with mock.patch.object(threading, 'Thread') as thread:
+                # The stale value is used while it is refreshed
+                self.assertEqual(100, tracker.free_space('/a'))
+                self.assertEqual(100, tracker.free_space('/a'))
+            self.assertEqual(1, thread.call_count)
+            thread.call_args[1]['target']()
+        self.assertEqual(50, tracker.free_space('/a'))
+        self.assertEqual(2, probe.call_count)
+
+    def test_capacity_tracker_probes_again_after_release(self):
+        probe = mock.Mock(return_value=(100, 1000))
+        tracker = filesystem.CapacityTracker(probe, ttl=60)
+        tracker.reserve('/a', 30)
+        self.assertEqual(70, tracker.free_space('/a'))
+        # The image was written, the space it took isn't free anymore
+        probe.return_value = (70, 1000)
+        tracker.release('/a', 30)
+        self.assertEqual(70, tracker.free_space('/a'))
+        self.assertEqual(2, probe.call_count)
+        self.assertEqual(70, tracker.free_space('/a'))
+        self.assertEqual(2, probe.call_count)
+
+    def test_capacity_tracker_discards_probe_started_before_release(self):
+        tracker = filesystem.CapacityTracker(None, ttl=60)
+
+        def release_while_probing(datadir):
+            tracker.release(datadir, 30)
+            return (100, 1000)
+
+        tracker.probe = release_while_probing
+        tracker.reserve('/a', 30)
+        self.assertEqual((100, 1000), tracker.refresh('/a'))
+        tracker.probe = mock.Mock(return_value=(70, 1000))
+        self.assertEqual(70, tracker.free_space('/a'))
+
+    def test_update_capabilities_exposes_capacity(self):
+        with mock.patch.object(self.store, '_probe_capacity',
+                               return_value=(250, 1000)):
+            self.store._find_best_datadir(50)
+            self.store.update_capabilities()
+        self.assertEqual({self.test_dir: {'total': 1000, 'free': 200,
+                                          'reserved': 50,
+                                          'utilization': 0.8}},
+                         self.store.capacity)
+
+    def test_add_releases_reserved_space(self):
+        self.store.add(str(uuid.uuid4()), six.BytesIO(b"*"), 1)
+        image_file = six.BytesIO(b"*")
+        with mock.patch.object(image_file, 'read', side_effect=IOError()):
+            self.assertRaises(IOError, self.store.add, str(uuid.uuid4()),
+                              image_file, 1)
+        self.assertEqual({}, self.store._capacity._reserved)
+
+    def test_add_preallocates(self):
+        self.config(filesystem_store_preallocate=True)
+        contents = b"*" * units.Ki + b"\0" * (100 * units.Ki)
+        image_id = str(uuid.uuid4())
+        with mock.patch.object(os, 'posix_fallocate',
+                               side_effect=os.posix_fallocate) as fallocate:
+            self.store.add(image_id, six.BytesIO(contents), len(contents))
+        self.assertEqual(len(contents), fallocate.call_args[0][2])
+        with open(os.path.join(self.test_dir, image_id), 'rb') as f:
+            self.assertEqual(contents, f.read())
+
+    def test_add_preallocate_storage_full(self):
+        self.config(filesystem_store_preallocate=True)
+        image_file = six.BytesIO(b"*" * units.Ki)
+        with mock.patch.object(os, 'posix_fallocate',
+                               side_effect=OSError(errno.ENOSPC, 'full')):
+            self.assertRaises(exceptions.StorageFull, self.store.add,
+                              str(uuid.uuid4()), image_file, units.Ki)
+        self.assertEqual(0, image_file.tell())
+        self.assertEqual([], os.listdir(self.test_dir))
+
+    def test_add_preallocate_unsupported(self):
+        self.config(filesystem_store_preallocate=True)
+        image_id = str(uuid.uuid4())
+        with mock.patch.object(os, 'posix_fallocate',
+                               side_effect=OSError(errno.EOPNOTSUPP, 'no')):
+            self.store.add(image_id, six.BytesIO(b"*" * units.Ki), units.Ki)
+        self.assertEqual(units.Ki,
+                         os.path.getsize(os.path.join(self.test_dir,
+                                                      image_id)))
+
+    def test_add_with_fanout(self):
+        self.config(filesystem_store_fanout=2)
+        image_id = str(uuid.uuid4())
+        contents = b"*" * units.Ki
+        loc = self.store.add(image_id, six.BytesIO(contents), units.Ki)[0]
+        digest = hashlib.sha256(image_id.encode('utf-8')).hexdigest()
+        expected = os.path.join(self.test_dir, digest[:2], digest[2:4],
+                                image_id)
+        self.assertEqual('file://%s' % expected, loc)
+        self.assertEqual([image_id], os.listdir(os.path.dirname(expected)))
+
+        uri = location.get_location_from_uri(loc, conf=self.conf)
+        self.assertEqual(contents, b"".join(self.store.get(uri)[0]))
+        self.assertRaises(exceptions.Duplicate, self.store.add, image_id,
+                          six.BytesIO(contents), units.Ki)
+
+    def test_add_with_fanout_directory_removed_concurrently(self):
+        self.config(filesystem_store_fanout=2)
+        image_id = str(uuid.uuid4())
+        link = os.link
+        removed = []
+
+        def remove_directories_first(src, dst):
+            if not removed:
+                # A migration removing the empty directories just created
+                os.rmdir(os.path.dirname(dst))
+                os.rmdir(os.path.dirname(os.path.dirname(dst)))
+                removed.append(dst)
+            return link(src, dst)
+
+        with mock.patch.object(os, 'link',
+                               side_effect=remove_directories_first):
+            loc = self.store.add(image_id, six.BytesIO(b"*" * 10), 10)[0]
+        self.assertEqual(1, len(removed))
+        uri = location.get_location_from_uri(loc, conf=self.conf)
+        self.assertEqual(b"*" * 10, b"".join(self.store.get(uri)[0]))
+
+    def test_get_after_fanout_change(self):
+        image_id = str(uuid.uuid4())
+        contents = b"*" * units.Ki
+        flat_loc = self.store.add(image_id, six.BytesIO(contents),
+                                  units.Ki)[0]
+        self.config(filesystem_store_fanout=1)
+        self.assertRaises(exceptions.Duplicate, self.store.add, image_id,
+                          six.BytesIO(contents), units.Ki)
+
+        # The image file is moved to the new layout
+        sharded = filesystem.image_path(self.test_dir, image_id, 1)
+        os.mkdir(os.path.dirname(sharded))
+        os.rename(flat_loc[len('file://'):], sharded)
+        uri = location.get_location_from_uri(flat_loc, conf=self.conf)
+        self.assertEqual(units.Ki, self.store.get_size(uri))
+        self.assertEqual(contents, b"".join(self.store.get(uri)[0]))
+        self.store.delete(uri)
+        self.assertFalse(os.path.exists(sharded))
+        self.assertRaises(exceptions.NotFound, self.store.get, uri)
+
+    def test_get_unrelated_path_not_resolved(self):
+        image_id = str(uuid.uuid4())
+        self.store.add(image_id, six.BytesIO(b"*"), 1)
+        uri = location.get_location_from_uri(
+            'file://%s/zz/%s' % (self.test_dir, image_id), conf=self.conf)
+        self.assertRaises(exceptions.NotFound, self.store.get, uri)
+
+    def _write_image(self, contents):
+        path = os.path.join(self.test_dir, str(uuid.uuid4()))
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def test_parallel_chunked_file(self):
+        contents = os.urandom(10000)
+        path = self._write_image(contents)
+        for offset, length in ((0, None), (0, 1000), (999, 5001),
+                               (9990, None), (5000, 20000)):
+            chunks = ParallelChunkedFile(path, offset=offset, chunk_size=1000,
+                                         partial_length=length, threads=3)
+            data = [bytes(chunk) for chunk in chunks]
+            end = offset + length if length else None
+            self.assertEqual(contents[offset:end], b"".join(data))
+            self.assertTrue(all(len(chunk) <= 1000 for chunk in data))
+            self.assertIsNone(chunks.fp)
+
+    def test_parallel_chunked_file_chunks_kept(self):
+        contents = os.urandom(20000)
+        path = self._write_image(contents)
+        # All the chunks are taken before any is compared, while the
+        # buffers they were read into are reused for the chunks after
+        chunks = list(ParallelChunkedFile(path, chunk_size=1000, threads=2))
+        self.assertEqual(20, len(chunks))
+        self.assertEqual(contents, b"".join(chunks))
+
+    def test_parallel_chunked_file_reads_off_the_hub(self):
+        path = self._write_image(b"*" * 4000)
+        with mock.patch.object(utils, 'run_blocking',
+                               side_effect=utils.run_blocking) as blocking:
+            chunks = list(ParallelChunkedFile(path, chunk_size=1000,
+                                              threads=2))
+        self.assertEqual(b"*" * 4000, b"".join(chunks))
+        self.assertEqual([filesystem._pread_into] * 4,
+                         [c[0][0] for c in blocking.call_args_list])
+
+    def test_parallel_chunked_file_read_failure(self):
+        path = self._write_image(b"*" * 10000)
+        chunks = ParallelChunkedFile(path, chunk_size=1000, threads=2)
+        pread_into = filesystem._pread_into
+
+        def fail_at_second_chunk(fd, buf, length, offset):
+            if offset == 1000:
+                raise OSError(errno.EIO, 'bad')
+            return pread_into(fd, buf, length, offset)
+
+        with mock.patch.object(filesystem, '_pread_into',
+                               side_effect=fail_at_second_chunk):
+            self.assertRaises(OSError, list, chunks)
+        self.assertIsNone(chunks.fp)
+
+    def test_parallel_chunked_file_closed_early(self):
+        path = self._write_image(b"*" * 100000)
+        chunks = ParallelChunkedFile(path, chunk_size=1000, threads=4)
+        iterator = iter(chunks)
+        self.assertEqual(b"*" * 1000, bytes(next(iterator)))
+        iterator.close()
+        self.assertTrue(chunks._stopped)
+        self.assertIsNone(chunks.fp)
+
+    def test_get_parallel(self):
+        self.config(filesystem_store_read_threads=4,
+                    filesystem_store_parallel_read_size=0)
+        contents = os.urandom(1000)
+        image_id = str(uuid.uuid4())
+        loc = self.store.add(image_id, six.BytesIO(contents), 1000)[0]
+        uri = location.get_location_from_uri(loc, conf=self.conf)
+        chunks, size = self.store.get(uri, offset=10, chunk_size=500)
+        # The data of get() is wrapped to record the read in the metrics
+        self.assertIsInstance(chunks.wrapped, ParallelChunkedFile)
+        self.assertEqual(500, size)
+        self.assertEqual(contents[10:510],
+                         b"".join(bytes(chunk) for chunk in chunks))
+
+        self.config(filesystem_store_parallel_read_size=1)
+        self.assertNotIsInstance(self.store.get(uri)[0].wrapped,
+                                 ParallelChunkedFile)
+
+    def _add_for_clone(self, contents=b"clone me" * 1000):
+        image_id = str(uuid.uuid4())
+        loc = self.store.add(image_id, six.BytesIO(contents),
+                             len(contents))[0]
+        return location.get_location_from_uri(loc, conf=self.conf)
+
+    def test_clone_with_copy_file_range(self):
+        uri = self._add_for_clone()
+        image_id = str(uuid.uuid4())
+        with mock.patch.object(filesystem.fcntl, 'ioctl',
+                               side_effect=IOError(errno.EOPNOTSUPP, 'no')):
+            loc, size, checksum, metadata = self.store.clone(uri, image_id)
+        self.assertEqual('file://%s/%s' % (self.test_dir, image_id), loc)
+        self.assertEqual(8000, size)
+        self.assertIsNone(checksum)
+        with open(os.path.join(self.test_dir, image_id), 'rb') as f:
+            self.assertEqual(b"clone me" * 1000, f.read())
+        self.assertRaises(exceptions.Duplicate, self.store.clone, uri,
+                          image_id)
+        self.assertEqual({}, self.store._capacity._reserved)
+
+    def test_clone_short_copy(self):
+        uri = self._add_for_clone()
+        image_id = str(uuid.uuid4())
+        with mock.patch.object(filesystem.fcntl, 'ioctl',
+                               side_effect=IOError(errno.EOPNOTSUPP, 'no')):
+            # The source file was truncated after its size was read
+            with mock.patch.object(os, 'copy_file_range', create=True,
+                                   side_effect=[5000, 0]):
+                self.assertRaises(IOError, self.store.clone, uri, image_id)
+        self.assertEqual(1, len(os.listdir(self.test_dir)))
+        self.assertEqual({}, self.store._capacity._reserved)
+
+    def test_clone_with_reflink(self):
+        uri = self._add_for_clone()
+        image_id = str(uuid.uuid4())
+        with mock.patch.object(filesystem.fcntl, 'ioctl') as ioctl:
+            loc = self.store.clone(uri, image_id)[0]
+        self.assertEqual(filesystem._FICLONE, ioctl.call_args[0][1])
+        self.assertTrue(os.path.exists(loc[len('file://'):]))
+
+    def test_clone_unsupported(self):
+        uri = self._add_for_clone()
+        with mock.patch.object(filesystem.fcntl, 'ioctl',
+                               side_effect=IOError(errno.ENOTTY, 'no')):
+            with mock.patch.object(os, 'copy_file_range', create=True,
+                                   side_effect=OSError(errno.EXDEV, 'no')):
+                self.assertIsNone(self.store.clone(uri, str(uuid.uuid4())))
+        self.assertEqual(1, len(os.listdir(self.test_dir)))
+
+        self.config(filesystem_store_fast_clone=False)
+        self.assertIsNone(self.store.clone(uri, str(uuid.uuid4())))
+
+    def test_copy_between_stores_clones(self):
+        contents = b"clone me" * 1000
+        uri = self._add_for_clone(contents)
+        src_uri = uri.store_location.get_uri()
+        image_id = str(uuid.uuid4())
+        result = backend.copy_between_stores(src_uri, 'file', image_id,
+                                             conf=self.conf)
+        self.assertEqual(('file://%s/%s' % (self.test_dir, image_id),
+                          len(contents), hashlib.md5(contents).hexdigest()),
+                         result[:3])
+
+        with mock.patch.object(backend, 'get_from_backend') as get:
+            result = backend.copy_between_stores(src_uri, 'file',
+                                                 str(uuid.uuid4()),
+                                                 conf=self.conf,
+                                                 checksum='known')
+        self.assertFalse(get.called)
+        self.assertEqual('known', result[2])
+
+    def _configure_striping(self, count=3, width=2):
+        store_map = [self.useFixture(fixtures.TempDir()).path
+                     for _i in range(count)]
+        self.conf.clear_override('filesystem_store_datadir',
+                                 group='glance_store')
+        self.config(filesystem_store_datadirs=[d + ":100" for d in store_map],
+                    filesystem_store_stripe_width=width,
+                    filesystem_store_stripe_size=1)
+        self.store.configure_add()
+        self.store.READ_CHUNKSIZE = 64 * units.Ki
+        return store_map
+
+    def test_add_striped(self):
+        store_map = self._configure_striping()
+        image_id = str(uuid.uuid4())
+        contents = os.urandom(units.Mi * 5 // 2)
+        capacity = dict((d, 10 * units.Mi) for d in store_map)
+        capacity[store_map[1]] = 20 * units.Mi
+        with mock.patch.object(self.store, '_get_capacity_info',
+                               side_effect=capacity.get):
+            loc, size, checksum, _ = self.store.add(
+                image_id, six.BytesIO(contents), len(contents))
+        self.assertEqual({}, self.store._capacity._reserved)
+        self.assertEqual(len(contents), size)
+        self.assertEqual(hashlib.md5(contents).hexdigest(), checksum)
+        manifest = os.path.join(store_map[1], image_id + '.stripes')
+        self.assertEqual('file://%s' % manifest, loc)
+
+        # The extents alternate between the datadirs with the most space
+        for i, datadir in enumerate((store_map[1], store_map[0],
+                                     store_map[1])):
+            with open(os.path.join(datadir, '%s.%d' % (image_id, i)),
+                      'rb') as f:
+                self.assertEqual(contents[i * units.Mi:(i + 1) * units.Mi],
+                                 f.read())
+        self.assertEqual([], os.listdir(store_map[2]))
+
+        uri = location.get_location_from_uri(loc, conf=self.conf)
+        self.assertEqual(len(contents), self.store.get_size(uri))
+        self.assertEqual(contents, b"".join(self.store.get(uri)[0]))
+        for offset, length in ((0, 10), (units.Mi - 5, 10),
+                               (units.Mi * 2, None), (100, units.Mi * 2)):
+            chunks, size = self.store.get(uri, offset=offset,
+                                          chunk_size=length)
+            end = offset + length if length else None
+            self.assertEqual(contents[offset:end], b"".join(chunks))
+
+        with mock.patch.object(self.store, '_get_capacity_info',
+                               side_effect=capacity.get):
+            self.assertRaises(exceptions.Duplicate, self.store.add, image_id,
+                              six.BytesIO(contents), len(contents))
+        self.store.delete(uri)
+        for datadir in store_map:
+            self.assertEqual([], os.listdir(datadir))
+        self.assertRaises(exceptions.NotFound, self.store.get, uri)
+
+    def test_add_small_image_not_striped(self):
+        self._configure_striping()
+        image_id = str(uuid.uuid4())
+        loc = self.store.add(image_id, six.BytesIO(b"*" * units.Ki),
+                             units.Ki)[0]
+        self.assertFalse(loc.endswith('.stripes'))
+
+    def test_add_not_striped_without_enough_space(self):
+        store_map = self._configure_striping()
+        image_id = str(uuid.uuid4())
+        contents = b"*" * (units.Mi * 3)
+        capacity = dict((d, units.Mi) for d in store_map)
+        capacity[store_map[0]] = 10 * units.Mi
+        with mock.patch.object(self.store, '_get_capacity_info',
+                               side_effect=capacity.get):
+            loc = self.store.add(image_id, six.BytesIO(contents),
+                                 len(contents))[0]
+        self.assertEqual('file://%s' % os.path.join(store_map[0], image_id),
+                         loc)
+        self.assertEqual({}, self.store._capacity._reserved)
+
+    def test_add_striped_iterator(self):
+        store_map = self._configure_striping(count=2)
+        image_id = str(uuid.uuid4())
+        contents = os.urandom(units.Mi * 5 // 2)
+        # Chunks which don't line up with the extents
+        chunks = [contents[i:i + 300 * units.Ki]
+                  for i in range(0, len(contents), 300 * units.Ki)]
+        loc, size, checksum, _ = self.store.add(image_id, iter(chunks),
+                                                len(contents))
+        self.assertEqual(len(contents), size)
+        self.assertEqual(hashlib.md5(contents).hexdigest(), checksum)
+        extents = sorted(name for datadir in store_map
+                         for name in os.listdir(datadir)
+                         if not name.endswith('.stripes'))
+        self.assertEqual(['%s.%d' % (image_id, i) for i in range(3)],
+                         extents)
+        uri = location.get_location_from_uri(loc, conf=self.conf)
+        self.assertEqual(contents, b"".join(self.store.get(uri)[0]))
+
+    def test_striped_io_off_the_hub(self):
+        self._configure_striping(count=2)
+        self.store.WRITE_CHUNKSIZE = 64 * units.Ki
+        contents = os.urandom(units.Mi * 5 // 2)
+        with mock.patch.object(utils, 'run_blocking',
+                               side_effect=utils.run_blocking) as blocking:
+            loc = self.store.add(str(uuid.uuid4()), six.BytesIO(contents),
+                                 len(contents))[0]
+        funcs = [c[0][0] for c in blocking.call_args_list]
+        # Each of the 64KiB chunks of the 3 extents
+        self.assertEqual(40, funcs.count(Store._write_sparse))
+
+        uri = location.get_location_from_uri(loc, conf=self.conf)
+        with mock.patch.object(utils, 'run_blocking',
+                               side_effect=utils.run_blocking) as blocking:
+            self.assertEqual(contents, b"".join(self.store.get(uri)[0]))
+        funcs = [c[0][0] for c in blocking.call_args_list]
+        # Each of the chunks, then the end, of the 3 extents
+        self.assertEqual(43, funcs.count(next))
+
+    def test_add_striped_write_failure(self):
+        store_map = self._configure_striping(count=2)
+        contents = b"*" * (units.Mi * 3)
+        original = Store._rename_into_place
+
+        def rename_into_place(store, temppath, filepath, sync):
+            if filepath.endswith('.1'):
+                raise OSError(errno.ENOSPC, 'full')
+            return original(store, temppath, filepath, sync)
+
+        with mock.patch.object(Store, '_rename_into_place',
+                               rename_into_place):
+            self.assertRaises(exceptions.StorageFull, self.store.add,
+                              str(uuid.uuid4()), six.BytesIO(contents),
+                              len(contents))
+        for datadir in store_map:
+            self.assertEqual([], os.listdir(datadir))
+        self.assertEqual({}, self.store._capacity._reserved)
+
+    def test_add_striped_read_failure(self):
+        store_map = self._configure_striping(count=2)
+        image_file = six.BytesIO(b"*" * (units.Mi * 3))
+        read = image_file.read
+
+        def fail_after_first_extent(size=-1):
+            if image_file.tell() > units.Mi:
+                raise IOError(errno.EIO, 'bad read')
+            return read(size)
+
+        image_file.read = fail_after_first_extent
+        self.assertRaises(IOError, self.store.add, str(uuid.uuid4()),
+                          image_file, units.Mi * 3)
+        for datadir in store_map:
+            self.assertEqual([], os.listdir(datadir))
+
     def test_configure_add_with_file_perm(self):
         """
         Tests filesystem specified by filesystem_store_file_perm
@@ -14,6 +14,7 @@
 #    under the License.
 
 import mock
+import six
 
 import glance_store
 from glance_store._drivers import http
@@ -62,6 +63,20 @@ class TestHttpStore(base.StoreBaseTest,
         chunks = [c for c in image_file]
         self.assertEqual(expected_returns, chunks)
 
+    def test_http_get_indexable(self):
+        self._mock_httplib()
+        data = six.BytesIO(b'I am a teapot, short and stout\n')
+        self.response.return_value.read = data.read
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = location.get_location_from_uri(uri, conf=self.conf)
+        image_file = self.store.get(loc)[0]
+        # Copy-from sends the data by indexing it
+        self.assertEqual(31, len(image_file))
+        sent = b''
+        while len(sent) < len(image_file):
+            sent += bytes(image_file[len(sent):])
+        self.assertEqual(b'I am a teapot, short and stout\n', sent)
+
     def test_http_partial_get(self):
         uri = "http://netloc/path/to/file.tar.gz"
         loc = location.get_location_from_uri(uri, conf=self.conf)
@@ -94,6 +109,38 @@ class TestHttpStore(base.StoreBaseTest,
         chunks = [c for c in image_file]
         self.assertEqual(chunks, expected_returns)
 
+    def test_http_get_with_download_threads(self):
+        """Test a retrieval of an image in concurrent byte ranges."""
+        self.config(http_store_download_threads=3,
+                    http_store_download_range_size=1)
+        data = 'I am a teapot, short and stout\n'
+
+        def request(conn, verb, path, body, headers):
+            conn.fake_verb = verb
+            conn.fake_headers = headers
+
+        def getresponse(conn):
+            if conn.fake_verb == 'HEAD':
+                return utils.FakeHTTPResponse(
+                    headers={'content-length': len(data),
+                             'accept-ranges': 'bytes'})
+            start, end = conn.fake_headers['Range'][6:].split('-')
+            return utils.FakeHTTPResponse(status=206,
+                                          data=data[int(start):int(end) + 1])
+
+        conn_class = 'six.moves.http_client.HTTPConnection'
+        with mock.patch(conn_class + '.request', autospec=True,
+                        side_effect=request):
+            with mock.patch(conn_class + '.getresponse', autospec=True,
+                            side_effect=getresponse):
+                with mock.patch.object(http.units, 'Mi', 10):
+                    uri = "http://netloc/path/to/file.tar.gz"
+                    loc = location.get_location_from_uri(uri,
+                                                         conf=self.conf)
+                    (image_file, image_size) = self.store.get(loc)
+                self.assertEqual(31, image_size)
+                self.assertEqual(data, ''.join(image_file))
+
     def test_http_get_max_redirects(self):
         self._mock_httplib()
         redirect = {"location": "http://example.com/teapot.img"}
@@ -0,0 +1,83 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+import glance_store as store
+from glance_store._drivers import filesystem
+from glance_store import exceptions
+from glance_store import location
+from glance_store.tests import base
+
+
+class TestLocationCache(base.StoreBaseTest):
+
+    def setUp(self):
+        super(TestLocationCache, self).setUp()
+        self.config(stores=['file', 's3'], store_location_cache_size=2)
+        store.create_stores(self.conf)
+        self.addCleanup(location.set_location_cache_size, 0)
+
+    def _parse(self, uri):
+        with mock.patch.object(filesystem.StoreLocation, 'parse_uri',
+                               autospec=True,
+                               side_effect=filesystem.StoreLocation.parse_uri
+                               ) as parse_uri:
+            loc = location.get_location_from_uri(uri, conf=self.conf)
+        return loc, parse_uri.called
+
+    def test_parsed_once(self):
+        first, parsed = self._parse('file:///tmp/a')
+        self.assertTrue(parsed)
+        second, parsed = self._parse('file:///tmp/a')
+        self.assertFalse(parsed)
+        self.assertEqual('/tmp/a', second.store_location.path)
+
+    def test_cached_location_not_shared(self):
+        first, _parsed = self._parse('file:///tmp/a')
+        first.store_location.path = '/tmp/b'
+        second, parsed = self._parse('file:///tmp/a')
+        self.assertFalse(parsed)
+        self.assertIsNot(first, second)
+        self.assertEqual('/tmp/a', second.store_location.path)
+
+    def test_least_recently_used_evicted(self):
+        self._parse('file:///tmp/a')
+        self._parse('file:///tmp/b')
+        self._parse('file:///tmp/a')
+        self._parse('file:///tmp/c')
+        self.assertEqual(2, len(location._LOCATION_CACHE))
+        self.assertFalse(self._parse('file:///tmp/a')[1])
+        self.assertTrue(self._parse('file:///tmp/b')[1])
+
+    def test_credentials_not_in_keys(self):
+        uri = 's3://access:secret@s3.example.com/bucket/image'
+        loc = location.get_location_from_uri(uri, conf=self.conf)
+        self.assertEqual('secret', loc.store_location.secretkey)
+        for key in location._LOCATION_CACHE._entries:
+            self.assertNotIn(b'secret', key[0])
+
+    def test_unregistered_scheme_not_served(self):
+        self._parse('file:///tmp/a')
+        location.SCHEME_TO_CLS_MAP.pop('file')
+        self.assertRaises(exceptions.UnknownScheme,
+                          location.get_location_from_uri, 'file:///tmp/a',
+                          conf=self.conf)
+
+    def test_disabled(self):
+        location.set_location_cache_size(0)
+        self._parse('file:///tmp/a')
+        self.assertTrue(self._parse('file:///tmp/a')[1])
+        self.assertEqual(0, len(location._LOCATION_CACHE))
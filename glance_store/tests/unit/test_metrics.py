@@ -0,0 +1,186 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import socket
+
+import mock
+import six
+
+from glance_store._drivers import filesystem
+from glance_store import backend
+from glance_store import exceptions
+from glance_store import location
+from glance_store import metrics
+from glance_store.tests import base
+
+
+class TestMetrics(base.StoreBaseTest):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_percentiles(self):
+        stats = metrics.OperationStats()
+        self.assertIsNone(stats.percentile(50))
+        for i in range(98):
+            stats.record(0.0015, 10, False)
+        stats.record(0.1, 10, False)
+        stats.record(5000, 10, True)
+        self.assertEqual(0.002, stats.percentile(50))
+        self.assertEqual(0.002, stats.percentile(95))
+        self.assertEqual(0.128, stats.percentile(99))
+        self.assertEqual(metrics.BUCKETS[-1], stats.percentile(100))
+        self.assertEqual(1, stats.as_dict()['errors'])
+        self.assertEqual(1000, stats.as_dict()['bytes'])
+
+    def test_store_operations_recorded(self):
+        self.config(filesystem_store_datadir=self.test_dir)
+        store = filesystem.Store(self.conf)
+        store.configure()
+        self.register_store_schemes(store, 'file')
+
+        uri, size, checksum, _ = store.add('img', six.BytesIO(b'x' * 10), 10)
+        backend.get_size_from_backend(uri)
+        loc = location.get_location_from_uri(uri, conf=self.conf)
+        self.assertEqual(b'x' * 10, b''.join(store.get(loc)[0]))
+        store.delete(loc)
+        self.assertRaises(exceptions.NotFound, store.delete, loc)
+
+        stats = backend.get_store_stats()['file']
+        self.assertEqual(['add', 'delete', 'get', 'get_size'], sorted(stats))
+        self.assertEqual(1, stats['add']['count'])
+        self.assertEqual(10, stats['add']['bytes'])
+        self.assertEqual(10, stats['get']['bytes'])
+        self.assertEqual(2, stats['delete']['count'])
+        self.assertEqual(1, stats['delete']['errors'])
+        self.assertEqual(1, stats['get_size']['count'])
+        self.assertIsNotNone(stats['add']['p99'])
+
+    def test_get_recorded_once_data_is_read(self):
+        store = mock.Mock()
+        store.get_schemes.return_value = ('file',)
+        get = mock.Mock(return_value=(iter([b'ab', b'cd', b'e']), 5))
+        with mock.patch.object(metrics.time, 'time',
+                               side_effect=[10.0, 14.0]):
+            data, size = metrics.call(store, 'get', get)
+            self.assertEqual(5, size)
+            self.assertEqual({}, metrics.get_stats())
+            data = iter(data)
+            self.assertEqual(b'ab', next(data))
+            self.assertEqual({}, metrics.get_stats())
+            self.assertEqual(b'cde', b''.join(data))
+
+        stats = metrics.get_stats()['file']['get']
+        self.assertEqual(1, stats['count'])
+        self.assertEqual(5, stats['bytes'])
+        self.assertEqual(4.0, stats['seconds'])
+
+    def test_get_recorded_when_data_is_closed(self):
+        store = mock.Mock()
+        store.get_schemes.return_value = ('file',)
+        chunks = mock.MagicMock()
+        data, size = metrics.call(store, 'get',
+                                  mock.Mock(return_value=(chunks, 5)))
+        data.close()
+        data.close()
+        self.assertTrue(chunks.close.called)
+        stats = metrics.get_stats()['file']['get']
+        self.assertEqual(1, stats['count'])
+        self.assertEqual(0, stats['bytes'])
+
+    def test_get_of_indexable_stays_indexable(self):
+        class FileIndexable(backend.Indexable):
+            def another(self):
+                return self.read_chunk(self.wrapped, 4)
+
+        store = mock.Mock()
+        store.get_schemes.return_value = ('http',)
+        indexable = FileIndexable(six.BytesIO(b'0123456789'), 10)
+        data, size = metrics.call(store, 'get',
+                                  mock.Mock(return_value=(indexable, 10)))
+        self.assertEqual(10, len(data))
+        # Indexed the way eventlet's GreenSocket.sendall() does
+        sent = b''
+        while len(sent) < len(data):
+            chunk = data[len(sent):]
+            self.assertIsInstance(chunk, memoryview)
+            sent += bytes(chunk[:3])
+        self.assertEqual(b'0123456789', sent)
+        stats = metrics.get_stats()['http']['get']
+        self.assertEqual(1, stats['count'])
+        self.assertEqual(10, stats['bytes'])
+
+    def test_get_read_error_recorded(self):
+        def failing():
+            yield b'ab'
+            raise IOError()
+
+        store = mock.Mock()
+        store.get_schemes.return_value = ('file',)
+        data, size = metrics.call(store, 'get',
+                                  mock.Mock(return_value=(failing(), 5)))
+        self.assertRaises(IOError, b''.join, data)
+        stats = metrics.get_stats()['file']['get']
+        self.assertEqual(1, stats['errors'])
+        self.assertEqual(2, stats['bytes'])
+
+    def test_sink(self):
+        sink = mock.Mock()
+        metrics.register_sink(sink)
+        self.addCleanup(metrics.unregister_sink, sink)
+        metrics.record('file', 'add', 0.5, nbytes=3)
+        sink.assert_called_once_with('file', 'add', 0.5, 3, False)
+
+    def test_failing_sink_ignored(self):
+        sink = mock.Mock(side_effect=IOError())
+        metrics.register_sink(sink)
+        self.addCleanup(metrics.unregister_sink, sink)
+        metrics.record('file', 'add', 0.5)
+        self.assertEqual(1, metrics.get_stats()['file']['add']['count'])
+
+    def test_statsd_sink(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.config(store_metrics_statsd_address='127.0.0.1:%d' %
+                    server.getsockname()[1])
+        backend._configure_metrics(self.conf)
+        self.addCleanup(backend._configure_metrics, self.conf)
+        self.addCleanup(self.conf.clear_override,
+                        'store_metrics_statsd_address', 'glance_store')
+
+        metrics.record('rbd', 'get', 0.25, nbytes=42, error=True)
+        self.assertEqual(b'glance_store.rbd.get.count:1|c\n'
+                         b'glance_store.rbd.get.latency:250|ms\n'
+                         b'glance_store.rbd.get.bytes:42|c\n'
+                         b'glance_store.rbd.get.errors:1|c',
+                         server.recv(1024))
+
+    def test_format_prometheus(self):
+        metrics.record('file', 'add', 0.0015, nbytes=7)
+        text = metrics.format_prometheus()
+        self.assertIn('glance_store_operations_total'
+                      '{scheme="file",operation="add"} 1\n', text)
+        self.assertIn('glance_store_bytes_total'
+                      '{scheme="file",operation="add"} 7\n', text)
+        self.assertIn('glance_store_latency_seconds_bucket'
+                      '{scheme="file",operation="add",le="0.001"} 0\n', text)
+        self.assertIn('glance_store_latency_seconds_bucket'
+                      '{scheme="file",operation="add",le="0.002"} 1\n', text)
+        self.assertIn('glance_store_latency_seconds_count'
+                      '{scheme="file",operation="add"} 1\n', text)
@@ -59,16 +59,47 @@ class OptsTestCase(base.StoreBaseTest):
             'default_store',
             'stores',
             'store_capabilities_update_min_interval',
+            'store_cache_dir',
+            'store_cache_eviction_policy',
+            'store_cache_max_size',
+            'store_cache_schemes',
+            'store_driver_pool_size',
+            'store_fanout_buffer_size',
+            'store_checksum_algorithms',
+            'store_checksum_threads',
+            'store_metrics_statsd_address',
+            'store_lazy_load',
+            'store_location_cache_size',
+            'store_compression',
+            'store_compression_level',
+            'store_compression_frame_size',
+            'store_compression_schemes',
             'cinder_api_insecure',
             'cinder_ca_certificates_file',
             'cinder_catalog_info',
             'cinder_endpoint_template',
             'cinder_http_retries',
             'default_swift_reference',
+            'filesystem_store_capacity_cache_ttl',
             'filesystem_store_datadir',
             'filesystem_store_datadirs',
+            'filesystem_store_direct_io_size',
+            'filesystem_store_drop_cache_size',
+            'filesystem_store_durability',
+            'filesystem_store_fadvise',
+            'filesystem_store_fanout',
+            'filesystem_store_fast_clone',
             'filesystem_store_file_perm',
             'filesystem_store_metadata_file',
+            'filesystem_store_mmap_reads',
+            'filesystem_store_parallel_read_size',
+            'filesystem_store_preallocate',
+            'filesystem_store_read_threads',
+            'filesystem_store_stripe_size',
+            'filesystem_store_stripe_width',
+            'filesystem_store_temp_file_max_age',
+            'http_store_download_range_size',
+            'http_store_download_threads',
             'mongodb_store_db',
             'mongodb_store_uri',
             'os_region_name',
@@ -91,6 +122,8 @@ class OptsTestCase(base.StoreBaseTest):
             's3_store_proxy_port',
             's3_store_proxy_user',
             's3_store_proxy_password',
+            's3_store_download_range_size',
+            's3_store_download_threads',
             'sheepdog_store_address',
             'sheepdog_store_chunk_size',
             'sheepdog_store_port',
@@ -114,6 +147,8 @@ class OptsTestCase(base.StoreBaseTest):
             'swift_store_service_type',
             'swift_store_ssl_compression',
             'swift_store_user',
+            'swift_store_download_range_size',
+            'swift_store_download_threads',
             'vmware_api_insecure',
             'vmware_api_retry_count',
             'vmware_datacenter_path',
@@ -13,10 +13,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+
 import mock
 from oslo_utils import units
 import six
 
+from glance_store._drivers import filesystem
 from glance_store._drivers import rbd as rbd_store
 from glance_store import exceptions
 from glance_store.location import Location
@@ -182,6 +185,58 @@ class TestStore(base.StoreBaseTest,
                 self.assertTrue(write.called)
                 self.assertEqual(ret[1], self.data_len)
 
+    def test_add_skips_zero_blocks(self):
+        data = b'*' * 10 + b'\0' * (8 * units.Ki - 10) + b'*' * 10
+        self.store.WRITE_CHUNKSIZE = 8 * units.Ki
+        with mock.patch.object(rbd_store.rbd.Image, 'write') as write:
+            ret = self.store.add('fake_image_id', six.BytesIO(data),
+                                 len(data))
+        self.assertEqual(len(data), ret[1])
+        self.assertEqual([mock.call(data[:4 * units.Ki], 0),
+                          mock.call(data[8 * units.Ki:], 8 * units.Ki)],
+                         write.call_args_list)
+
+    def test_add_from_memory_mapped_file(self):
+        path = os.path.join(self.test_dir, 'image')
+        with open(path, 'wb') as f:
+            f.write(b'*' * self.data_len)
+        chunks = filesystem.ChunkedFile(path, chunk_size=units.Ki,
+                                        use_mmap=True)
+        with mock.patch.object(rbd_store.rbd.Image, 'write') as write:
+            self.store.add('fake_image_id', iter(chunks), self.data_len)
+        self.assertEqual(3, write.call_count)
+        for call in write.call_args_list:
+            self.assertIs(bytes, type(call[0][0]))
+
+    def test_get_skips_unallocated_extents(self):
+        def diff_iterate(image, offset, length, from_snapshot, iterate_cb):
+            iterate_cb(0, 2, True)
+            iterate_cb(2, 3, True)
+            iterate_cb(9, 1, False)
+
+        image = rbd_store.ImageIterator('fake_pool', 'fake_image', None,
+                                        self.store, chunk_size=4)
+        with mock.patch.multiple(MockRBD.Image, create=True,
+                                 stat=lambda self: {'size': 12},
+                                 diff_iterate=diff_iterate):
+            with mock.patch.object(MockRBD.Image, 'read',
+                                   side_effect=lambda offset, length:
+                                   b'*' * length) as read:
+                self.assertEqual(b'*' * 8 + b'\0' * 4, b''.join(image))
+        self.assertEqual([mock.call(0, 4), mock.call(4, 4)],
+                         read.call_args_list)
+
+    def test_get_without_diff_iterate(self):
+        image = rbd_store.ImageIterator('fake_pool', 'fake_image', None,
+                                        self.store, chunk_size=4)
+        with mock.patch.object(MockRBD.Image, 'stat', create=True,
+                               return_value={'size': 6}):
+            with mock.patch.object(MockRBD.Image, 'read',
+                                   side_effect=lambda offset, length:
+                                   b'*' * length) as read:
+                self.assertEqual(b'*' * 6, b''.join(image))
+        self.assertEqual(2, read.call_count)
+
     @mock.patch.object(MockRBD.Image, '__enter__')
     @mock.patch.object(rbd_store.Store, '_create_image')
     @mock.patch.object(rbd_store.Store, '_delete_image')
@@ -293,6 +348,24 @@ class TestStore(base.StoreBaseTest,
 
             self.called_commands_expected = ['remove']
 
+    def test_get_reads_to_the_end(self):
+        """
+        Tests the image iterator ends without raising StopIteration,
+        which is a RuntimeError in generators as of Python 3.7 (PEP 479).
+        """
+        loc = Location('test_rbd_store', rbd_store.StoreLocation, self.conf,
+                       store_specs=self.store_specs)
+        self.store.READ_CHUNKSIZE = 4
+        with mock.patch.object(MockRBD.Image, 'stat', create=True,
+                               return_value={'size': 10}):
+            with mock.patch.object(MockRBD.Image, 'read',
+                                   side_effect=lambda offset, length:
+                                   b'*' * length):
+                (image, size) = self.store.get(loc)
+                chunks = list(image)
+        self.assertEqual(10, size)
+        self.assertEqual([b'****', b'****', b'**'], chunks)
+
     def test_get_partial_image(self):
         loc = Location('test_rbd_store', rbd_store.StoreLocation, self.conf,
                        store_specs=self.store_specs)
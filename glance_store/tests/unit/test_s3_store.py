@@ -15,6 +15,7 @@
 
 """Tests the S3 backend store"""
 
+import copy
 import hashlib
 import uuid
 import xml.etree.ElementTree
@@ -108,6 +109,18 @@ class FakeKey(object):
     def get_file(self):
         return self.data
 
+    def get_contents_as_string(self, headers=None):
+        data = self.data.getvalue()
+        byte_range = (headers or {}).get('Range')
+        if byte_range:
+            start, end = byte_range.split('=')[1].split('-')
+            data = data[int(start):int(end) + 1]
+        return data
+
+    def open_read(self, headers=None):
+        self.read = six.BytesIO(
+            self.get_contents_as_string(headers=headers)).read
+
 
 class FakeMPU(object):
     """
@@ -192,7 +205,8 @@ class FakeBucket(object):
         key = self.keys.get(key_name)
         if not key:
             return FakeKey(self, key_name)
-        return key
+        # A new Key object is returned for each request, as boto does
+        return copy.copy(key)
 
     def new_key(self, key_name):
         new_key = FakeKey(self, key_name)
@@ -306,6 +320,34 @@ class TestStore(base.StoreBaseTest,
             data += chunk
         self.assertEqual(expected_data, data)
 
+    def test_get_with_download_threads(self):
+        """Test a retrieval of an image in concurrent byte ranges."""
+        self.config(s3_store_download_threads=3,
+                    s3_store_download_range_size=1)
+        loc = location.get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID,
+            conf=self.conf)
+        with mock.patch.object(s3.units, 'Mi', units.Ki):
+            (image_s3, image_size) = self.store.get(loc)
+
+        self.assertEqual(image_size, FIVE_KB)
+        self.assertEqual(b"*" * FIVE_KB, b"".join(image_s3))
+
+    def test_get_with_download_threads_streams_ranges(self):
+        """Test each byte range is read in chunks of READ_CHUNKSIZE."""
+        self.config(s3_store_download_threads=3,
+                    s3_store_download_range_size=1)
+        self.store.READ_CHUNKSIZE = 256
+        loc = location.get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID,
+            conf=self.conf)
+        with mock.patch.object(s3.units, 'Mi', units.Ki):
+            (image_s3, image_size) = self.store.get(loc)
+            chunks = list(image_s3)
+
+        self.assertEqual([256] * 20, [len(chunk) for chunk in chunks])
+        self.assertEqual(b"*" * FIVE_KB, b"".join(chunks))
+
     def test_partial_get(self):
         """Test a "normal" retrieval of an image in chunks."""
         loc = location.get_location_from_uri(
@@ -13,10 +13,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+import threading
+
 import mock
+import six
 
 import glance_store as store
 from glance_store import backend
+from glance_store.common import utils
+from glance_store import exceptions
+from glance_store import location
 from glance_store.tests import base
 
 
@@ -32,3 +39,402 @@ class TestStoreBase(base.StoreBaseTest):
         for (__, store_instance) in backend._load_stores(self.conf):
             store_instance.configure()
             self.assertTrue(mock_log.warn.called)
+
+
+class TestDriverPool(base.StoreBaseTest):
+
+    def setUp(self):
+        super(TestDriverPool, self).setUp()
+        self.config(stores=['rbd'], default_store='rbd')
+        store.create_stores(self.conf)
+
+    def test_released_store_is_reused(self):
+        first = backend.get_store_from_scheme('rbd')
+        self.assertIsNot(first, backend.get_store_from_scheme('rbd'))
+        backend.release_store(first)
+        self.assertIs(first, backend.get_store_from_scheme('rbd'))
+
+    def test_checked_out_store_is_not_shared(self):
+        first = backend.get_store_from_scheme('rbd')
+        second = backend.get_store_from_scheme('rbd')
+        self.assertIsNot(first, second)
+        backend.release_store(first)
+        backend.release_store(second)
+        stores = set([backend.get_store_from_scheme('rbd'),
+                      backend.get_store_from_scheme('rbd')])
+        self.assertEqual(set([first, second]), stores)
+
+    def test_double_release_is_noop(self):
+        first = backend.get_store_from_scheme('rbd')
+        backend.release_store(first)
+        backend.release_store(first)
+        self.assertIs(first, backend.get_store_from_scheme('rbd'))
+        self.assertIsNot(first, backend.get_store_from_scheme('rbd'))
+
+    def test_pool_size_bounded(self):
+        self.config(store_driver_pool_size=1)
+        store.create_stores(self.conf)
+        first = backend.get_store_from_scheme('rbd')
+        second = backend.get_store_from_scheme('rbd')
+        backend.release_store(first)
+        backend.release_store(second)
+        self.assertIs(first, backend.get_store_from_scheme('rbd'))
+        self.assertIsNot(second, backend.get_store_from_scheme('rbd'))
+
+    def test_pool_disabled(self):
+        self.config(store_driver_pool_size=0)
+        store.create_stores(self.conf)
+        first = backend.get_store_from_scheme('rbd')
+        backend.release_store(first)
+        self.assertIsNot(first, backend.get_store_from_scheme('rbd'))
+
+    def test_backend_operations_release_store(self):
+        first = backend.get_store_from_scheme('rbd')
+        backend.release_store(first)
+        with mock.patch.object(first, 'get_size', return_value=3) as gs:
+            self.assertEqual(3, backend.get_size_from_backend(
+                'rbd://fsid/pool/image/snap'))
+            self.assertTrue(gs.called)
+        self.assertIs(first, backend.get_store_from_scheme('rbd'))
+
+    def test_get_releases_store_once_data_is_read(self):
+        first = backend.get_store_from_scheme('rbd')
+        backend.release_store(first)
+        with mock.patch.object(first, 'get',
+                               return_value=(iter([b'ab', b'c']), 3)):
+            data, size = backend.get_from_backend(
+                'rbd://fsid/pool/image/snap')
+            self.assertIsNot(first, backend.get_store_from_scheme('rbd'))
+            self.assertEqual(b'abc', b''.join(data))
+        self.assertIs(first, backend.get_store_from_scheme('rbd'))
+
+    def test_get_of_indexable_stays_indexable(self):
+        class ChunksIndexable(backend.Indexable):
+            def another(self):
+                return next(self.wrapped, b'')
+
+        first = backend.get_store_from_scheme('rbd')
+        backend.release_store(first)
+        indexable = ChunksIndexable(iter([b'ab', b'c']), 3)
+        with mock.patch.object(first, 'get', return_value=(indexable, 3)):
+            data, size = backend.get_from_backend(
+                'rbd://fsid/pool/image/snap')
+            self.assertEqual(3, len(data))
+            self.assertEqual(b'ab', bytes(data[0:]))
+            self.assertEqual(b'b', bytes(data[1:]))
+            self.assertIsNot(first, backend.get_store_from_scheme('rbd'))
+            self.assertEqual(b'c', bytes(data[2:]))
+        # Released once all the data has been indexed
+        self.assertIs(first, backend.get_store_from_scheme('rbd'))
+
+    def test_get_releases_store_when_data_is_closed(self):
+        first = backend.get_store_from_scheme('rbd')
+        backend.release_store(first)
+        chunks = mock.MagicMock()
+        with mock.patch.object(first, 'get', return_value=(chunks, 3)):
+            data, size = backend.get_from_backend(
+                'rbd://fsid/pool/image/snap')
+            data.close()
+        self.assertTrue(chunks.close.called)
+        self.assertIs(first, backend.get_store_from_scheme('rbd'))
+
+    def test_get_releases_store_on_error(self):
+        first = backend.get_store_from_scheme('rbd')
+        backend.release_store(first)
+        with mock.patch.object(first, 'get',
+                               side_effect=exceptions.BackendException):
+            self.assertRaises(exceptions.BackendException,
+                              backend.get_from_backend,
+                              'rbd://fsid/pool/image/snap')
+        self.assertIs(first, backend.get_store_from_scheme('rbd'))
+
+    def test_checked_out_store(self):
+        with backend.checked_out_store('rbd') as first:
+            self.assertIsNot(first, backend.get_store_from_scheme('rbd'))
+        self.assertIs(first, backend.get_store_from_scheme('rbd'))
+
+
+class TestIndexable(base.StoreBaseTest):
+
+    class FileIndexable(backend.Indexable):
+        def another(self):
+            return self.read_chunk(self.wrapped, 4)
+
+    def test_sendall_does_not_copy_tails(self):
+        indexable = self.FileIndexable(six.BytesIO(b'0123456789'), 10)
+        sent = []
+        tail = 0
+        while tail < len(indexable):
+            data = indexable[tail:]
+            # A socket taking 3 bytes a time
+            sent.append(bytes(data[:3]))
+            tail += len(sent[-1])
+        self.assertEqual(b'0123456789', b''.join(sent))
+
+    def test_tail_is_view_of_chunk(self):
+        indexable = self.FileIndexable(six.BytesIO(b'0123456789'), 10)
+        first = indexable[0:]
+        tail = indexable[2:]
+        self.assertIsInstance(tail, memoryview)
+        self.assertEqual(b'23', bytes(tail))
+        self.assertIs(first.obj, tail.obj)
+
+    def test_read_chunk_reuses_buffer(self):
+        indexable = self.FileIndexable(six.BytesIO(b'0123456789'), 10)
+        first = indexable[0:]
+        self.assertEqual(b'0123', bytes(first))
+        second = indexable[4:]
+        self.assertEqual(b'4567', bytes(second))
+        self.assertIs(first.obj, second.obj)
+        self.assertEqual(b'89', bytes(indexable[8:]))
+        self.assertEqual(b'', bytes(indexable[10:]))
+
+    def test_read_chunk_without_readinto(self):
+        fp = mock.Mock(spec=['read'])
+        fp.read.return_value = b'abc'
+        indexable = self.FileIndexable(fp, 3)
+        self.assertEqual(b'abc', indexable[0:])
+        fp.read.assert_called_once_with(4)
+
+
+class TestLazyLoad(base.StoreBaseTest):
+
+    def setUp(self):
+        super(TestLazyLoad, self).setUp()
+        self.config(stores=['file', 'rbd'], default_store='file',
+                    store_lazy_load=True,
+                    filesystem_store_datadir=self.test_dir)
+
+    def test_drivers_loaded_on_first_use(self):
+        with mock.patch.object(backend, '_load_store',
+                               wraps=backend._load_store) as load:
+            self.assertEqual(2, store.create_stores(self.conf))
+            self.assertFalse(load.called)
+            self.assertIsInstance(location.SCHEME_TO_CLS_MAP['file'],
+                                  backend._LazySchemeInfo)
+            self.assertEqual('file',
+                             location.SCHEME_TO_CLS_MAP['file']['store_entry'])
+
+            loc = location.get_location_from_uri('file:///tmp/img',
+                                                 conf=self.conf)
+            self.assertEqual('/tmp/img', loc.store_location.path)
+            fs_store = backend.get_store_from_scheme('filesystem')
+            self.assertEqual('file', fs_store.get_schemes()[0])
+            load.assert_called_once_with(self.conf, 'file')
+
+        # The loaded store replaces the placeholders of its schemes
+        self.assertIs(fs_store, location.SCHEME_TO_CLS_MAP['file']['store'])
+        self.assertNotIsInstance(location.SCHEME_TO_CLS_MAP['file'],
+                                 backend._LazySchemeInfo)
+        self.assertIsInstance(location.SCHEME_TO_CLS_MAP['rbd'],
+                              backend._LazySchemeInfo)
+
+    def test_unknown_driver_loaded_at_startup(self):
+        self.config(stores=['file', 'unknown'])
+        with mock.patch.object(backend, '_load_store',
+                               return_value=None) as load:
+            store.create_stores(self.conf)
+        load.assert_called_once_with(self.conf, 'unknown')
+
+    def test_concurrent_lookup_waits_for_load(self):
+        store.create_stores(self.conf)
+        load_store = backend._load_store
+        found = []
+
+        def lookup():
+            found.append(backend.get_store_from_scheme('filesystem'))
+
+        def load(conf, store_entry):
+            # The placeholders stay registered while the driver loads
+            self.assertIsInstance(location.SCHEME_TO_CLS_MAP['filesystem'],
+                                  backend._LazySchemeInfo)
+            thread = threading.Thread(target=lookup)
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual([], found)
+            self.threads.append(thread)
+            return load_store(conf, store_entry)
+
+        self.threads = []
+        with mock.patch.object(backend, '_load_store', side_effect=load):
+            fs_store = backend.get_store_from_scheme('file')
+        self.threads[0].join()
+        self.assertEqual([fs_store], found)
+
+    def test_driver_failing_to_load_unregistered(self):
+        store.create_stores(self.conf)
+        with mock.patch.object(backend, '_load_store', return_value=None):
+            self.assertRaises(exceptions.UnknownScheme,
+                              backend.get_store_from_scheme, 'rbd')
+        self.assertNotIn('rbd', location.SCHEME_TO_CLS_MAP)
+
+    def test_driver_schemes(self):
+        for store_entry, target in backend._entry_points(
+                'glance_store.drivers'):
+            if target.startswith('glance_store.tests.'):
+                continue
+            schemes = backend._driver_schemes(store_entry)
+            self.assertIsNotNone(schemes, store_entry)
+            try:
+                driver_cls = backend._load_store(None, store_entry, False)
+            except Exception:
+                # The dependencies of the driver aren't installed
+                continue
+            self.assertEqual(sorted(driver_cls.get_schemes(mock.Mock())),
+                             sorted(schemes))
+
+
+class FakeStore(object):
+
+    def __init__(self, scheme, conf, fail_after=None):
+        self.scheme = scheme
+        self.conf = conf
+        self.fail_after = fail_after
+        self.data = None
+
+    def get_schemes(self):
+        return (self.scheme,)
+
+    def is_capable(self, *capabilities):
+        return True
+
+    def add(self, image_id, image_file, image_size, context=None):
+        data = b''
+        checksum = hashlib.md5()
+        for chunk in utils.chunkreadable(image_file, 4096):
+            data += chunk
+            checksum.update(chunk)
+            if self.fail_after is not None and len(data) > self.fail_after:
+                raise exceptions.StorageFull()
+        self.data = data
+        return ('%s://%s' % (self.scheme, image_id), len(data),
+                checksum.hexdigest(), {})
+
+
+class TestAddToBackends(base.StoreBaseTest):
+
+    def setUp(self):
+        super(TestAddToBackends, self).setUp()
+        self.stores = {}
+
+    def _register(self, scheme, **kwargs):
+        fake = self.stores[scheme] = FakeStore(scheme, self.conf, **kwargs)
+        location.register_scheme_map({scheme: {'store': fake,
+                                               'location_class': None,
+                                               'store_entry': None}})
+
+    def test_add_to_backends(self):
+        self._register('one')
+        self._register('two')
+        data = b'x' * 1000
+        results = backend.add_to_backends(self.conf, 'img',
+                                          six.BytesIO(data), len(data),
+                                          ['one', 'two'])
+        checksum = hashlib.md5(data).hexdigest()
+        self.assertEqual([('one://img', 1000, checksum, {}),
+                          ('two://img', 1000, checksum, {})], results)
+        self.assertEqual(data, self.stores['one'].data)
+        self.assertEqual(data, self.stores['two'].data)
+
+    def test_source_read_once_with_small_buffer(self):
+        self.config(store_fanout_buffer_size=1)
+        self._register('one')
+        self._register('two')
+        data = six.BytesIO(b'x' * (1024 * 1024))
+        with mock.patch.object(data, 'read', wraps=data.read) as read:
+            backend.add_to_backends(self.conf, 'img', data, 0,
+                                    ['one', 'two'])
+        # 16 chunks of 64KiB and the final empty read
+        self.assertEqual(17, read.call_count)
+        self.assertEqual(1024 * 1024, len(self.stores['two'].data))
+
+    @mock.patch.object(backend, 'delete_from_backend')
+    def test_failure_deletes_other_locations(self, mock_delete):
+        self.config(store_fanout_buffer_size=1)
+        self._register('one')
+        self._register('two', fail_after=100)
+        data = six.BytesIO(b'x' * (1024 * 1024))
+        self.assertRaises(exceptions.StorageFull, backend.add_to_backends,
+                          self.conf, 'img', data, 0, ['one', 'two'])
+        self.assertIsNone(self.stores['two'].data)
+        for call in mock_delete.call_args_list:
+            self.assertEqual('one://img', call[0][0])
+
+    @mock.patch.object(backend, 'delete_from_backend')
+    def test_source_failure_deletes_locations(self, mock_delete):
+        self._register('one')
+        data = mock.Mock()
+        data.read.side_effect = [b'x' * 10, IOError()]
+        self.assertRaises(IOError, backend.add_to_backends,
+                          self.conf, 'img', data, 0, ['one'])
+        self.assertIsNone(self.stores['one'].data)
+        self.assertFalse(mock_delete.called)
+
+    def test_unknown_scheme(self):
+        self._register('one')
+        self.assertRaises(exceptions.UnknownScheme, backend.add_to_backends,
+                          self.conf, 'img', six.BytesIO(b'x'), 1,
+                          ['one', 'nope'])
+
+
+class TestCopyBetweenStores(base.StoreBaseTest):
+
+    def setUp(self):
+        super(TestCopyBetweenStores, self).setUp()
+        self.dst = FakeStore('dst', self.conf)
+        location.register_scheme_map({'dst': {'store': self.dst,
+                                              'location_class': None,
+                                              'store_entry': None}})
+
+    def _copy(self, chunks, size):
+        with mock.patch.object(backend, 'get_from_backend',
+                               return_value=(chunks, size)) as get:
+            result = backend.copy_between_stores('src://img', 'dst', 'img',
+                                                 conf=self.conf)
+            get.assert_called_once_with('src://img', context=None)
+        return result
+
+    def test_copy(self):
+        self.config(store_fanout_buffer_size=1)
+        chunks = [b'%d' % i * 1000 for i in range(100)]
+        data = b''.join(chunks)
+        result = self._copy(iter(chunks), len(data))
+        self.assertEqual(('dst://img', len(data),
+                          hashlib.md5(data).hexdigest(), {}), result)
+        self.assertEqual(data, self.dst.data)
+
+    def test_source_failure(self):
+        def chunks():
+            yield b'x' * 10
+            raise exceptions.NotFound(image='img')
+
+        self.assertRaises(exceptions.NotFound, self._copy, chunks(), 20)
+        self.assertIsNone(self.dst.data)
+
+    def test_destination_failure_stops_source(self):
+        self.config(store_fanout_buffer_size=1)
+        self.dst.fail_after = 100
+        consumed = []
+
+        def chunks():
+            for i in range(1000):
+                consumed.append(i)
+                yield b'x' * 4096
+
+        self.assertRaises(exceptions.StorageFull, self._copy, chunks(), 0)
+        self.assertTrue(len(consumed) < 1000)
+
+    def test_queue_reader_read_sizes(self):
+        reader = backend._QueueReader(4)
+        for chunk in (b'abc', b'defgh', b'ij'):
+            reader.feed(chunk)
+        reader.finish()
+        data = [reader.read(2), reader.read(5), reader.read(), reader.read()]
+        self.assertEqual([b'ab', b'cdefg', b'hij', b''], data)
+        self.assertTrue(all(type(chunk) is bytes for chunk in data))
+
+    @mock.patch.object(backend, 'delete_from_backend')
+    def test_size_mismatch(self, mock_delete):
+        self.assertRaises(exceptions.BackendException, self._copy,
+                          iter([b'x' * 10]), 20)
+        mock_delete.assert_called_once_with('dst://img', context=None)
@@ -13,10 +13,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+
+import mock
 from oslotest import base
 import six
 
 from glance_store.common import utils
+from glance_store import exceptions
 
 
 class TestUtils(base.BaseTestCase):
@@ -42,3 +46,126 @@ class TestUtils(base.BaseTestCase):
             self.skipTest("test specific to Python 2")
         ret = utils.exception_to_str(Exception('\xa5 error message'))
         self.assertEqual(ret, ' error message')
+
+    def test_run_blocking(self):
+        func = mock.Mock(return_value=3)
+        with mock.patch.object(utils.patcher, 'is_monkey_patched',
+                               return_value=False):
+            self.assertEqual(3, utils.run_blocking(func, 1, b=2))
+        func.assert_called_once_with(1, b=2)
+
+    def test_run_blocking_in_tpool_when_monkey_patched(self):
+        func = mock.Mock()
+        with mock.patch.object(utils.patcher, 'is_monkey_patched',
+                               return_value=True):
+            with mock.patch.object(utils.tpool, 'execute',
+                                   return_value=3) as execute:
+                self.assertEqual(3, utils.run_blocking(func, 1, b=2))
+        execute.assert_called_once_with(func, 1, b=2)
+        self.assertFalse(func.called)
+
+    def test_parallel_range_iter(self):
+        data = b'0123456789abcdefghij'
+        calls = []
+
+        def fetch(offset, length):
+            calls.append((offset, length))
+            return [data[offset:offset + length]]
+
+        chunks = list(utils.parallel_range_iter(fetch, len(data), 6, 3))
+        self.assertEqual([b'012345', b'6789ab', b'cdefgh', b'ij'], chunks)
+        self.assertEqual([(0, 6), (6, 6), (12, 6), (18, 2)], sorted(calls))
+
+    def test_parallel_range_iter_without_eventlet(self):
+        data = b'0123456789abcdefghij'
+        calls = []
+
+        def fetch(offset, length):
+            calls.append((offset, length))
+            return [data[offset:offset + length]]
+
+        with mock.patch.object(utils, 'greenpool', None):
+            chunks = list(utils.parallel_range_iter(fetch, len(data), 6, 3))
+        self.assertEqual([b'012345', b'6789ab', b'cdefgh', b'ij'], chunks)
+        self.assertEqual([(0, 6), (6, 6), (12, 6), (18, 2)], calls)
+
+    def test_parallel_range_iter_short_range(self):
+        def fetch(offset, length):
+            return [b'x']
+
+        self.assertRaises(exceptions.BackendException, list,
+                          utils.parallel_range_iter(fetch, 10, 5, 2))
+
+    def _conf(self, algorithms=(), threads=0):
+        return mock.Mock(glance_store=mock.Mock(
+            store_checksum_algorithms=list(algorithms),
+            store_checksum_threads=threads))
+
+    def _checksum(self, checksum, chunks):
+        for chunk in chunks:
+            checksum.update(chunk)
+        return checksum
+
+    def test_checksum_md5_only(self):
+        chunks = [b'a' * 100, b'b' * 100000]
+        checksum = self._checksum(utils.Checksum(), chunks)
+        self.assertEqual(hashlib.md5(b''.join(chunks)).hexdigest(),
+                         checksum.hexdigest())
+        self.assertEqual({}, checksum.metadata())
+
+    def test_checksum_multiple_digests_offloaded(self):
+        chunks = [b'a' * 100, b'b' * 100000, b'c' * 70000, b'd']
+        data = b''.join(chunks)
+        checksum = self._checksum(
+            utils.Checksum(self._conf(['sha256', 'sha512'], threads=2)),
+            chunks)
+        self.assertEqual(hashlib.md5(data).hexdigest(), checksum.hexdigest())
+        self.assertEqual({'md5': hashlib.md5(data).hexdigest(),
+                          'sha256': hashlib.sha256(data).hexdigest(),
+                          'sha512': hashlib.sha512(data).hexdigest()},
+                         checksum.hexdigests())
+        metadata = checksum.metadata()
+        self.assertEqual(['sha256', 'sha512'], sorted(metadata))
+        self.assertIsInstance(metadata['sha256'], six.text_type)
+
+    def test_checksum_offloads_large_chunks(self):
+        checksum = utils.Checksum(self._conf(threads=1))
+        with mock.patch.object(utils, 'run_blocking',
+                               side_effect=lambda f, *a: f(*a)) as blocking:
+            self._checksum(checksum, [b'a' * 100, b'b' * 100000])
+        self.assertEqual(1, blocking.call_count)
+        self.assertEqual(hashlib.md5(b'a' * 100 + b'b' * 100000).hexdigest(),
+                         checksum.hexdigest())
+
+    def test_checksum_unsupported_algorithm(self):
+        self.assertRaises(exceptions.BackendException, utils.Checksum,
+                          self._conf(['nope']))
+
+    def test_chunkreadable_yields_bytes(self):
+        data = memoryview(b'0123456789')
+        chunks = list(utils.chunkreadable(iter([data[:4], data[4:]])))
+        self.assertEqual([b'0123', b'456789'], chunks)
+        self.assertTrue(all(type(chunk) is bytes for chunk in chunks))
+        chunks = list(utils.chunkreadable(six.BytesIO(b'0123456789'), 4))
+        self.assertEqual([b'0123', b'4567', b'89'], chunks)
+
+    def test_data_extents(self):
+        self.assertEqual([], utils.data_extents(b''))
+        self.assertEqual([], utils.data_extents(b'\0' * 10, block_size=4))
+        self.assertEqual([(0, 10)], utils.data_extents(b'*' * 10,
+                                                       block_size=4))
+        data = b'\0' * 4 + b'*' + b'\0' * 7 + b'\0' * 4 + b'\0*'
+        self.assertEqual([(4, 4), (16, 2)],
+                         utils.data_extents(data, block_size=4))
+        self.assertEqual([(4, 4), (16, 2)],
+                         utils.data_extents(bytearray(data), block_size=4))
+        self.assertEqual([(0, 8), (16, 2)],
+                         utils.data_extents(b'*' + data[1:], block_size=4))
+        self.assertEqual([(4, 4), (16, 2)],
+                         utils.data_extents(memoryview(data), block_size=4))
+        self.assertEqual([], utils.data_extents(memoryview(b'\0' * 10),
+                                                block_size=4))
+        # Blocks starting with a zero byte which hold data
+        self.assertEqual([(0, 8)],
+                         utils.data_extents(b'\0**\0\0\0\0*',
+                                            block_size=4))
@@ -0,0 +1,229 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Move the image files of filesystem store datadirs to the layout of a
+fan-out, e.g. after changing filesystem_store_fanout.
+
+The image files are renamed within their datadir, in parallel. The store
+finds image files at any level of fan-out, so that it keeps serving them
+under the locations they were added with while and after they are moved.
+Image files added by a store configured with another fan-out while they
+are moved are left where they are, running the command again moves them.
+
+The file:// paths of moved image files which were handed out of process
+go stale: the direct URLs of images, and the paths recorded in the
+files of filesystem_store_metadata_file. Readers which open those paths
+themselves rather than through the store must look the images up again.
+"""
+
+import argparse
+import errno
+import logging
+from multiprocessing import pool
+import os
+import sys
+
+from oslo_config import cfg
+
+from glance_store._drivers import filesystem
+from glance_store.common import utils
+
+LOG = logging.getLogger(__name__)
+
+
+def find_image_files(datadir):
+    """
+    Yield the paths of the image files of a datadir, at any level of
+    fan-out. Temporary files and files at paths no image of that name
+    would be stored at are ignored.
+    """
+    datadir = os.path.normpath(datadir)
+    for dirpath, dirnames, filenames in os.walk(datadir):
+        depth = len(os.path.relpath(dirpath, datadir).split(os.sep))
+        if dirpath == datadir:
+            depth = 0
+        if depth >= filesystem.MAX_FANOUT:
+            del dirnames[:]
+        for name in filenames:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(dirpath, name)
+            if path == filesystem.image_path(datadir, name, depth):
+                yield path
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def move_image_file(datadir, path, fanout, dry_run=False):
+    """
+    Move an image file of a datadir to its path for a fan-out.
+
+    :returns: the new path of the image file, or None if it was already
+              there
+    :raises OSError: if it can't be moved, or there is a file at its new
+                     path already
+    """
+    datadir = os.path.normpath(datadir)
+    target = filesystem.image_path(datadir, os.path.basename(path), fanout)
+    if target == path:
+        return None
+    if dry_run:
+        if os.path.exists(target):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), target)
+        return target
+    _makedirs(os.path.dirname(target))
+    # Hard linked rather than renamed, which fails rather than replaces an
+    # image file added concurrently under the same name
+    try:
+        os.link(path, target)
+    except OSError as e:
+        if e.errno in (errno.EEXIST, errno.ENOENT):
+            raise
+        # The filesystem doesn't support hard links
+        if os.path.exists(target):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), target)
+        os.rename(path, target)
+    else:
+        os.unlink(path)
+    return target
+
+
+def _remove_empty_directories(datadir, fanout):
+    """
+    Remove the empty subdirectories of a datadir deeper than a fan-out,
+    leaving those a store configured with it may be adding image files to.
+    """
+    datadir = os.path.normpath(datadir)
+    for dirpath, dirnames, filenames in os.walk(datadir, topdown=False):
+        if dirpath == datadir:
+            continue
+        depth = len(os.path.relpath(dirpath, datadir).split(os.sep))
+        if depth > fanout and not os.listdir(dirpath):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+
+
+def migrate(datadirs, fanout, workers=8, dry_run=False):
+    """
+    Move the image files of datadirs to their path for a fan-out.
+
+    :returns: a tuple of the numbers of image files moved and of image
+              files which couldn't be
+    """
+    def move(job):
+        datadir, path = job
+        try:
+            target = move_image_file(datadir, path, fanout, dry_run)
+        except OSError as e:
+            LOG.error("Unable to move %(path)s: %(e)s" %
+                      {'path': path, 'e': utils.exception_to_str(e)})
+            return None
+        if target is not None:
+            LOG.info("Moved %(path)s to %(target)s" %
+                     {'path': path, 'target': target})
+        return target is not None
+
+    jobs = [(datadir, path) for datadir in datadirs
+            for path in list(find_image_files(datadir))]
+    workers = pool.ThreadPool(max(1, workers))
+    try:
+        results = workers.map(move, jobs)
+    finally:
+        workers.close()
+        workers.join()
+
+    if not dry_run:
+        for datadir in datadirs:
+            _remove_empty_directories(datadir, fanout)
+    return (len([r for r in results if r]),
+            len([r for r in results if r is None]))
+
+
+def load_store_config(config_file):
+    """
+    Read the filesystem store options of a configuration file.
+
+    :returns: a tuple of the datadirs and the [glance_store] options
+    """
+    conf = cfg.ConfigOpts()
+    conf.register_opts(filesystem._FILESYSTEM_CONFIGS, group='glance_store')
+    conf(args=[], default_config_files=[config_file])
+    glance_conf = conf.glance_store
+    if glance_conf.filesystem_store_datadir:
+        datadirs = [glance_conf.filesystem_store_datadir]
+    else:
+        datadirs = [datadir.rsplit(':', 1)[0].strip()
+                    for datadir in glance_conf.filesystem_store_datadirs or []]
+    return datadirs, glance_conf
+
+
+def _load_config(config_file):
+    datadirs, glance_conf = load_store_config(config_file)
+    return datadirs, glance_conf.filesystem_store_fanout
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Move the image files of filesystem store datadirs to '
+                    'the layout of a fan-out.')
+    parser.add_argument('datadirs', nargs='*', metavar='DATADIR',
+                        help='Datadirs to move the image files of')
+    parser.add_argument('--config-file',
+                        help='Configuration file to read the datadirs and '
+                             'the fan-out from, filesystem_store_datadir(s) '
+                             'and filesystem_store_fanout in the '
+                             '[glance_store] section')
+    parser.add_argument('--fanout', type=int,
+                        help='Levels of subdirectories to move the image '
+                             'files to, 0 moves them back to the datadirs')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Image files moved in parallel '
+                             '(default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only print the image files which would be '
+                             'moved')
+    args = parser.parse_args(argv)
+
+    datadirs, fanout = args.datadirs, args.fanout
+    if args.config_file:
+        conf_datadirs, conf_fanout = _load_config(args.config_file)
+        datadirs = datadirs or conf_datadirs
+        fanout = conf_fanout if fanout is None else fanout
+    if not datadirs:
+        parser.error('no datadir given')
+    if fanout is None:
+        parser.error('no fan-out given')
+    if not 0 <= fanout <= filesystem.MAX_FANOUT:
+        parser.error('the fan-out must be between 0 and %d' %
+                     filesystem.MAX_FANOUT)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    moved, failed = migrate(datadirs, fanout, args.workers, args.dry_run)
+    print('%d image files %s, %d failed' %
+          (moved, 'to move' if args.dry_run else 'moved', failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,458 @@
+# Copyright 2015 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Find the files of filesystem store datadirs which aren't the data of an
+image, or no longer are, and optionally remove them:
+
+- partial: temporary files of image files left over by uploads which
+  failed or were interrupted
+- empty: image files of zero length
+- orphan_extent: extents of striped images without a manifest, which
+  are only looked for when all the datadirs of the store are scanned
+- incomplete: manifests of striped images missing extents
+- unreferenced: images whose ID isn't known
+- checksum_mismatch: images whose data doesn't match their checksum
+
+Files modified more recently than the maximum age of temporary files may
+belong to uploads in progress, and are left alone, as are the extents of
+the images with temporary files. The datadirs and
+their fan-out subdirectories are scanned in parallel.
+"""
+
+import argparse
+import collections
+import hashlib
+import logging
+from multiprocessing import pool
+import os
+import re
+import stat
+import sys
+import threading
+import time
+
+from oslo_serialization import jsonutils
+
+from glance_store._drivers import filesystem
+from glance_store.common import utils
+from glance_store import compression
+from glance_store.tools import filesystem_layout
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+LOG = logging.getLogger(__name__)
+
+PARTIAL = 'partial'
+EMPTY = 'empty'
+ORPHAN_EXTENT = 'orphan_extent'
+INCOMPLETE = 'incomplete'
+UNREFERENCED = 'unreferenced'
+CHECKSUM_MISMATCH = 'checksum_mismatch'
+KINDS = (PARTIAL, EMPTY, ORPHAN_EXTENT, INCOMPLETE, UNREFERENCED,
+         CHECKSUM_MISMATCH)
+# Nothing refers to these files, they are removed unless told otherwise
+DEFAULT_REMOVE_KINDS = (PARTIAL,)
+
+# The files of a finding are those removed with it: its file, or the
+# extents of a striped image and its manifest
+Finding = collections.namedtuple('Finding', ['kind', 'path', 'image_id',
+                                             'size', 'files'])
+
+_EXTENT = re.compile(r'^(.+)\.(\d+)$')
+_READ_SIZE = 1024 * 1024
+
+
+class Throttle(object):
+    """Limits the reads of several threads to `rate` bytes per second."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, amount):
+        """Account for amount bytes read, sleeping to keep to the rate."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._next = max(now, self._next) + amount / float(self.rate)
+            delay = self._next - now
+        time.sleep(delay)
+
+
+def _scandir(directory):
+    """Yield the path, name, stat and whether it is a directory of entries."""
+    if scandir is None:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            st = os.lstat(path)
+            yield path, name, st, stat.S_ISDIR(st.st_mode)
+        return
+    for entry in scandir(directory):
+        yield (entry.path, entry.name, entry.stat(follow_symlinks=False),
+               entry.is_dir(follow_symlinks=False))
+
+
+def _list_files(directory, depth, recursive):
+    """
+    Return the path, name, depth and stat of the regular files below a
+    directory, down to the deepest fan-out, and its subdirectories when
+    not recursive.
+    """
+    files = []
+    subdirectories = []
+    for path, name, st, is_dir in _scandir(directory):
+        if is_dir:
+            if depth < filesystem.MAX_FANOUT:
+                if recursive:
+                    files.extend(_list_files(path, depth + 1, True)[0])
+                else:
+                    subdirectories.append(path)
+        elif stat.S_ISREG(st.st_mode):
+            files.append((path, name, depth, st))
+    return files, subdirectories
+
+
+def _as_lookup(value):
+    """Turn a collection or mapping into a function looking it up."""
+    if value is None or callable(value):
+        return value
+    if isinstance(value, dict):
+        return value.get
+    value = set(value)
+    return lambda image_id: image_id in value
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            return jsonutils.loads(f.read())['extents']
+    except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+        LOG.warn("Unable to read the manifest %(path)s: %(e)s" %
+                 {'path': path, 'e': utils.exception_to_str(e)})
+        return None
+
+
+def _read_files(paths, throttle):
+    for path in paths:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(_READ_SIZE)
+                if not chunk:
+                    break
+                throttle.consume(len(chunk))
+                yield chunk
+
+
+def _checksum(paths, size, throttle):
+    """Return the md5 checksum of the image data stored in files."""
+    checksum = hashlib.md5()
+    chunks = compression.decompress(_read_files(paths, throttle), size)[0]
+    for chunk in chunks:
+        checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def scan(datadirs, known=None, checksums=None, temp_file_max_age=3600,
+         workers=8, bandwidth=None, store_datadirs=None):
+    """
+    Find the files of datadirs to scrub.
+
+    :param known: A function returning whether an image ID is known, or a
+                  collection of the known image IDs. Images aren't checked
+                  to be known without it.
+    :param checksums: A function returning the md5 checksum of an image,
+                      or None if it isn't known, or a dict of them by
+                      image ID. Checksums aren't verified without it.
+    :param temp_file_max_age: The age in seconds of the files which may
+                              belong to uploads in progress
+    :param workers: The number of directories scanned, and of images
+                    verified, in parallel
+    :param bandwidth: The rate in bytes per second at which the image
+                      data is read to be verified, or None if unbounded
+    :param store_datadirs: All the datadirs of the store, by default
+                           datadirs. The manifest of a striped image may be
+                           in any of them, so orphan extents are only
+                           looked for when they are all scanned.
+    :returns: a list of Findings
+    """
+    known = _as_lookup(known)
+    checksums = _as_lookup(checksums)
+    throttle = Throttle(bandwidth)
+    oldest = time.time() - temp_file_max_age
+    workers = pool.ThreadPool(max(1, workers))
+    try:
+        # The datadirs are listed, then their subdirectories, in parallel
+        datadirs = [os.path.normpath(datadir) for datadir in datadirs]
+        jobs = []
+        files = []
+        for datadir, (top, subdirectories) in zip(datadirs, workers.map(
+                lambda datadir: _list_files(datadir, 0, False), datadirs)):
+            files.extend((datadir, f) for f in top)
+            jobs.extend((datadir, path) for path in subdirectories)
+        for datadir, found in workers.map(
+                lambda job: (job[0], _list_files(job[1], 1, True)[0]), jobs):
+            files.extend((datadir, f) for f in found)
+
+        findings, images, extents, in_progress = _classify(files, oldest)
+        unscanned = set(os.path.normpath(datadir)
+                        for datadir in store_datadirs or []) - set(datadirs)
+        if unscanned:
+            LOG.warn("Not looking for orphan extents, the datadirs %s "
+                     "aren't scanned" % ', '.join(sorted(unscanned)))
+        findings.extend(_check_striped(images, extents, oldest, in_progress,
+                                       not unscanned))
+        candidates = [image for image in images
+                      if image['mtime'] < oldest and
+                      not image.get('incomplete')]
+        if known is not None:
+            for image in candidates:
+                if not known(image['image_id']):
+                    image['unreferenced'] = True
+                    findings.append(_finding(UNREFERENCED, image))
+        if checksums is not None:
+            verified = [image for image in candidates
+                        if not image.get('unreferenced') and
+                        checksums(image['image_id'])]
+            findings.extend(f for f in workers.map(
+                lambda image: _verify(image, checksums, throttle),
+                verified) if f is not None)
+    finally:
+        workers.close()
+        workers.join()
+    return findings
+
+
+def _classify(files, oldest):
+    """
+    Sort out the files of the datadirs.
+
+    :returns: a tuple of the findings about single files, the images, the
+              extents of striped images and the IDs of the images with
+              temporary files
+    """
+    findings = []
+    images = []
+    extents = {}
+    in_progress = set()
+    for datadir, (path, name, depth, st) in files:
+        if name.startswith(filesystem._TEMP_PREFIX):
+            image_id = name[len(filesystem._TEMP_PREFIX):].rsplit('.', 1)[0]
+            # The temporary files of extents are named after them
+            extent = _EXTENT.match(image_id)
+            in_progress.add(extent.group(1) if extent else image_id)
+            if st.st_mtime < oldest:
+                findings.append(Finding(PARTIAL, path, image_id,
+                                        st.st_size, [path]))
+            continue
+        if (name.startswith('.') or
+                path != filesystem.image_path(datadir, name, depth)):
+            continue
+        image = {'path': path, 'image_id': name, 'size': st.st_size,
+                 'mtime': st.st_mtime, 'files': [path]}
+        extent = _EXTENT.match(name)
+        if name.endswith(filesystem._MANIFEST_SUFFIX):
+            image['image_id'] = name[:-len(filesystem._MANIFEST_SUFFIX)]
+            image['manifest'] = True
+        elif extent is not None:
+            extents[name] = (path, extent.group(1), st)
+            continue
+        elif st.st_size == 0 and st.st_mtime < oldest:
+            findings.append(Finding(EMPTY, path, name, 0, [path]))
+            continue
+        images.append(image)
+    return findings, images, extents, in_progress
+
+
+def _check_striped(images, extents, oldest, in_progress, find_orphans):
+    """
+    Match the manifests of striped images with the extents found. The
+    extents of the images in progress, which may not have a manifest yet,
+    or of which the manifest can't be read, aren't orphaned.
+    """
+    findings = []
+    referenced = set()
+    for image in images:
+        if not image.get('manifest'):
+            continue
+        listed = _read_manifest(image['path'])
+        if listed is None:
+            in_progress.add(image['image_id'])
+            continue
+        names = [os.path.basename(path) for path in listed]
+        referenced.update(names)
+        if all(name in extents for name in names):
+            image['files'] = [extents[name][0] for name in names]
+            image['size'] = sum(extents[name][2].st_size for name in names)
+        elif image['mtime'] < oldest:
+            image['incomplete'] = True
+            image['files'] = [extents[name][0] for name in names
+                              if name in extents]
+            findings.append(_finding(INCOMPLETE, image))
+    if not find_orphans:
+        return findings
+    for name, (path, image_id, st) in sorted(extents.items()):
+        if (name not in referenced and image_id not in in_progress and
+                st.st_mtime < oldest):
+            findings.append(Finding(ORPHAN_EXTENT, path, image_id,
+                                    st.st_size, [path]))
+    return findings
+
+
+def _finding(kind, image):
+    files = list(image['files'])
+    if image.get('manifest'):
+        files.append(image['path'])
+    return Finding(kind, image['path'], image['image_id'], image['size'],
+                   files)
+
+
+def _verify(image, checksums, throttle):
+    try:
+        checksum = _checksum(image['files'], image['size'], throttle)
+    except (IOError, OSError) as e:
+        LOG.warn("Unable to verify %(path)s: %(e)s" %
+                 {'path': image['path'], 'e': utils.exception_to_str(e)})
+        return None
+    if checksum != checksums(image['image_id']):
+        return _finding(CHECKSUM_MISMATCH, image)
+    return None
+
+
+def remove(findings, kinds=DEFAULT_REMOVE_KINDS, dry_run=False):
+    """
+    Remove the files of findings of the given kinds. The extents of
+    striped images are removed along with their manifest.
+
+    :returns: a tuple of the numbers of files removed and of files which
+              couldn't be
+    """
+    removed = failed = 0
+    for finding in findings:
+        if finding.kind not in kinds:
+            continue
+        for path in finding.files:
+            try:
+                if not dry_run:
+                    os.unlink(path)
+            except OSError as e:
+                LOG.error("Unable to remove %(path)s: %(e)s" %
+                          {'path': path, 'e': utils.exception_to_str(e)})
+                failed += 1
+            else:
+                LOG.info("Removed %(path)s" % {'path': path})
+                removed += 1
+    return removed, failed
+
+
+def _read_lines(path):
+    if path == '-':
+        return [line.strip() for line in sys.stdin if line.strip()]
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Find, and optionally remove, the files of filesystem '
+                    'store datadirs which aren\'t the data of an image.')
+    parser.add_argument('datadirs', nargs='*', metavar='DATADIR',
+                        help='Datadirs to scrub')
+    parser.add_argument('--config-file',
+                        help='Configuration file to read the datadirs and '
+                             'filesystem_store_temp_file_max_age from, in '
+                             'the [glance_store] section')
+    parser.add_argument('--known-ids', metavar='FILE',
+                        help='File listing the known image IDs, one per '
+                             'line, or - for the standard input, to find '
+                             'the unreferenced images')
+    parser.add_argument('--checksums', metavar='FILE',
+                        help='File listing the md5 checksums of images, '
+                             'as "<image ID> <checksum>" lines, to verify '
+                             'them')
+    parser.add_argument('--bandwidth', type=int, metavar='MB/S',
+                        help='Limit the reads of the images verified to '
+                             'this many megabytes per second')
+    parser.add_argument('--max-age', type=int,
+                        help='Age in seconds of the files which may '
+                             'belong to uploads in progress (default: '
+                             'filesystem_store_temp_file_max_age)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Directories scanned and images verified in '
+                             'parallel (default: %(default)s)')
+    parser.add_argument('--remove', nargs='?', metavar='KINDS',
+                        const=','.join(DEFAULT_REMOVE_KINDS),
+                        help='Remove the files found of these comma '
+                             'separated kinds (default: %s)' %
+                             ','.join(DEFAULT_REMOVE_KINDS))
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only print the files which would be removed')
+    args = parser.parse_args(argv)
+
+    datadirs, max_age = args.datadirs, args.max_age
+    store_datadirs = None
+    if args.config_file:
+        store_datadirs, glance_conf = filesystem_layout.load_store_config(
+            args.config_file)
+        datadirs = datadirs or store_datadirs
+        if max_age is None:
+            max_age = glance_conf.filesystem_store_temp_file_max_age
+    if not datadirs:
+        parser.error('no datadir given')
+    for datadir in datadirs:
+        if not os.path.isdir(datadir):
+            parser.error('%s is not a directory' % datadir)
+    kinds = []
+    if args.remove:
+        kinds = [kind.strip() for kind in args.remove.split(',')]
+        for kind in kinds:
+            if kind not in KINDS:
+                parser.error('unknown kind %s' % kind)
+
+    known = checksums = None
+    if args.known_ids:
+        known = _read_lines(args.known_ids)
+    if args.checksums:
+        checksums = dict(line.split()[:2]
+                         for line in _read_lines(args.checksums))
+    bandwidth = args.bandwidth * 1024 * 1024 if args.bandwidth else None
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    findings = scan(datadirs, known=known, checksums=checksums,
+                    temp_file_max_age=3600 if max_age is None else max_age,
+                    workers=args.workers, bandwidth=bandwidth,
+                    store_datadirs=store_datadirs)
+    for finding in findings:
+        print('%-17s %12d %s' % (finding.kind, finding.size, finding.path))
+    print('%d files found, %d bytes' %
+          (len(findings), sum(finding.size for finding in findings)))
+    if not kinds:
+        return 0
+    removed, failed = remove(findings, kinds, args.dry_run)
+    print('%d files %s, %d failed' %
+          (removed, 'to remove' if args.dry_run else 'removed', failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())